@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+
+# Merge the per-rank shards ((output_path).shard(rank).jsonl) written by predict.py or rm_eval.py into output_path,
+# e.g., after a run was stopped before its own merge step. The records are ordered by the ids of --data_path.
+
+import argparse
+import json
+import os
+import sys
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+
+from training.utils.utils import get_shard_paths, merge_prediction_shards
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Merge the prediction shards of all ranks")
+    parser.add_argument('--output_path',
+                        type=str,
+                        required=True,
+                        help='The --output_path of the prediction run.')
+    parser.add_argument('--data_path',
+                        type=str,
+                        default=None,
+                        help='The data file of the run, the records follow the order of its ids '
+                        '(sorted ids if not given).')
+    parser.add_argument('--output_format',
+                        type=str,
+                        choices=["jsonl", "text"],
+                        default="jsonl",
+                        help="One JSON record per line, or the fields of a record separated by ' ||| '.")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    shard_paths = get_shard_paths(args.output_path)
+    assert len(shard_paths) > 0, f"no shard of {args.output_path} is found"
+
+    ids = None
+    if args.data_path is not None:
+        ids = [str(item['id']) for item in json.load(open(args.data_path, "r", encoding="utf-8"))]
+    num_records = merge_prediction_shards(args.output_path, ids, args.output_format)
+    print(f"merge {num_records} records of {len(shard_paths)} shards into {args.output_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,7 +12,7 @@ import json
 
 
 import torch
-from torch.utils.data import DataLoader, Subset
+from torch.utils.data import DataLoader, Subset, BatchSampler
 from torch.utils.data.distributed import DistributedSampler
 
 import deepspeed
@@ -23,11 +23,15 @@ sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)) + "/training")
 
-from training.ppo_training.ppo_training_utils import sampling, sampling_llava, sampling_llama
-from training.utils.data import build_dataset, DataCollatorPadToMaxLenForPrediction
-from training.utils.utils import print_rank_0, to_device, set_random_seed, get_all_reduce_mean
+from training.ppo_training.ppo_training_utils import sampling, sampling_llava, sampling_llama, speculative_sampling_llava, \
+    batch_sampling_llava
+from training.utils.data import build_dataset, DataCollatorPadToMaxLenForPrediction, BucketedBatchSampler, get_prompt_lengths, \
+    get_sample_annotations
+from training.utils.utils import print_rank_0, to_device, set_random_seed, get_all_reduce_mean, PredictionShardWriter, \
+    get_shard_path, read_prediction_shards, remove_prediction_shards, merge_prediction_shards
 from training.utils.ds_utils import get_train_ds_config
-from training.utils.module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, fuse_lora, unfuse_lora
+from training.utils.module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, fuse_lora, unfuse_lora, \
+    convert_linear_layer_to_multi_lora, load_lora_adapter, lora_adapters
 from training.utils.model import create_dsvl_model_and_transforms, build_model
 
 def parse_args():
@@ -200,6 +204,17 @@ def parse_args():
                         choices=
                         ["default", "llama_2", "llama_3", "llama_3", 
                         "vicuna", "llava", "llava_next", "llama-3.2-vision"],)
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
     
     parser.add_argument(
         "--max_new_tokens",
@@ -230,6 +245,54 @@ def parse_args():
         default=0.75,
         type=float
     )
+    parser.add_argument(
+        "--lora_adapters",
+        nargs='*',
+        default=[],
+        help="LoRA adapters (adapter_model.bin or the checkpoint folders with it) to evaluate in one pass over the "
+        "base model, in the form name=path. The predictions of each adapter are written to (output_path).(name)."
+    )
+    parser.add_argument(
+        "--lora_module_name",
+        type=str,
+        default="model.layers.",
+        help="The scope name of the layers that the adapters are applied to."
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["jsonl", "text"],
+        default="jsonl",
+        help="Format of the merged predictions in --output_path: one JSON record per line, or the fields of a record "
+        "separated by ' ||| ' (id ||| image ||| prompt ||| prediction ||| label). Each rank writes its own JSONL shard "
+        "(output_path).shard(rank).jsonl, the shards are merged in the order of the ids of --data_path at the end."
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the shards of an interrupted run of the same --output_path and only predict the samples "
+        "whose ids are not in them."
+    )
+    parser.add_argument(
+        "--bucket_by_length",
+        action="store_true",
+        help="Sort the samples into batches of --batch_size prompts with similar lengths and the same number of images, "
+        "and decode each batch with one batched generate call (llava and llava_next). The predictions are still "
+        "written in the order of the data."
+    )
+    parser.add_argument(
+        "--draft_model_path",
+        type=str,
+        default=None,
+        help="A smaller llava / llava_next checkpoint with the same tokenizer and image processor. If given, the answers "
+        "are decoded speculatively: the draft model proposes tokens and the model verifies them in one forward."
+    )
+    parser.add_argument(
+        "--num_draft_tokens",
+        type=int,
+        default=4,
+        help="With --draft_model_path, the number of tokens the draft model proposes per verification."
+    )
 
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
@@ -237,7 +300,17 @@ def parse_args():
     if 'qwen' in args.vision_model_name_or_path.lower():
         assert args.vis_proj == 'baseline', "qwen's model only support baseline vis_proj as it has the perceiver module inside"
 
-    assert args.batch_size == 1, "For the time being, we only support cases where batchsize is 1."
+    if args.batch_size > 1:
+        assert args.bucket_by_length, "--batch_size > 1 needs --bucket_by_length, so that the samples of a batch have the same number of images"
+        assert len(args.lora_adapters) == 0, "--lora_adapters decodes one sample at a time, please use --batch_size 1"
+    if len(args.lora_adapters) > 0:
+        assert args.model_architecture in ["llava", "llava_next", "llama-3.2-vision"], \
+            "--lora_adapters supports llava, llava_next and llama-3.2-vision"
+        assert args.num_return_sequences == 1, "--lora_adapters supports one return sequence per adapter"
+    if args.draft_model_path is not None:
+        assert args.model_architecture in ["llava", "llava_next"], "--draft_model_path supports llava and llava_next"
+        assert len(args.lora_adapters) == 0, "--draft_model_path can not be used with --lora_adapters"
+        assert args.num_draft_tokens > 0, "--num_draft_tokens should be positive"
     return args
 
 
@@ -276,13 +349,34 @@ def main():
     model, image_processor, tokenizer = build_model(
                                         text_tokenizer=tokenizer,
                                         args=args,
-                                        ds_config=ds_config)
+                                        ds_config=ds_config,
+                                        enable_lora=False)
     
 
     if args.model_architecture == "default":
         model.load_state_dict(torch.load(os.path.join(args.from_checkpoint, 'pytorch_model.bin'), map_location='cpu'), strict=False) 
     model = model.to(torch.bfloat16)
     model.to('cuda')
+
+    draft_model = None
+    if args.draft_model_path is not None:
+        print_rank_0(f"load the draft model from {args.draft_model_path}............")
+        draft_model, *_ = build_model(args=args,
+                                      from_checkpoint=args.draft_model_path,
+                                      enable_lora=False)
+        draft_model = draft_model.to(torch.bfloat16)
+        draft_model.to('cuda')
+
+    # several fine-tunes on one copy of the base weights, each row of a batch is generated by one adapter
+    adapter_names = []
+    if len(args.lora_adapters) > 0:
+        model = convert_linear_layer_to_multi_lora(model, args.lora_module_name)
+        for adapter in args.lora_adapters:
+            adapter_name, adapter_path = adapter.split("=", 1)
+            num_layers = load_lora_adapter(model, adapter_name, adapter_path)
+            print_rank_0(f"load the adapter {adapter_name} into {num_layers} layers from {adapter_path}")
+            adapter_names.append(adapter_name)
+        model = model.to(torch.bfloat16)
     
     # Prepare the data
     if len(args.dataset_samples) < len(args.dataset_names):
@@ -304,7 +398,10 @@ def main():
         vis_root=args.image_folder,
         vis_processor=image_processor,
         tokenizer=tokenizer,
-        template=args.template
+        template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor
     )
 
     generation_kwargs={
@@ -317,33 +414,59 @@ def main():
     }
 
 
-    # split the dataset into train and evaluation
+    # one shard per rank and output file, the shards are merged when all ranks are done
+    if len(adapter_names) > 0:
+        output_paths = [f"{args.output_path}.{adapter_name}" for adapter_name in adapter_names]
+    else:
+        output_paths = [args.output_path]
+    if not args.resume and args.global_rank == 0:
+        for output_path in output_paths:
+            remove_prediction_shards(output_path)
+    torch.distributed.barrier()
+
+    # the reference (image, label) of each sample comes from its annotation
+    annotations = get_sample_annotations(dataset)
+    data_ids = [str(anns[0]['id']) for anns in annotations]
     train_dataset = dataset
-    args.batch_size = 1
+    if args.resume:
+        # a sample is done when all output files have it
+        finished_ids = set.intersection(*[set(str(record['id']) for record in read_prediction_shards(output_path))
+                                          for output_path in output_paths])
+        # every rank reads the shards before any rank appends to (or truncates) its own, so that they all agree on
+        # the remaining samples and the distributed sampler splits them the same way
+        torch.distributed.barrier()
+        remaining = [index for index, id in enumerate(data_ids) if id not in finished_ids]
+        print_rank_0(f"resume: {len(data_ids) - len(remaining)} samples are done, {len(remaining)} to predict", args.global_rank)
+        train_dataset = Subset(dataset, remaining)
+        annotations = [annotations[index] for index in remaining]
 
     if args.model_architecture == "llama-3.2-vision":
         image_size = image_processor.size
     else:
         image_size = image_processor.crop_size
+    if args.bucket_by_length:
+        # the prompt lengths are read from the annotations, no image is decoded
+        lengths, image_nums = get_prompt_lengths(train_dataset)
+        batch_sampler = BucketedBatchSampler(lengths, image_nums, args.batch_size)
+    else:
+        batch_sampler = BatchSampler(DistributedSampler(train_dataset, shuffle=False, drop_last=False),
+                                     args.batch_size, drop_last=False)
     train_dataloader = DataLoader(
         train_dataset,
-        batch_size=args.batch_size,
-        sampler=DistributedSampler(train_dataset, shuffle=False, drop_last=False),
+        batch_sampler=batch_sampler,
         collate_fn=DataCollatorPadToMaxLenForPrediction(args.max_seq_len, tokenizer.pad_token_id, image_size),
     )
 
-    reference = json.load(open(args.data_path, "r", encoding="utf-8"))
-
-    reference_dict = {}
-    for item in reference:
-        reference_dict[str(item['id'])] = item
-
     print_rank_0("***** Running predicting *****", args.global_rank)
 
     model.eval()
 
+    # one writer per output file, the records of this rank are appended to its shard as they are decoded
+    writers = {output_path: PredictionShardWriter(get_shard_path(output_path, args.global_rank))
+               for output_path in output_paths}
+
     ref_count = 0
-    for idx, batch in enumerate(tqdm(train_dataloader)):
+    for batch_indices, batch in zip(batch_sampler, tqdm(train_dataloader)):
         batch = to_device(batch, device)  #torch.size(1, 3, 224, 224]) #torch.Size([1, 1, 3, 224, 224])
         images = batch["image"].half() 
         input_ids = batch["input_ids"]
@@ -363,53 +486,100 @@ def main():
         
         if image_num[0] == 0:
             images = [None]
+
+        if len(adapter_names) > 0:
+            # one copy of the sample for each adapter
+            num_copies = len(adapter_names)
+            input_ids = input_ids.repeat(num_copies, 1)
+            attention_mask = attention_mask.repeat(num_copies, 1)
+            if image_num[0] > 0:
+                images = torch.cat([images] * num_copies, dim=0)
+            if image_sizes is not None:
+                image_sizes = image_sizes.repeat(num_copies, 1)
+            if args.model_architecture == 'llama-3.2-vision':
+                aspect_ratio_ids = torch.cat([aspect_ratio_ids] * num_copies, dim=0)
+                aspect_ratio_mask = torch.cat([aspect_ratio_mask] * num_copies, dim=0)
         # import pdb; pdb.set_trace()
-        if args.model_architecture == 'default':
-            sampling_ans = sampling(model, 
-                                    images, input_ids, 
-                                    attention_mask=attention_mask, 
-                                    pad_token_id=tokenizer.pad_token_id,
-                                    **generation_kwargs)
-        elif args.model_architecture in ["llava", "llava_next"]:
-            sampling_ans = sampling_llava(model, 
-                                    images, input_ids,
-                                    image_sizes=image_sizes, 
-                                    attention_mask=attention_mask, 
-                                    pad_token_id=tokenizer.pad_token_id,
-                                    processor=tokenizer,
-                                    **generation_kwargs)
-        elif args.model_architecture in ["llama-3.2-vision"]:
-            sampling_ans = sampling_llama(model, 
-                                    images, input_ids,
-                                    aspect_ratio_ids=aspect_ratio_ids,
-                                    aspect_ratio_mask=aspect_ratio_mask,
-                                    attention_mask=attention_mask, 
-                                    pad_token_id=tokenizer.pad_token_id,
-                                    processor=tokenizer,
-                                    **generation_kwargs)
-        else:
-            raise NotImplementedError("Not support newly added model architecture")
+        with lora_adapters(model, adapter_names if len(adapter_names) > 0 else None):
+            if args.model_architecture == 'default':
+                sampling_ans = sampling(model, 
+                                        images, input_ids, 
+                                        attention_mask=attention_mask, 
+                                        pad_token_id=tokenizer.pad_token_id,
+                                        **generation_kwargs)
+            elif args.model_architecture in ["llava", "llava_next"] and draft_model is not None:
+                sampling_ans = speculative_sampling_llava(model, draft_model,
+                                        images, input_ids,
+                                        image_sizes=image_sizes, 
+                                        attention_mask=attention_mask, 
+                                        pad_token_id=tokenizer.pad_token_id,
+                                        processor=tokenizer,
+                                        num_draft_tokens=args.num_draft_tokens,
+                                        **generation_kwargs)
+            elif args.model_architecture in ["llava", "llava_next"] and args.bucket_by_length:
+                sampling_ans = batch_sampling_llava(model,
+                                        images if image_num[0] > 0 else None, input_ids,
+                                        image_sizes=image_sizes,
+                                        attention_mask=attention_mask,
+                                        pad_token_id=tokenizer.pad_token_id,
+                                        processor=tokenizer,
+                                        **generation_kwargs)
+            elif args.model_architecture in ["llava", "llava_next"]:
+                sampling_ans = sampling_llava(model, 
+                                        images, input_ids,
+                                        image_sizes=image_sizes, 
+                                        attention_mask=attention_mask, 
+                                        pad_token_id=tokenizer.pad_token_id,
+                                        processor=tokenizer,
+                                        **generation_kwargs)
+            elif args.model_architecture in ["llama-3.2-vision"]:
+                sampling_ans = sampling_llama(model, 
+                                        images, input_ids,
+                                        aspect_ratio_ids=aspect_ratio_ids,
+                                        aspect_ratio_mask=aspect_ratio_mask,
+                                        attention_mask=attention_mask, 
+                                        pad_token_id=tokenizer.pad_token_id,
+                                        processor=tokenizer,
+                                        **generation_kwargs)
+            else:
+                raise NotImplementedError("Not support newly added model architecture")
         
-        with open(args.output_path, "a") as trg:
-            for i in range(args.batch_size):       
-                id = str(batch['id'][0])
-                ref_image = reference_dict[id]['image'] if reference_dict[id]['image'] is not None else "None"
-
-                if 'label' in reference_dict[id].keys():
-                    ref_label = reference_dict[id]['label']
-                elif len(reference_dict[id]['conversations']) == 2:
-                    ref_label = reference_dict[id]['conversations'][1]['value'].replace("\n", "\\n")
-                else:
-                    ref_label = "None"
-
-                line = " ||| ".join([id, ref_image.strip(),
-                        tokenizer.decode(input_ids[i], skip_special_tokens=True, clean_up_tokenization_spaces=True).replace("\n", "\\n"), 
-                        sampling_ans[i][1].replace("\n", "\\n"), 
-                        ref_label.strip()]) + "\n"
-                print(line)
-                trg.write(line)
-                ref_count = ref_count + 1
-     
+        if len(adapter_names) > 0:
+            # (writer, sample row, answer row)
+            output_rows = [(writers[output_path], 0, i) for i, output_path in enumerate(output_paths)]
+        else:
+            output_rows = [(writers[args.output_path], i, i) for i in range(len(batch_indices))]
+        for writer, row, i in output_rows:
+            reference = annotations[batch_indices[row]][0]
+            ref_image = reference['image'] if reference['image'] is not None else "None"
+
+            if 'label' in reference.keys():
+                ref_label = reference['label']
+            elif len(reference['conversations']) == 2:
+                ref_label = reference['conversations'][1]['value']
+            else:
+                ref_label = "None"
+
+            record = {
+                "id": str(batch['id'][row]),
+                "image": ref_image.strip(),
+                "prompt": tokenizer.decode(input_ids[i], skip_special_tokens=True, clean_up_tokenization_spaces=True),
+                "prediction": sampling_ans[i][1],
+                "label": ref_label.strip()
+            }
+            print(record)
+            writer.write(batch_indices[row], json.dumps(record, ensure_ascii=False) + "\n")
+            ref_count = ref_count + 1
+
+    for writer in writers.values():
+        writer.close()
+
+    torch.distributed.barrier()
+    if args.global_rank == 0:
+        for output_path in output_paths:
+            num_records = merge_prediction_shards(output_path, data_ids, args.output_format)
+            print_rank_0(f"merge {num_records} predictions into {output_path}", args.global_rank)
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
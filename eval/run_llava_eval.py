@@ -15,7 +15,7 @@ from PIL import Image
 from io import BytesIO
 
 from training.utils.model import create_dsvl_model_and_transforms, build_model
-from training.ppo_training.ppo_training_utils import sampling, sampling_llava
+from training.ppo_training.ppo_training_utils import sampling, sampling_llava, speculative_sampling_llava
 
 def load_image(image_file):
     if image_file.startswith('http') or image_file.startswith('https'):
@@ -58,6 +58,16 @@ def eval_model(args):
 
     model.to('cuda')
 
+    draft_model = None
+    if args.draft_model_path is not None:
+        # a smaller llava with the same tokenizer and image processor, for speculative decoding
+        draft_model, *_ = build_model(text_tokenizer=tokenizer,
+                                      args=args_tmp,
+                                      ds_config=None,
+                                      from_checkpoint=args.draft_model_path,
+                                      enable_lora=False)
+        draft_model.to('cuda')
+
     print(tokenizer)
 
     test_path = args.test_path
@@ -113,12 +123,21 @@ def eval_model(args):
             #     use_cache=True,
             #     stopping_criteria=[stopping_criteria])
             input_ids[input_ids==-200]=32000
-            sampling_ans = sampling_llava(model, 
-                            image_tensor, input_ids, 
-                            attention_mask=attention_mask, 
-                            pad_token_id=tokenizer.pad_token_id,
-                            processor=tokenizer,
-                            **generation_kwargs)
+            if draft_model is not None:
+                sampling_ans = speculative_sampling_llava(model, draft_model,
+                                image_tensor, input_ids, 
+                                attention_mask=attention_mask, 
+                                pad_token_id=tokenizer.pad_token_id,
+                                processor=tokenizer,
+                                num_draft_tokens=args.num_draft_tokens,
+                                **generation_kwargs)
+            else:
+                sampling_ans = sampling_llava(model, 
+                                image_tensor, input_ids, 
+                                attention_mask=attention_mask, 
+                                pad_token_id=tokenizer.pad_token_id,
+                                processor=tokenizer,
+                                **generation_kwargs)
 
         # input_token_len = input_ids.shape[1]
         # n_diff_input_output = (input_ids != output_ids[:, :input_token_len]).sum().item()
@@ -147,5 +166,7 @@ if __name__ == "__main__":
     parser.add_argument("--output-path", type=str, required=True)
     parser.add_argument("--test-path", type=str, required=True)
     parser.add_argument("--conv-mode", type=str, default=None)
+    parser.add_argument("--draft-model-path", type=str, default=None)
+    parser.add_argument("--num-draft-tokens", type=int, default=4)
     args = parser.parse_args()
     eval_model(args)
\ No newline at end of file
@@ -0,0 +1,443 @@
+#!/usr/bin/env python
+
+# A local HTTP inference server for llava / llava_next checkpoints. The model is loaded once with build_model, the
+# image + prompt requests are queued and decoded in dynamic batches, and the answers can be streamed token by token.
+#
+#   POST /generate  {"prompt": ..., "image": path or "image_base64": ..., "max_new_tokens": ..., "temperature": ...,
+#                    "topk": ..., "topp": ..., "do_sample": ..., "stream": false}
+#   GET  /stats     throughput and latency stats
+#   GET  /health
+
+import argparse
+import base64
+import io
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)) + "/training")
+
+from training.ppo_training.ppo_training_utils import sample_next_token, StopSequenceChecker, truncate_at_stop_sequences
+from training.utils.data import DST
+from training.utils.model import build_model
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Serve a llava / llava_next model over HTTP with dynamic batching")
+    parser.add_argument('--from_checkpoint',
+                        type=str,
+                        required=True,
+                        help='Path to the model to serve.')
+    parser.add_argument('--model_architecture',
+                        type=str,
+                        choices=["llava", "llava_next"],
+                        default="llava")
+    parser.add_argument('--template',
+                        type=str,
+                        choices=["default", "llama_2", "llama_3", "vicuna", "llava", "llava_next"],
+                        default="llava",
+                        help='The prompt template (the one used in training).')
+    parser.add_argument('--host',
+                        type=str,
+                        default="127.0.0.1")
+    parser.add_argument('--port',
+                        type=int,
+                        default=8000)
+    parser.add_argument('--device',
+                        type=str,
+                        default=None,
+                        help='cuda or cpu (default: cuda if available).')
+    parser.add_argument('--precision',
+                        type=str,
+                        choices=["fp32", "fp16", "bf16"],
+                        default=None,
+                        help='Default: bf16 on cuda, fp32 on cpu.')
+    parser.add_argument('--max_batch_size',
+                        type=int,
+                        default=8,
+                        help='The largest number of requests decoded together.')
+    parser.add_argument('--max_batch_delay_ms',
+                        type=float,
+                        default=20.0,
+                        help='How long the oldest waiting request waits for others to join its batch.')
+    parser.add_argument('--max_new_tokens',
+                        type=int,
+                        default=512,
+                        help='The default (and largest) number of new tokens of a request.')
+    parser.add_argument('--max_prompt_len',
+                        type=int,
+                        default=768,
+                        help='The prompts are truncated to this many tokens.')
+    parser.add_argument('--template_stop_sequences',
+                        action='store_true',
+                        help='Also stop the answers at the end-of-turn markers of --template.')
+    parser.add_argument('--stats_window',
+                        type=int,
+                        default=1000,
+                        help='The number of recent requests in the latency percentiles.')
+    parser.set_defaults(lang_decoder_update=False)
+    args = parser.parse_args()
+
+    assert args.max_batch_size > 0, "--max_batch_size should be positive"
+    return args
+
+
+class InferenceRequest:
+    # a queued request: the encoded prompt and image, the sampling settings and the events streamed back to the client
+
+    def __init__(self, input_ids, pixel_values, image_sizes, max_new_tokens, sampling_kwargs):
+        self.input_ids = input_ids
+        self.pixel_values = pixel_values
+        self.image_sizes = image_sizes
+        self.max_new_tokens = max_new_tokens
+        self.sampling_kwargs = sampling_kwargs
+        self.events = queue.Queue()
+        self.tokens = []
+        self.streamed_text = ""
+        self.arrival_time = time.time()
+        self.start_time = None
+        self.first_token_time = None
+        self.finish_time = None
+
+
+class ServerStats:
+    # counters since the start and the latencies of the recent requests, updated by the batcher thread
+
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_batched_requests = 0
+        self.generated_tokens = 0
+        self.busy_time = 0.0
+        self.latencies = deque(maxlen=window)
+        self.queue_times = deque(maxlen=window)
+        self.first_token_times = deque(maxlen=window)
+
+    def record_batch(self, batch_size, num_tokens, seconds):
+        with self.lock:
+            self.num_batches += 1
+            self.num_batched_requests += batch_size
+            self.generated_tokens += num_tokens
+            self.busy_time += seconds
+
+    def record_request(self, request):
+        with self.lock:
+            self.num_requests += 1
+            self.latencies.append(request.finish_time - request.arrival_time)
+            self.queue_times.append(request.start_time - request.arrival_time)
+            if request.first_token_time is not None:
+                self.first_token_times.append(request.first_token_time - request.arrival_time)
+
+    @staticmethod
+    def percentiles(values):
+        if len(values) == 0:
+            return None
+        return {f"p{p}": float(np.percentile(values, p)) for p in [50, 90, 99]}
+
+    def summary(self):
+        with self.lock:
+            uptime = time.time() - self.start_time
+            return {
+                "uptime_s": uptime,
+                "num_requests": self.num_requests,
+                "num_batches": self.num_batches,
+                "mean_batch_size": self.num_batched_requests / max(self.num_batches, 1),
+                "generated_tokens": self.generated_tokens,
+                "tokens_per_s": self.generated_tokens / max(self.busy_time, 1e-6),
+                "requests_per_s": self.num_requests / max(uptime, 1e-6),
+                "busy_fraction": self.busy_time / max(uptime, 1e-6),
+                "latency_s": self.percentiles(self.latencies),
+                "queue_time_s": self.percentiles(self.queue_times),
+                "time_to_first_token_s": self.percentiles(self.first_token_times),
+            }
+
+
+class DynamicBatcher:
+    """
+    Decode the queued requests in batches on one background thread. A batch starts with the oldest waiting request
+    and takes the requests that arrive within `max_delay` seconds of it (up to `max_batch_size`), so that a request
+    waits at most `max_delay` for company. The prompts of a batch are left-padded and decoded together with one kv
+    cache, each request samples with its own settings and stops on its own. The text of a request is streamed to its
+    event queue as ("token", text) events, followed by ("done", result) or ("error", message).
+    """
+
+    def __init__(self, model, tokenizer, device, max_batch_size=8, max_delay=0.02, stop_sequences=None, stats=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.stop_sequences = stop_sequences
+        self.stop_checker = StopSequenceChecker(stop_sequences, tokenizer)
+        # the text that could be the start of a stop sequence is held back until the request finishes
+        self.holdback = max([len(stop) for stop in (stop_sequences or [])] + [1]) - 1
+        self.stats = stats if stats is not None else ServerStats()
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def submit(self, request):
+        self.requests.put(request)
+
+    def next_batch(self):
+        batch = [self.requests.get()]
+        deadline = batch[0].arrival_time + self.max_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            try:
+                batch.append(self.requests.get(timeout=timeout) if timeout > 0 else self.requests.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            start_time = time.time()
+            try:
+                self.generate(batch)
+            except Exception as e:
+                for request in batch:
+                    if request.finish_time is None:
+                        request.events.put(("error", f"{type(e).__name__}: {e}"))
+                continue
+            self.stats.record_batch(len(batch), sum(len(request.tokens) for request in batch), time.time() - start_time)
+
+    def stream(self, request, finished=False):
+        text = self.tokenizer.decode(request.tokens, skip_special_tokens=True)
+        if finished:
+            text = truncate_at_stop_sequences(text, self.stop_sequences)
+            end = len(text)
+        else:
+            end = len(text) - self.holdback
+            if text.endswith("�"):
+                # an incomplete multi-byte character
+                end = min(end, len(text) - 1)
+        if end > len(request.streamed_text):
+            request.events.put(("token", text[len(request.streamed_text):end]))
+            request.streamed_text = text[:end]
+        return text
+
+    def finish(self, request):
+        text = self.stream(request, finished=True)
+        request.finish_time = time.time()
+        self.stats.record_request(request)
+        request.events.put(("done", {
+            "text": text,
+            "num_prompt_tokens": len(request.input_ids),
+            "num_tokens": len(request.tokens),
+            "queue_time_s": request.start_time - request.arrival_time,
+            "latency_s": request.finish_time - request.arrival_time,
+        }))
+
+    @torch.no_grad()
+    def generate(self, batch):
+        start_time = time.time()
+        for request in batch:
+            request.start_time = start_time
+        pad_token_id = self.tokenizer.pad_token_id
+        eos_token_id = self.tokenizer.eos_token_id
+
+        # 1. left-pad the prompts, the anyres patches of llava-next are zero-padded (dropped by image_sizes)
+        max_len = max(len(request.input_ids) for request in batch)
+        input_ids = torch.full((len(batch), max_len), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(batch), max_len), dtype=torch.long)
+        for row, request in enumerate(batch):
+            input_ids[row, max_len - len(request.input_ids):] = torch.tensor(request.input_ids, dtype=torch.long)
+            attention_mask[row, max_len - len(request.input_ids):] = 1
+        pixel_values = [request.pixel_values for request in batch]
+        if pixel_values[0].dim() == 5:
+            num_patches = max(image.size(1) for image in pixel_values)
+            pixel_values = [torch.nn.functional.pad(image, (0, 0, 0, 0, 0, 0, 0, num_patches - image.size(1)), "constant", 0)
+                            for image in pixel_values]
+        inputs = dict(input_ids=input_ids.to(self.device),
+                      attention_mask=attention_mask.to(self.device),
+                      pixel_values=torch.cat(pixel_values, dim=0).to(self.device, dtype=self.model.dtype),
+                      use_cache=True,
+                      return_dict=True)
+        if batch[0].image_sizes is not None:
+            inputs.update(image_sizes=torch.cat([request.image_sizes for request in batch], dim=0).to(self.device))
+
+        # 2. prefill, then decode the batch until every request is finished
+        outputs = self.model(**inputs)
+        past_key_values = outputs.past_key_values
+        batch_attention_mask = outputs.attention_mask
+        next_logits = outputs.logits[:, -1, :]
+        finished = [False] * len(batch)
+        while True:
+            next_tokens = []
+            for row, request in enumerate(batch):
+                if finished[row]:
+                    next_tokens.append(pad_token_id)
+                    continue
+                token = sample_next_token(next_logits[row:row + 1], **request.sampling_kwargs).item()
+                next_tokens.append(token)
+                request.tokens.append(token)
+                if request.first_token_time is None:
+                    request.first_token_time = time.time()
+                if token == eos_token_id or len(request.tokens) >= request.max_new_tokens or self.stop_checker(request.tokens):
+                    finished[row] = True
+                    self.finish(request)
+                else:
+                    self.stream(request)
+            if all(finished):
+                break
+            batch_attention_mask = torch.cat([batch_attention_mask, torch.ones_like(batch_attention_mask[:, :1])], dim=-1)
+            outputs = self.model(input_ids=torch.tensor(next_tokens, dtype=torch.long, device=self.device)[:, None],
+                                 attention_mask=batch_attention_mask,
+                                 position_ids=batch_attention_mask.long().sum(-1, keepdim=True) - 1,
+                                 past_key_values=past_key_values,
+                                 use_cache=True,
+                                 return_dict=True)
+            past_key_values = outputs.past_key_values
+            next_logits = outputs.logits[:, -1, :]
+
+
+class InferenceServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, args, model, image_processor, tokenizer, batcher):
+        super().__init__(address, InferenceHandler)
+        self.args = args
+        self.model = model
+        self.image_processor = image_processor
+        self.tokenizer = tokenizer
+        self.batcher = batcher
+        self.prompter = DST.Prompter()
+
+    def encode_request(self, payload):
+        # the prompt and image are encoded as in LlavaPredictDataset, on the handler thread of the request
+        if "prompt" not in payload:
+            raise ValueError("the request has no prompt")
+        if "image_base64" in payload:
+            image = Image.open(io.BytesIO(base64.b64decode(payload["image_base64"]))).convert("RGB")
+        elif "image" in payload:
+            image = Image.open(payload["image"]).convert("RGB")
+        else:
+            raise ValueError("the request has no image (image or image_base64)")
+
+        question = payload["prompt"].replace("<image>", "").strip("\n")
+        instruction = self.prompter(question, with_image=True, first_message=True, template=self.args.template)
+        input_ids = self.tokenizer(instruction, return_tensors=None, padding="do_not_pad", truncation=True,
+                                   max_length=self.args.max_prompt_len)["input_ids"]
+        if input_ids[-1] == self.tokenizer.eos_token_id:
+            input_ids = input_ids[:-1]
+
+        image_outputs = self.image_processor(image, return_tensors="pt")
+        image_sizes = image_outputs["image_sizes"] if self.args.model_architecture == "llava_next" else None
+
+        max_new_tokens = min(int(payload.get("max_new_tokens", self.args.max_new_tokens)), self.args.max_new_tokens)
+        temperature = float(payload.get("temperature", 0.75))
+        sampling_kwargs = dict(topk=int(payload.get("topk", 50)),
+                               topp=float(payload.get("topp", 0.95)),
+                               do_sample=bool(payload.get("do_sample", temperature > 0.0)),
+                               temperature=temperature if temperature > 0.0 else 1.0)
+        return InferenceRequest(input_ids, image_outputs["pixel_values"], image_sizes, max(max_new_tokens, 1), sampling_kwargs)
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self.send_json(200, self.server.batcher.stats.summary())
+        elif self.path == "/health":
+            self.send_json(200, {"status": "ok"})
+        else:
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/generate":
+            self.send_json(404, {"error": f"unknown path {self.path}"})
+            return
+        try:
+            payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            request = self.server.encode_request(payload)
+        except Exception as e:
+            self.send_json(400, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self.server.batcher.submit(request)
+
+        if not payload.get("stream", False):
+            while True:
+                event, data = request.events.get()
+                if event == "done":
+                    self.send_json(200, data)
+                    return
+                if event == "error":
+                    self.send_json(500, {"error": data})
+                    return
+
+        # one JSON object per line: {"token": ...} while decoding, then the result with "finished": true
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        while True:
+            event, data = request.events.get()
+            if event == "token":
+                line = {"token": data}
+            elif event == "done":
+                line = dict(data, finished=True)
+            else:
+                line = {"error": data, "finished": True}
+            try:
+                self.wfile.write((json.dumps(line) + "\n").encode("utf-8"))
+                self.wfile.flush()
+            except (BrokenPipeError, ConnectionResetError):
+                # the client is gone, the request is still decoded with its batch
+                return
+            if event != "token":
+                return
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    precision = args.precision if args.precision is not None else ("bf16" if device.type == "cuda" else "fp32")
+    dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[precision]
+
+    print("load model............")
+    model, image_processor, tokenizer = build_model(args=args, enable_lora=False)
+    model = model.to(device, dtype=dtype)
+    model.eval()
+
+    stop_sequences = DST.get_stop_sequences(args.template) if args.template_stop_sequences else None
+    batcher = DynamicBatcher(model, tokenizer, device,
+                             max_batch_size=args.max_batch_size,
+                             max_delay=args.max_batch_delay_ms / 1000.0,
+                             stop_sequences=stop_sequences,
+                             stats=ServerStats(args.stats_window))
+    batcher.start()
+
+    server = InferenceServer((args.host, args.port), args, model, image_processor, tokenizer, batcher)
+    print(f"serving {args.from_checkpoint} on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -63,6 +63,7 @@ nohup deepspeed --include localhost:$DEVICE --master_port $((12345 + DEVICE)) ./
     --batch_size ${BATCH_SIZE} \
     --image_folder ${IMAGE_FOLDER} \
     --output_path ${OUTPUT} \
+    --output_format text \
     --do_sample \
     --topk ${TOPK} \
     --topp ${TOPP} \
@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir))
+# the training scripts import their siblings by name (as when they are run from their folders) and the repository
+# modules as `training.*`
+for path in ["", "training", os.path.join("training", "ppo_training"), "eval"]:
+    sys.path.insert(0, os.path.join(ROOT, path))
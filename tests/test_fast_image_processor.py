@@ -0,0 +1,94 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+np = pytest.importorskip("numpy")
+pytest.importorskip("deepspeed")
+from PIL import Image
+
+from utils.data.fast_image_processor import TorchImageProcessor, PendingImage, process_pending_images
+
+# (height, width): square, wide, tall, and sizes that pick different anyres grids
+IMAGE_SIZES = [(40, 40), (30, 70), (90, 25), (64, 48), (33, 100), (100, 61)]
+GRID_PINPOINTS = [[32, 64], [64, 32], [64, 64], [32, 96], [96, 32]]
+# the torch bicubic resize (with antialias) differs from the PIL one by rounding: at most 4 levels of 255 per pixel
+# and 0.5 level on average, measured after undoing rescale / normalize
+MAX_LEVEL_DIFF = 4.0
+MEAN_LEVEL_DIFF = 0.5
+
+
+def make_image(height, width, seed):
+    # a smooth image (a random 6x6 image upsampled) with a little noise
+    rng = np.random.default_rng(seed)
+    coarse = Image.fromarray(rng.integers(0, 256, (6, 6, 3), dtype=np.uint8)).resize((width, height), Image.BILINEAR)
+    noisy = np.asarray(coarse, dtype=np.int16) + rng.integers(-8, 9, (height, width, 3))
+    return Image.fromarray(noisy.clip(0, 255).astype(np.uint8))
+
+
+def to_levels(pixel_values, processor):
+    mean = torch.tensor(processor.image_mean, dtype=torch.float64).view(-1, 1, 1)
+    std = torch.tensor(processor.image_std, dtype=torch.float64).view(-1, 1, 1)
+    return (torch.as_tensor(np.asarray(pixel_values), dtype=torch.float64) * std + mean) / processor.rescale_factor
+
+
+def assert_close_pixels(pixel_values, expected, processor):
+    assert tuple(pixel_values.shape) == tuple(expected.shape)
+    diff = (to_levels(pixel_values, processor) - to_levels(expected, processor)).abs()
+    assert diff.max().item() <= MAX_LEVEL_DIFF
+    assert diff.mean().item() <= MEAN_LEVEL_DIFF
+
+
+def clip_processor():
+    return transformers.CLIPImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32})
+
+
+def llava_next_processor():
+    return transformers.LlavaNextImageProcessor(size={"shortest_edge": 32}, crop_size={"height": 32, "width": 32},
+                                                image_grid_pinpoints=GRID_PINPOINTS)
+
+
+@pytest.mark.parametrize("image_size", IMAGE_SIZES)
+def test_clip_parity(image_size):
+    hf_processor = clip_processor()
+    image = make_image(*image_size, seed=sum(image_size))
+    expected = hf_processor(image, return_tensors="np")["pixel_values"][0]
+    pixel_values = TorchImageProcessor(hf_processor)(image)["pixel_values"][0]
+    assert_close_pixels(pixel_values, expected, hf_processor)
+
+
+@pytest.mark.parametrize("image_size", IMAGE_SIZES)
+def test_llava_next_anyres_parity(image_size):
+    hf_processor = llava_next_processor()
+    image = make_image(*image_size, seed=sum(image_size))
+    expected = hf_processor(image, return_tensors="np")
+    outputs = TorchImageProcessor(hf_processor)(image)
+    assert [list(sizes) for sizes in expected["image_sizes"]] == outputs["image_sizes"]
+    # the base image and one tile per cell of the selected grid
+    assert_close_pixels(outputs["pixel_values"][0], expected["pixel_values"][0], hf_processor)
+
+
+def test_the_anyres_grids_differ():
+    # the sizes above cover several grids, not only one
+    hf_processor = llava_next_processor()
+    num_tiles = {len(TorchImageProcessor(hf_processor)(make_image(*size, seed=0))["pixel_values"][0])
+                 for size in IMAGE_SIZES}
+    assert len(num_tiles) >= 3
+
+
+@pytest.mark.parametrize("make_processor", [clip_processor, llava_next_processor])
+def test_batched_pending_images_match_single_calls(make_processor):
+    processor = TorchImageProcessor(make_processor())
+    images = [make_image(*size, seed=i) for i, size in enumerate(IMAGE_SIZES)]
+    pending = [PendingImage(processor, image) for image in images]
+    # a batch of samples as the datasets return them, the candidates of a query share one image
+    data = [[{"image": [pending[0]], "id": 0}, {"image": [pending[0]], "id": 1}]] + \
+        [{"image": [image], "image_sizes": [image.image_sizes]} for image in pending[1:]]
+
+    data = process_pending_images(data)
+
+    assert data[0][0]["image"][0] is data[0][1]["image"][0]
+    processed = [data[0][0]["image"][0]] + [sample["image"][0] for sample in data[1:]]
+    for pixel_values, image in zip(processed, images):
+        torch.testing.assert_close(pixel_values, processor(image)["pixel_values"][0], rtol=0, atol=1e-6)
+    for sample, image in zip(data[1:], images[1:]):
+        assert sample["image_sizes"] == [[image.height, image.width]]
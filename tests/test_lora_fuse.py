@@ -0,0 +1,57 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("deepspeed")
+
+from utils.module.lora import LinearLayer_LoRA, fuse_lora, unfuse_lora
+
+NUM_CYCLES = 20
+
+
+def build_lora_layer(dtype, seed=0, rows=96, columns=64, lora_dim=4):
+    torch.manual_seed(seed)
+    linear = torch.nn.Linear(columns, rows, bias=True)
+    layer = LinearLayer_LoRA(linear.weight, lora_dim=lora_dim, lora_scaling=8, bias=linear.bias)
+    # a trained adapter (the left weight is zero-initialized), its update is about 1% of the weight
+    torch.nn.init.normal_(layer.lora_left_weight, std=0.005)
+    return torch.nn.Sequential(layer).to(dtype), layer
+
+
+@pytest.mark.parametrize("dtype", [torch.bfloat16, torch.float16, torch.float32])
+def test_repeated_fuse_unfuse_does_not_drift(dtype):
+    model, layer = build_lora_layer(dtype)
+    original_weight = layer.weight.data.clone()
+    inputs = torch.randn(5, layer.weight.size(1)).to(dtype)
+    with torch.no_grad():
+        lora_outputs = layer(inputs).float()
+
+    # the fp32 delta alone does not restore every value in half precision, the residual does
+    delta = layer.get_lora_delta()
+    naive_weight = ((layer.weight.data.float() + delta).to(dtype).float() - delta).to(dtype)
+    if dtype != torch.float32:
+        assert not torch.equal(naive_weight, original_weight)
+
+    for _ in range(NUM_CYCLES):
+        fuse_lora(model)
+        assert layer.fuse_lora
+        drift_index, _, _ = layer.lora_fuse_residual
+        # only the few values that do not round-trip are kept, not a copy of the weight
+        assert drift_index.numel() <= 0.05 * layer.weight.numel()
+        with torch.no_grad():
+            fused_outputs = layer(inputs).float()
+        torch.testing.assert_close(fused_outputs, lora_outputs, rtol=0.02, atol=0.02)
+
+        unfuse_lora(model)
+        assert not layer.fuse_lora
+        assert layer.lora_fuse_residual is None
+        # bit-exact after every cycle: the drift of the base weight is zero
+        assert torch.equal(layer.weight.data, original_weight)
+
+
+def test_unfuse_after_the_lora_weights_change_is_rejected():
+    model, layer = build_lora_layer(torch.bfloat16)
+    fuse_lora(model)
+    with torch.no_grad():
+        layer.lora_left_weight.add_(1.0)
+    with pytest.raises(AssertionError):
+        unfuse_lora(model)
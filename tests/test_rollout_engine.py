@@ -0,0 +1,106 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("deepspeed")
+
+from tiny_models import ToyTokenizer, build_tiny_llava, set_eos_token, make_batch, PAD_TOKEN_ID
+from ppo_training_utils import sampling_llava
+from rollout_engine import RolloutEngine
+
+MAX_NEW_TOKENS = 10
+# prefill lengths 8, 10, 9 and 12 (the image token becomes 4 tokens): full and partly filled last pages of 4 tokens
+PROMPT_LENS = [5, 7, 6, 9]
+
+
+def reference_responses(model, tokenizer, images, lang, attention_mask):
+    outputs = sampling_llava(model, images, lang,
+                             attention_mask=attention_mask,
+                             pad_token_id=PAD_TOKEN_ID,
+                             do_sample=False,
+                             max_new_tokens=MAX_NEW_TOKENS,
+                             processor=tokenizer,
+                             return_logprobs=True)
+    model.eval()
+    return outputs
+
+
+def setup(group_size):
+    model = build_tiny_llava()
+    tokenizer = ToyTokenizer()
+    images, lang, attention_mask = make_batch(PROMPT_LENS)
+    # an eos token that the greedy responses sample partway, so that they end at different steps
+    first = reference_responses(model, tokenizer, images, lang, attention_mask)
+    set_eos_token(model, tokenizer, first[0][0][3].item())
+    if group_size > 1:
+        images, lang, attention_mask = (t.repeat_interleave(group_size, dim=0) for t in (images, lang, attention_mask))
+    return model, tokenizer, images, lang, attention_mask
+
+
+def build_engine(model, tokenizer, **kwargs):
+    return RolloutEngine(model, tokenizer,
+                         pad_token_id=PAD_TOKEN_ID,
+                         max_new_tokens=MAX_NEW_TOKENS,
+                         do_sample=False,
+                         **kwargs)
+
+
+def assert_same_responses(outputs, expected):
+    assert len(outputs) == len(expected)
+    for (res, res_text, logprobs), (expected_res, expected_text, expected_logprobs) in zip(outputs, expected):
+        assert res.tolist() == expected_res.tolist()
+        assert res_text == expected_text
+        torch.testing.assert_close(logprobs.double(), expected_logprobs.double(), rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("group_size", [1, 2])
+def test_rollout_engine_matches_sampling_llava(group_size):
+    model, tokenizer, images, lang, attention_mask = setup(group_size)
+    expected = reference_responses(model, tokenizer, images, lang, attention_mask)
+    assert len(set(len(res) for res, _, _ in expected)) > 1, "the responses should end at different steps"
+
+    engine = build_engine(model, tokenizer, max_batch_size=4, page_size=4)
+    forks, shared_writes = [], []
+    fork, append = engine.cache.fork, engine.cache.append
+
+    def recording_fork(seq_id, new_seq_id):
+        forks.append(new_seq_id)
+        fork(seq_id, new_seq_id)
+
+    def recording_append(seq_ids, keys, values):
+        cache = engine.cache
+        shared_writes.extend(seq_id for seq_id in seq_ids
+                             if cache.seq_lens[seq_id] % cache.page_size != 0
+                             and cache.page_refs[cache.page_tables[seq_id][-1]] > 1)
+        append(seq_ids, keys, values)
+
+    engine.cache.fork, engine.cache.append = recording_fork, recording_append
+    outputs = engine.generate(images, lang, attention_mask, group_size=group_size, return_logprobs=True)
+
+    assert_same_responses(outputs, expected)
+    if group_size > 1:
+        # the group shares the prompt pages, the partly filled last page is copied on the first write
+        assert len(forks) == len(PROMPT_LENS)
+        assert len(shared_writes) > 0
+    assert not engine.cache.allocated
+
+
+@pytest.mark.parametrize("group_size", [1, 2])
+def test_rollout_engine_preemption(group_size):
+    model, tokenizer, images, lang, attention_mask = setup(group_size)
+    expected = reference_responses(model, tokenizer, images, lang, attention_mask)
+
+    # 7 pages of 4 tokens hold one full response (at most 6 pages), not all of them
+    engine = build_engine(model, tokenizer, max_batch_size=4, page_size=4, num_pages=7)
+    preempted = []
+    preempt = engine._preempt
+
+    def recording_preempt(running, waiting):
+        preempted.append(running[-1].row)
+        preempt(running, waiting)
+
+    engine._preempt = recording_preempt
+    outputs = engine.generate(images, lang, attention_mask, group_size=group_size, return_logprobs=True)
+
+    assert len(preempted) > 0
+    assert_same_responses(outputs, expected)
@@ -0,0 +1,140 @@
+import argparse
+import json
+import threading
+import time
+import urllib.request
+import zlib
+
+import pytest
+
+torch = pytest.importorskip("torch")
+transformers = pytest.importorskip("transformers")
+np = pytest.importorskip("numpy")
+pytest.importorskip("deepspeed")
+from PIL import Image
+
+from tiny_models import ToyTokenizer, build_tiny_llava, BOS_TOKEN_ID, IMAGE_TOKEN_ID, IMAGE_SIZE
+from serve import DynamicBatcher, InferenceServer, ServerStats
+
+# the prompts, with different lengths and answer lengths, so that the batched requests are padded and stop apart
+REQUESTS = [
+    ("what is in the image?", 6),
+    ("describe the picture in a few words please", 4),
+    ("how many", 8),
+    ("is there a dog or a cat next to the red car on the left?", 5),
+]
+
+
+class PromptTokenizer(ToyTokenizer):
+    # encodes the chat prompts of the server: <bos>, the image token, and one token per word
+
+    def __call__(self, text, return_tensors=None, padding="do_not_pad", truncation=False, max_length=None):
+        input_ids = [BOS_TOKEN_ID] + [IMAGE_TOKEN_ID if word == "<image>" else 3 + zlib.crc32(word.encode()) % 94
+                                      for word in text.split()]
+        if truncation and max_length is not None:
+            input_ids = input_ids[:max_length]
+        return {"input_ids": input_ids}
+
+
+def make_image(seed):
+    rng = np.random.default_rng(seed)
+    return Image.fromarray(rng.integers(0, 256, (IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8))
+
+
+@pytest.fixture(scope="module")
+def model():
+    return build_tiny_llava(seed=0)
+
+
+@pytest.fixture
+def start_server(model, tmp_path):
+    servers = []
+
+    def start(max_batch_size, max_delay):
+        args = argparse.Namespace(template="llava", model_architecture="llava", max_prompt_len=128, max_new_tokens=8)
+        image_processor = transformers.CLIPImageProcessor(size={"shortest_edge": IMAGE_SIZE},
+                                                          crop_size={"height": IMAGE_SIZE, "width": IMAGE_SIZE})
+        tokenizer = PromptTokenizer()
+        batcher = DynamicBatcher(model, tokenizer, torch.device("cpu"), max_batch_size=max_batch_size,
+                                 max_delay=max_delay, stats=ServerStats())
+        batcher.start()
+        server = InferenceServer(("127.0.0.1", 0), args, model, image_processor, tokenizer, batcher)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}"
+
+    for i in range(len(REQUESTS)):
+        make_image(i).save(tmp_path / f"{i}.png")
+    start.image_dir = tmp_path
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=60) as response:
+        return json.loads(response.read())
+
+
+def post(url, payload):
+    request = urllib.request.Request(url + "/generate", data=json.dumps(payload).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=60) as response:
+        if not payload.get("stream", False):
+            return json.loads(response.read())
+        lines = [json.loads(line) for line in response.read().decode("utf-8").splitlines() if line.strip()]
+    # the tokens are streamed as they are decoded, the last line holds the result
+    assert all("token" in line for line in lines[:-1])
+    assert lines[-1]["finished"]
+    assert "".join(line["token"] for line in lines[:-1]) == lines[-1]["text"]
+    return lines[-1]
+
+
+def make_payload(image_dir, i, stream):
+    prompt, max_new_tokens = REQUESTS[i]
+    return {"prompt": prompt, "image": str(image_dir / f"{i}.png"), "max_new_tokens": max_new_tokens,
+            "temperature": 0.0, "stream": stream}
+
+
+def test_batched_requests_match_single_requests(start_server):
+    image_dir = start_server.image_dir
+    # one request at a time: every batch holds a single request
+    single_url = start_server(max_batch_size=1, max_delay=0.0)
+    expected = [post(single_url, make_payload(image_dir, i, stream=False)) for i in range(len(REQUESTS))]
+    assert [result["num_tokens"] for result in expected] == [max_new_tokens for _, max_new_tokens in REQUESTS]
+
+    # concurrent requests, half of them streamed, wait for each other in one batch
+    url = start_server(max_batch_size=len(REQUESTS), max_delay=2.0)
+    assert get(url + "/health") == {"status": "ok"}
+    assert get(url + "/stats")["num_requests"] == 0
+    results = [None] * len(REQUESTS)
+    barrier = threading.Barrier(len(REQUESTS))
+
+    def client(i):
+        barrier.wait()
+        results[i] = post(url, make_payload(image_dir, i, stream=i % 2 == 1))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(len(REQUESTS))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=120)
+
+    for result, expected_result in zip(results, expected):
+        assert result is not None
+        assert result["text"] == expected_result["text"]
+        assert result["num_tokens"] == expected_result["num_tokens"]
+        assert result["num_prompt_tokens"] == expected_result["num_prompt_tokens"]
+
+    # the batch is recorded after its last request is answered
+    deadline = time.time() + 10
+    stats = get(url + "/stats")
+    while stats["generated_tokens"] < sum(max_new_tokens for _, max_new_tokens in REQUESTS) and time.time() < deadline:
+        time.sleep(0.05)
+        stats = get(url + "/stats")
+    assert stats["num_requests"] == len(REQUESTS)
+    assert stats["num_batches"] < len(REQUESTS)
+    assert stats["mean_batch_size"] > 1
+    assert stats["generated_tokens"] == sum(max_new_tokens for _, max_new_tokens in REQUESTS)
+    assert stats["latency_s"] is not None
@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("transformers")
+pytest.importorskip("deepspeed")
+
+from tiny_models import ToyTokenizer, build_tiny_llava, set_eos_token, make_batch, PAD_TOKEN_ID
+from ppo_training_utils import sampling_llava, speculative_sampling_llava, next_token_probs
+
+MAX_NEW_TOKENS = 12
+
+
+@pytest.mark.parametrize("draft_seed", [0, 1])
+@pytest.mark.parametrize("num_draft_tokens", [1, 4])
+def test_speculative_sampling_greedy_matches_sampling_llava(draft_seed, num_draft_tokens):
+    # draft_seed 0: the draft is the actor (every proposal is accepted), 1: a smaller random draft (rejections)
+    actor = build_tiny_llava(seed=0)
+    draft = build_tiny_llava(seed=draft_seed) if draft_seed == 0 else build_tiny_llava(seed=draft_seed, num_hidden_layers=1)
+    tokenizer = ToyTokenizer()
+    images, lang, attention_mask = make_batch([5, 7, 6, 9])
+    kwargs = dict(attention_mask=attention_mask, pad_token_id=PAD_TOKEN_ID, do_sample=False,
+                  max_new_tokens=MAX_NEW_TOKENS, processor=tokenizer, return_logprobs=True)
+    first = sampling_llava(actor, images, lang, **kwargs)
+    set_eos_token(actor, tokenizer, first[0][0][4].item())
+
+    expected = sampling_llava(actor, images, lang, **kwargs)
+    outputs = speculative_sampling_llava(actor, draft, images, lang, num_draft_tokens=num_draft_tokens, **kwargs)
+
+    assert len(outputs) == len(expected)
+    for (res, res_text, logprobs), (expected_res, expected_text, expected_logprobs) in zip(outputs, expected):
+        assert res.tolist() == expected_res.tolist()
+        assert res_text == expected_text
+        torch.testing.assert_close(logprobs.double(), expected_logprobs.double(), rtol=0, atol=1e-6)
+
+
+def test_speculative_sampling_follows_the_actor_distribution():
+    # with two new tokens the draft proposes one, the first response token goes through the accept / resample step
+    sampling_kwargs = dict(topk=5, topp=1.0, temperature=1.0)
+    num_samples = 3000
+    actor = build_tiny_llava(seed=0)
+    draft = build_tiny_llava(seed=1, num_hidden_layers=1)
+    tokenizer = ToyTokenizer()
+    images, lang, attention_mask = make_batch([7])
+
+    with torch.no_grad():
+        actor_probs = next_token_probs(actor(input_ids=lang, pixel_values=images, attention_mask=attention_mask).logits[:, -1],
+                                       **sampling_kwargs)[0]
+        draft_probs = next_token_probs(draft(input_ids=lang, pixel_values=images, attention_mask=attention_mask).logits[:, -1],
+                                       **sampling_kwargs)[0]
+    # the draft should be rejected often enough for the residual resampling to matter
+    assert 0.5 * (actor_probs - draft_probs).abs().sum().item() > 0.2
+
+    torch.manual_seed(0)
+    outputs = speculative_sampling_llava(actor, draft,
+                                         images.expand(num_samples, -1, -1, -1),
+                                         lang.expand(num_samples, -1),
+                                         attention_mask=attention_mask.expand(num_samples, -1),
+                                         pad_token_id=PAD_TOKEN_ID,
+                                         do_sample=True,
+                                         max_new_tokens=2,
+                                         processor=tokenizer,
+                                         num_draft_tokens=1,
+                                         **sampling_kwargs)
+    first_tokens = torch.tensor([res[0].item() for res, _ in outputs])
+    frequencies = torch.bincount(first_tokens, minlength=actor_probs.numel()).double() / num_samples
+
+    # the total variation distance of 3000 samples over the 5 tokens of top-k stays well below 0.05
+    assert 0.5 * (frequencies - actor_probs).abs().sum().item() < 0.05
+    assert (frequencies[actor_probs == 0] == 0).all()
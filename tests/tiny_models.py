@@ -0,0 +1,68 @@
+# tiny random models and a toy tokenizer for the CPU tests, float64 so that greedy decoding does not flip on ties
+
+import torch
+from transformers import LlavaConfig
+
+from utils.model.third_party_model.hf_model.modeling_llava import LlavaForConditionalGeneration
+
+PAD_TOKEN_ID = 0
+BOS_TOKEN_ID = 1
+IMAGE_TOKEN_ID = 98
+VOCAB_SIZE = 100
+IMAGE_SIZE = 30
+NUM_IMAGE_TOKENS = 4   # (30 / 15) ** 2 patches, the cls token is dropped
+
+
+class ToyTokenizer:
+    # token i is the word "t<i>"
+
+    def __init__(self, eos_token_id=None, pad_token_id=PAD_TOKEN_ID):
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+
+    def encode(self, text, add_special_tokens=True):
+        return [int(word[1:]) for word in text.split()]
+
+    def decode(self, ids, skip_special_tokens=False):
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist()
+        special = {self.eos_token_id, self.pad_token_id, BOS_TOKEN_ID}
+        return " ".join(f"t{i}" for i in ids if not (skip_special_tokens and i in special))
+
+
+def build_tiny_llava(seed=0, hidden_size=32, num_hidden_layers=2):
+    config = LlavaConfig(
+        vision_config=dict(model_type="clip_vision_model", hidden_size=32, intermediate_size=37, num_hidden_layers=2,
+                           num_attention_heads=4, image_size=IMAGE_SIZE, patch_size=15, projection_dim=32),
+        text_config=dict(model_type="llama", vocab_size=VOCAB_SIZE, hidden_size=hidden_size, intermediate_size=37,
+                         num_hidden_layers=num_hidden_layers, num_attention_heads=4, num_key_value_heads=2,
+                         max_position_embeddings=256, initializer_range=0.5),
+        image_token_index=IMAGE_TOKEN_ID,
+        pad_token_id=PAD_TOKEN_ID,
+        vision_feature_layer=-1,
+        vision_feature_select_strategy="default")
+    config._attn_implementation = "eager"
+    torch.manual_seed(seed)
+    model = LlavaForConditionalGeneration(config).to(torch.float64).eval()
+    model.generation_config.pad_token_id = PAD_TOKEN_ID
+    model.generation_config.eos_token_id = None
+    return model
+
+
+def set_eos_token(model, tokenizer, eos_token_id):
+    model.generation_config.eos_token_id = eos_token_id
+    tokenizer.eos_token_id = eos_token_id
+
+
+def make_batch(prompt_lens, seed=0):
+    # left-padded prompts "<bos> <image> text..." of the given lengths, one image each
+    generator = torch.Generator().manual_seed(seed)
+    max_len = max(prompt_lens)
+    lang = torch.full((len(prompt_lens), max_len), PAD_TOKEN_ID, dtype=torch.long)
+    attention_mask = torch.zeros_like(lang)
+    for row, prompt_len in enumerate(prompt_lens):
+        text = torch.randint(3, IMAGE_TOKEN_ID - 1, (prompt_len - 2,), generator=generator)
+        lang[row, max_len - prompt_len:] = torch.cat([torch.tensor([BOS_TOKEN_ID, IMAGE_TOKEN_ID]), text])
+        attention_mask[row, max_len - prompt_len:] = 1
+    images = torch.randn(len(prompt_lens), 3, IMAGE_SIZE, IMAGE_SIZE, generator=generator, dtype=torch.float64)
+    return images, lang, attention_mask
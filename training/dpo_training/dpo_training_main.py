@@ -29,7 +29,10 @@ from utils.data import build_dataset, DataCollatorPadToMaxLenForRewardModel, spl
 from utils.utils import print_rank_0, to_device, save_hf_format, set_random_seed, get_all_reduce_mean, get_optimizer_grouped_parameters, save_zero_three_model
 from utils.ds_utils import get_train_ds_config
 
+from utils.module.lora import merge_lora_state_dict, save_lora_adapter
 from utils.model import build_model
+from utils.model.vision_feature import get_mllama_cross_attention_states, broadcast_images
+from dpo_training_utils import prefix_shared_forward, RefLogpsTable
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -226,6 +229,27 @@ def parse_args():
                         type=str,
                         choices=["default", "llama_2", "llama_3", "llama_3", 
                                 "vicuna", "llava", "llava_next", "llama-3.2-vision"],)
+    parser.add_argument('--share_prompt_prefix',
+                        action='store_true',
+                        help='Run the shared image and prompt of the candidates once and continue each candidate '
+                        'from its kv cache (llava and llava_next only). The policy model only shares the prefix '
+                        'when gradient checkpointing is disabled.')
+    parser.add_argument('--ref_logps_path',
+                        type=str,
+                        default=None,
+                        help='The reference log-probs precomputed by precompute_ref_logps.py. If provided, the reference '
+                        'model is not built and its log-probs are read from this file.')
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
 
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
@@ -301,6 +325,9 @@ def main():
         vis_processor=image_processor,
         tokenizer=tokenizer,
         template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor,
         max_ranked_candidate_num=args.ranked_candidate_num        
     )
 
@@ -363,32 +390,39 @@ def main():
         model.gradient_checkpointing_enable()
     
     # ref model prepare
-    ds_ref_config_load = get_train_ds_config(
-        offload=args.offload,
-        args=args,
-        stage=2 
-    )
-
-    ref_model , _, _ = build_model(
-        text_tokenizer=tokenizer_origin,
-        args=args,
-        ds_config=ds_ref_config_load
-    )
-
-    print_rank_0("load ref model............")
-    if args.model_architecture == 'default':
-        ref_model.load_state_dict(torch.load(os.path.join(args.from_checkpoint, 'pytorch_model.bin'), map_location='cpu'), strict=False)
-
-    ds_ref_config_training = get_train_ds_config(
-        offload=args.offload,
-        args=args,
-        stage=3
-    )
-
-    ref_model, *_ = deepspeed.initialize(
-        model=ref_model,
-        config=ds_ref_config_training
-    )
+    ref_model = None
+    ref_logps_table = None
+    if args.ref_logps_path is not None:
+        ref_logps_table = RefLogpsTable(args.ref_logps_path)
+        print_rank_0(f"load the reference log-probs of {len(ref_logps_table)} queries from {args.ref_logps_path}", args.global_rank)
+    else:
+        ds_ref_config_load = get_train_ds_config(
+            offload=args.offload,
+            args=args,
+            stage=2 
+        )
+
+        ref_model , _, _ = build_model(
+            text_tokenizer=tokenizer_origin,
+            args=args,
+            ds_config=ds_ref_config_load,
+            enable_lora=False
+        )
+
+        print_rank_0("load ref model............")
+        if args.model_architecture == 'default':
+            ref_model.load_state_dict(torch.load(os.path.join(args.from_checkpoint, 'pytorch_model.bin'), map_location='cpu'), strict=False)
+
+        ds_ref_config_training = get_train_ds_config(
+            offload=args.offload,
+            args=args,
+            stage=3
+        )
+
+        ref_model, *_ = deepspeed.initialize(
+            model=ref_model,
+            config=ds_ref_config_training
+        )
 
     print_rank_0("***** Running training *****", args.global_rank)
     for epoch in range(start_epoch, args.num_train_epochs):
@@ -401,22 +435,17 @@ def main():
         for step, batch in enumerate(tqdm(train_dataloader)):
             # batch--> y1 of sample 1; y2 of sample 1;...; yn of sample 1; y1 of sample 2; ...
             batch = to_device(batch, device)
-            chosen_idx = [i for i in range(len(batch["input_ids"])) if (batch['input_ids'][i][0] != -1)]
-
-            batch["image"] = [batch["image"][i] for i in chosen_idx]
-            batch["input_ids"] = [batch["input_ids"][i] for i in chosen_idx]
-            batch["attention_mask"] = [batch["attention_mask"][i] for i in chosen_idx]
-            batch["labels"] = [batch["labels"][i] for i in chosen_idx]
-
-            input_ids = torch.stack(batch["input_ids"])
-            attention_mask = torch.stack(batch["attention_mask"])
-            labels = torch.stack(batch["labels"])
-            images = torch.stack(batch["image"])
+            # images are kept once per query, `image_index` maps each candidate to its image
+            image_index = batch["image_index"]
+            input_ids = batch["input_ids"]
+            attention_mask = batch["attention_mask"]
+            labels = batch["labels"]
+            images = batch["image"]
 
             if args.model_architecture == "llava_next":
                 image_sizes = batch["image_sizes"]
-                image_sizes = image_sizes.reshape(len(input_ids), 2)
-                images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
+                image_sizes = image_sizes.reshape(-1, 2)
+                image_num_tiles = batch["image_num_tiles"]
                 
                 aspect_ratio_ids = None
                 aspect_ratio_mask = None
@@ -424,11 +453,13 @@ def main():
             elif args.model_architecture == "llama-3.2-vision":
                 aspect_ratio_ids = batch["aspect_ratio_ids"]
                 aspect_ratio_mask = batch["aspect_ratio_mask"]
-                images = images.reshape(len(input_ids), 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
+                images = images.reshape(-1, 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
                 image_sizes = None
+                image_num_tiles = None
 
             else:
                 image_sizes = None
+                image_num_tiles = None
                 aspect_ratio_ids = None
                 aspect_ratio_mask = None
 
@@ -436,98 +467,109 @@ def main():
             attention_mask_tmp = attention_mask.clone()
             attention_mask_tmp[attention_mask_tmp==0] = 1
 
+            # logits[:, i] predicts input_ids[:, logits_start + i]
+            logits_start = 1
+            ref_logits_start = 1
             if args.model_architecture == 'default':
+                images = broadcast_images(images, image_index)[0]
                 outputs_logits = model(images,
                     input_ids,
                     attention_mask=attention_mask,
                     input_labels=labels,
                     image_num=batch["image_num"])[1]
                 
-                with torch.no_grad():
-                    ref_outputs_logits = ref_model(
-                        images,
-                        input_ids,
-                        attention_mask=attention_mask,
-                        input_labels=labels,
-                        image_num=batch["image_num"])[1]
+                if ref_model is not None:
+                    with torch.no_grad():
+                        ref_outputs_logits = ref_model(
+                            images,
+                            input_ids,
+                            attention_mask=attention_mask,
+                            input_labels=labels,
+                            image_num=batch["image_num"])[1]
             elif args.model_architecture in ["llava", "llava_next"]:
+                prefix_outputs = None
+                ref_prefix_outputs = None
+                if args.share_prompt_prefix:
+                    # gradient checkpointing disables the kv cache, so the policy only shares the prefix without it
+                    if not args.gradient_checkpointing:
+                        prefix_outputs = prefix_shared_forward(
+                            model, input_ids, attention_mask, labels, images, image_index, image_sizes, image_num_tiles)
+                    if ref_model is not None:
+                        with torch.no_grad():
+                            ref_prefix_outputs = prefix_shared_forward(
+                                ref_model, input_ids, attention_mask, labels, images, image_index, image_sizes, image_num_tiles)
+
+                image_inputs = dict(pixel_values=images, image_index=image_index)
                 if image_sizes is not None:
-                    outputs = model(
-                        input_ids=input_ids,
-                        image_sizes = image_sizes,
-                        pixel_values = images,
-                        attention_mask=attention_mask_tmp,
-                        labels=labels_tmp,
-                        output_hidden_states=True)
-                    outputs_logits = outputs.logits_drop_image
-                    
-                    with torch.no_grad():
-                        ref_outputs = ref_model(
-                        input_ids=input_ids,
-                        image_sizes = image_sizes,
-                        pixel_values = images,
-                        attention_mask=attention_mask_tmp,
-                        labels=labels_tmp,
-                        output_hidden_states=True)
-                        ref_outputs_logits = ref_outputs.logits_drop_image
+                    image_inputs.update(image_sizes=image_sizes, image_num_tiles=image_num_tiles)
+
+                if prefix_outputs is not None:
+                    outputs_logits, logits_start = prefix_outputs
                 else:
                     outputs = model(
                         input_ids=input_ids,
-                        pixel_values = images,
                         attention_mask=attention_mask_tmp,
                         labels=labels_tmp,
-                        output_hidden_states=True)
+                        output_hidden_states=True,
+                        **image_inputs)
                     outputs_logits = outputs.logits_drop_image
-                    
+
+                if ref_prefix_outputs is not None:
+                    ref_outputs_logits, ref_logits_start = ref_prefix_outputs
+                elif ref_model is not None:
                     with torch.no_grad():
                         ref_outputs = ref_model(
                         input_ids=input_ids,
-                        pixel_values = images,
                         attention_mask=attention_mask_tmp,
                         labels=labels_tmp,
-                        output_hidden_states=True)
+                        output_hidden_states=True,
+                        **image_inputs)
                         ref_outputs_logits = ref_outputs.logits_drop_image
             elif args.model_architecture in ["llama-3.2-vision"]:
+                # run the vision model once per image and broadcast the cross-attention states
+                cross_attention_states = get_mllama_cross_attention_states(
+                    model, images, aspect_ratio_ids, aspect_ratio_mask, image_index)
                 outputs = model(
                     input_ids=input_ids,
-                    pixel_values = images,
-                    aspect_ratio_ids=aspect_ratio_ids,
-                    aspect_ratio_mask=aspect_ratio_mask,
+                    cross_attention_states=cross_attention_states,
                     attention_mask=attention_mask,
                     labels=labels,
                     output_hidden_states=True)
                 outputs_logits = outputs.logits
                 
-                with torch.no_grad():
-                    ref_outputs = ref_model(
-                    input_ids=input_ids,
-                    pixel_values = images,
-                    aspect_ratio_ids=aspect_ratio_ids,
-                    aspect_ratio_mask=aspect_ratio_mask,
-                    attention_mask=attention_mask,
-                    labels=labels,
-                    output_hidden_states=True)
-                    ref_outputs_logits = ref_outputs.logits
+                if ref_model is not None:
+                    with torch.no_grad():
+                        ref_cross_attention_states = get_mllama_cross_attention_states(
+                            ref_model, images, aspect_ratio_ids, aspect_ratio_mask, image_index)
+                        ref_outputs = ref_model(
+                        input_ids=input_ids,
+                        cross_attention_states=ref_cross_attention_states,
+                        attention_mask=attention_mask,
+                        labels=labels,
+                        output_hidden_states=True)
+                        ref_outputs_logits = ref_outputs.logits
 
             # Conducting the DPO with all the data with an image or all without image.
-            logprobs = gather_log_probs(outputs_logits[:, :-1, :], input_ids[:, 1:], labels)
-            ref_logprobs = gather_log_probs(ref_outputs_logits[:, :-1, :], input_ids[:,1:], labels)
-
-            sample_num = len(logprobs) // 2
-            loss = 0
-            for batch_index in range(sample_num):
-                chosen_logps = logprobs[batch_index*2]
-                rejected_logps = logprobs[batch_index*2 + 1]
-
-                ref_chosen_logps = ref_logprobs[batch_index*2]
-                ref_rejected_logps = ref_logprobs[batch_index*2 + 1]
-
-                #compute DPO loss
-                logits = args.beta * ((chosen_logps-ref_chosen_logps)-(rejected_logps-ref_rejected_logps))
-                loss += (-torch.nn.functional.logsigmoid(logits) * (1 - args.label_smoothing) - \
-                            torch.nn.functional.logsigmoid(-logits) * args.label_smoothing)
-            
-            loss = loss/sample_num 
+            logprobs = gather_log_probs(outputs_logits[:, :-1, :], input_ids[:, logits_start:], labels[:, logits_start-1:])
+            if ref_logps_table is not None:
+                ref_logprobs = ref_logps_table.lookup([query_id[0] for query_id in batch["query_id"]],
+                                                      batch["candidate_index"], device=logprobs.device)
+                ref_logprobs = ref_logprobs.to(logprobs.dtype)
+            else:
+                ref_logprobs = gather_log_probs(ref_outputs_logits[:, :-1, :], input_ids[:, ref_logits_start:], labels[:, ref_logits_start-1:])
+
+            # the first two candidates of each query (the rows candidate_offsets[i]:candidate_offsets[i+1])
+            # are the chosen and the rejected one
+            candidate_offsets = batch["candidate_offsets"]
+            assert (candidate_offsets.diff() >= 2).all(), "every query needs a chosen and a rejected candidate"
+            chosen_rows, rejected_rows = candidate_offsets[:-1], candidate_offsets[:-1] + 1
+            chosen_logps, rejected_logps = logprobs[chosen_rows], logprobs[rejected_rows]
+            ref_chosen_logps, ref_rejected_logps = ref_logprobs[chosen_rows], ref_logprobs[rejected_rows]
+
+            #compute DPO loss
+            logits = args.beta * ((chosen_logps-ref_chosen_logps)-(rejected_logps-ref_rejected_logps))
+            loss = (-torch.nn.functional.logsigmoid(logits) * (1 - args.label_smoothing) - \
+                        torch.nn.functional.logsigmoid(-logits) * args.label_smoothing).mean()
             model.backward(loss)
             model.step()
 
@@ -550,11 +592,12 @@ def main():
             # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
             model_to_save = model.module if hasattr(model,
                                                     'module') else model
-            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
             os.makedirs(f'{args.output_dir}/epoch-{epoch}', exist_ok=True)
             WEIGHTS_NAME = "pytorch_model.bin"
             output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}', WEIGHTS_NAME)
             torch.save(lean_state_dict, output_model_file)
+            save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
         
 if __name__ == "__main__":
     main()
@@ -0,0 +1,142 @@
+import numpy as np
+import torch
+
+import os
+import sys
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from utils.data import DST
+from utils.model.vision_feature import unwrap_model, select_ragged_images
+from utils.utils import expand_past_key_values
+
+
+def get_group_first_rows(image_index):
+    # candidates are grouped by their image (query), return the group of each row and the first row of each group
+    group_ids, group_index = torch.unique(image_index, return_inverse=True)
+    first_row = torch.zeros(len(group_ids), dtype=torch.long, device=image_index.device)
+    first_row.scatter_reduce_(0, group_index, torch.arange(len(group_index), device=image_index.device),
+                              reduce="amin", include_self=False)
+    return group_ids, group_index, first_row
+
+
+def get_shared_prefix_len(input_ids, labels, image_index, image_token_index):
+    # the prompt (image + instruction) of the candidates of a query is the same, we share the part that
+    # 1) is not scored by any candidate and 2) covers all image tokens. Return 0 if there is nothing to share.
+    first_label_index = (labels != DST.DEFAULT_LABEL_PADDING_NUM).int().argmax(-1)
+    prefix_len = int(first_label_index.min().item())
+    image_positions = torch.where(input_ids == image_token_index)[-1]
+    if len(image_positions) > 0 and prefix_len <= int(image_positions.max().item()):
+        return 0
+    if prefix_len < 2:
+        return 0
+
+    _, group_index, first_row = get_group_first_rows(image_index)
+    if not torch.equal(input_ids[:, :prefix_len], input_ids[first_row[group_index], :prefix_len]):
+        return 0
+    return prefix_len
+
+
+def prefix_shared_forward(model, input_ids, attention_mask, labels, images, image_index, image_sizes=None,
+                          image_num_tiles=None):
+    """
+    Run the shared prompt (image + instruction) of each query once, then run every candidate continuation
+    against the kv cache of its prompt. Gradients flow back through the shared prefix.
+
+    Return (logits, start): logits[:, i] is the prediction of input_ids[:, start + i], so that the
+    log-probs are computed with `gather_log_probs(logits[:, :-1], input_ids[:, start:], labels[:, start-1:])`.
+    Return None when the prefix can not be shared on some rank (e.g., the kv cache is disabled by gradient checkpointing).
+    All ranks should call it together.
+    `image_num_tiles`: the tile counts of ragged llava-next images (see collate_ragged_tiles).
+    """
+    config = unwrap_model(model).config
+    prefix_len = get_shared_prefix_len(input_ids, labels, image_index, config.image_token_index)
+    # all ranks should run the same forwards (ZeRO-3 gathers the parameters in each of them),
+    # so the prefix is shared only if it can be shared on every rank
+    shared = torch.tensor(int(prefix_len > 0), device=input_ids.device)
+    if torch.distributed.is_initialized():
+        torch.distributed.all_reduce(shared, op=torch.distributed.ReduceOp.MIN)
+    if shared.item() == 0:
+        return None
+
+    group_ids, group_index, first_row = get_group_first_rows(image_index)
+
+    # 1. the shared prefix, one row per query
+    prefix_inputs = dict(
+        input_ids=input_ids[first_row, :prefix_len],
+        pixel_values=images[group_ids],
+        attention_mask=torch.ones_like(input_ids[first_row, :prefix_len]),
+        use_cache=True,
+        return_dict=True,
+    )
+    if image_sizes is not None:
+        prefix_inputs.update(image_sizes=image_sizes[group_ids])
+    if image_num_tiles is not None:
+        pixel_values, num_tiles = select_ragged_images(images, image_num_tiles, group_ids)
+        prefix_inputs.update(pixel_values=pixel_values, image_num_tiles=num_tiles)
+    prefix_outputs = model(**prefix_inputs)
+    if prefix_outputs.past_key_values is None:
+        return None
+
+    # 2. the continuation of every candidate
+    past_key_values = expand_past_key_values(prefix_outputs.past_key_values, group_index)
+    prefix_attention_mask = prefix_outputs.attention_mask[group_index]
+    full_attention_mask = torch.cat([prefix_attention_mask, attention_mask[:, prefix_len:]], dim=-1)
+    position_ids = (full_attention_mask.long().cumsum(-1) - 1).masked_fill_(full_attention_mask == 0, 1)
+    continuation_outputs = model(
+        input_ids=input_ids[:, prefix_len:],
+        attention_mask=full_attention_mask,
+        position_ids=position_ids[:, prefix_attention_mask.size(-1):],
+        past_key_values=past_key_values,
+        use_cache=True,
+        return_dict=True,
+    )
+
+    # the last prefix position predicts the first continuation token
+    logits = torch.cat([prefix_outputs.logits[:, -1:][group_index], continuation_outputs.logits], dim=1)
+    return logits, prefix_len
+
+
+def save_ref_logps(path, query_ids, candidate_index, ref_logps):
+    """
+    Save the reference log-probs as a compact table: one row per query (sorted by query id) and one column
+    per candidate, NaN marks a missing candidate. Rows repeated by the distributed sampler are merged.
+    """
+    table = {}
+    for query_id, cand, logp in zip(query_ids, candidate_index, ref_logps):
+        key = (str(query_id), int(cand))
+        if key in table and not np.isclose(table[key], logp, rtol=1e-3, atol=1e-3):
+            raise ValueError(f"query id {query_id} is not unique, the reference log-probs can not be indexed by it")
+        table[key] = logp
+
+    keys = sorted(set(query_id for query_id, _ in table.keys()))
+    row = {query_id: i for i, query_id in enumerate(keys)}
+    num_candidates = max(cand for _, cand in table.keys()) + 1
+    logps = np.full((len(keys), num_candidates), np.nan, dtype=np.float32)
+    for (query_id, cand), logp in table.items():
+        logps[row[query_id], cand] = logp
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "wb") as f:
+        np.savez(f, query_ids=np.array(keys), ref_logps=logps)
+
+
+class RefLogpsTable:
+    # reference log-probs precomputed by precompute_ref_logps.py, indexed by (query id, candidate index)
+
+    def __init__(self, path):
+        data = np.load(path)
+        self.row = {query_id: i for i, query_id in enumerate(data["query_ids"].tolist())}
+        self.ref_logps = torch.from_numpy(data["ref_logps"])
+
+    def __len__(self):
+        return len(self.row)
+
+    def lookup(self, query_ids, candidate_index, device=None):
+        try:
+            rows = torch.LongTensor([self.row[str(query_id)] for query_id in query_ids])
+        except KeyError as e:
+            raise KeyError(f"query id {e} is not found in the reference log-probs, "
+                           "please precompute them on the same training data") from None
+        ref_logps = self.ref_logps[rows, candidate_index.cpu()]
+        assert not torch.isnan(ref_logps).any(), "some candidates are missing in the reference log-probs"
+        return ref_logps.to(device) if device is not None else ref_logps
@@ -29,8 +29,12 @@ sys.path.append(
 from utils.data import build_dataset, DataCollatorPadToMaxLenForRewardModel, split_dataset, shuffle_dataset, DST
 from utils.utils import print_rank_0, to_device, save_hf_format, set_random_seed, get_all_reduce_mean, get_optimizer_grouped_parameters, save_zero_three_model
 from utils.ds_utils import get_train_ds_config
+from utils.module.lora import merge_lora_state_dict, save_lora_adapter
 
 from utils.model import build_model
+from utils.model.vision_feature import broadcast_images
+from utils.module.ranking_loss import get_candidate_mask, listwise_loss
+from dpo_training_utils import RefLogpsTable
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -226,6 +230,22 @@ def parse_args():
     parser.add_argument('--template',
                         type=str,
                         choices=["default", "llama_2", "llama_3", "llama_3", "vicuna", "llava"],)
+    parser.add_argument('--ref_logps_path',
+                        type=str,
+                        default=None,
+                        help='The reference log-probs precomputed by precompute_ref_logps.py. If provided, the reference '
+                        'model is not built and its log-probs are read from this file.')
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
 
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
@@ -298,7 +318,10 @@ def main():
         vis_root=args.image_folder,
         vis_processor=image_processor,
         tokenizer=tokenizer,
-        template=args.template        
+        template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor        
     )
 
     np_rng = np.random.RandomState(seed=args.seed)
@@ -360,32 +383,39 @@ def main():
         model.gradient_checkpointing_enable()
     
     # ref model prepare
-    ds_ref_config_load = get_train_ds_config(
-        offload=args.offload,
-        args=args,
-        stage=2 
-    )
-
-    ref_model , _, _ = build_model(
-        text_tokenizer=tokenizer_origin,
-        args=args,
-        ds_config=ds_ref_config_load
-    )
-
-    print_rank_0("load ref model............")
-    if args.model_architecture == "default":
-        ref_model.load_state_dict(torch.load(os.path.join(args.from_checkpoint, 'pytorch_model.bin'), map_location='cpu'), strict=False)
-
-    ds_ref_config_training = get_train_ds_config(
-        offload=args.offload,
-        args=args,
-        stage=3
-    )
-
-    ref_model, *_ = deepspeed.initialize(
-        model=ref_model,
-        config=ds_ref_config_training
-    )
+    ref_model = None
+    ref_logps_table = None
+    if args.ref_logps_path is not None:
+        ref_logps_table = RefLogpsTable(args.ref_logps_path)
+        print_rank_0(f"load the reference log-probs of {len(ref_logps_table)} queries from {args.ref_logps_path}", args.global_rank)
+    else:
+        ds_ref_config_load = get_train_ds_config(
+            offload=args.offload,
+            args=args,
+            stage=2 
+        )
+
+        ref_model , _, _ = build_model(
+            text_tokenizer=tokenizer_origin,
+            args=args,
+            ds_config=ds_ref_config_load,
+            enable_lora=False
+        )
+
+        print_rank_0("load ref model............")
+        if args.model_architecture == "default":
+            ref_model.load_state_dict(torch.load(os.path.join(args.from_checkpoint, 'pytorch_model.bin'), map_location='cpu'), strict=False)
+
+        ds_ref_config_training = get_train_ds_config(
+            offload=args.offload,
+            args=args,
+            stage=3
+        )
+
+        ref_model, *_ = deepspeed.initialize(
+            model=ref_model,
+            config=ds_ref_config_training
+        )
 
     print_rank_0("***** Running training *****", args.global_rank)
     for epoch in range(start_epoch, args.num_train_epochs):
@@ -398,98 +428,64 @@ def main():
         for step, batch in enumerate(tqdm(train_dataloader)):
             # batch--> y1 of sample 1; y2 of sample 1;...; yn of sample 1; y1 of sample 2; ...
             batch = to_device(batch, device)  #torch.size(1, 3, 224, 224]) #torch.Size([1, 1, 3, 224, 224])
-            chosen_idx = [i for i in range(len(batch["input_ids"])) if (batch['input_ids'][i][0] != -1)]
-
-            batch["image"] = [batch["image"][i] for i in chosen_idx]
-            batch["input_ids"] = [batch["input_ids"][i] for i in chosen_idx]
-            batch["attention_mask"] = [batch["attention_mask"][i] for i in chosen_idx]
-            batch["labels"] = [batch["labels"][i] for i in chosen_idx]
-            
-            input_ids = torch.stack(batch["input_ids"])
-            attention_mask = torch.stack(batch["attention_mask"])
-            labels = torch.stack(batch["labels"])
-            images = torch.stack(batch["image"])
+            candidate_mask = get_candidate_mask(batch["candidate_offsets"])
+            # images are kept once per query, `image_index` maps each candidate to its image
+            image_index = batch["image_index"]
+            input_ids = batch["input_ids"]
+            attention_mask = batch["attention_mask"]
+            labels = batch["labels"]
+            images = batch["image"]
     
             if args.model_architecture == "default":
+                images = broadcast_images(images, image_index)[0]
                 outputs_logits = model(images,
                     input_ids,
                     attention_mask=attention_mask,
                     input_labels=labels,
                     image_num=batch["image_num"])[1]
 
-                with torch.no_grad():
-                    ref_outputs_logits = ref_model(
-                        images,
-                        input_ids,
-                        attention_mask=attention_mask,
-                        input_labels=labels,
-                        image_num=batch["image_num"],
-                    )[1]
+                if ref_model is not None:
+                    with torch.no_grad():
+                        ref_outputs_logits = ref_model(
+                            images,
+                            input_ids,
+                            attention_mask=attention_mask,
+                            input_labels=labels,
+                            image_num=batch["image_num"],
+                        )[1]
 
             elif args.model_architecture=="llava":
                 outputs = model(
                     input_ids=input_ids,
                     pixel_values = images,
+                    image_index=image_index,
                     attention_mask=attention_mask,
                     labels=labels,
                     output_hidden_states=True)
                 outputs_logits = outputs.logits_drop_image
                 
-                with torch.no_grad():
-                    ref_outputs = ref_model(
-                    input_ids=input_ids,
-                    pixel_values = images,
-                    attention_mask=attention_mask,
-                    labels=labels,
-                    output_hidden_states=True)
-                    ref_outputs_logits = ref_outputs.logits_drop_image
+                if ref_model is not None:
+                    with torch.no_grad():
+                        ref_outputs = ref_model(
+                        input_ids=input_ids,
+                        pixel_values = images,
+                        image_index=image_index,
+                        attention_mask=attention_mask,
+                        labels=labels,
+                        output_hidden_states=True)
+                        ref_outputs_logits = ref_outputs.logits_drop_image
 
 
             logprobs = gather_log_probs(outputs_logits[:, :-1, :], input_ids[:, 1:], labels)
-            ref_logprobs = gather_log_probs(ref_outputs_logits[:, :-1, :], input_ids[:,1:], labels)
-            
-            # batch 
-            # if logprobs.shape[0] != args.per_device_train_batch_size * args.ranked_candidate_num:
-            #     print("check the number of the candidate, chosen and rejected !!!")
-            #     del logprobs
-            #     del ref_logprobs
-            #     continue
-
-            # use warmupbeta
-            if_del_reference = False
-            
-            sample_num = len(logprobs) // args.ranked_candidate_num
-            count_list = [args.ranked_candidate_num] * sample_num
-            loss = 0
-            for batch_index, can_num in enumerate(count_list):
-                probability = 1
-                for i in range(can_num):
-                    numerator_logps = logprobs[sum(count_list[:batch_index]) + i]
-                    numerator_ref_logps = ref_logprobs[sum(count_list[:batch_index]) + i]
-                    
-                    denominator = 0.01
-                    for j in range(i, can_num):
-                        denominator_logps = logprobs[sum(count_list[:batch_index]) + j]
-                        denominator_ref_logps = ref_logprobs[sum(count_list[:batch_index]) + j]
-                        if if_del_reference:
-                            denominator += torch.exp(args.beta * (denominator_logps))
-                        else:
-                            denominator += torch.exp(args.beta * (denominator_logps - denominator_ref_logps))
-                    
-                    if if_del_reference:
-                        probability *= torch.exp(args.beta * (numerator_logps)) / denominator
-                    else:
-                        # Overflow Prevention
-                        try:
-                            probability *= torch.exp(args.beta * (numerator_logps - numerator_ref_logps)) / denominator
-                        except:
-                            probability = probability
-                            print("skip this comparsion!!!")
-
-                loss += (- torch.log(probability) * (1 - args.label_smoothing) - \
-                        torch.log(1 - probability) * args.label_smoothing)
+            if ref_logps_table is not None:
+                ref_logprobs = ref_logps_table.lookup([query_id[0] for query_id in batch["query_id"]],
+                                                      batch["candidate_index"], device=logprobs.device)
+                ref_logprobs = ref_logprobs.to(logprobs.dtype)
+            else:
+                ref_logprobs = gather_log_probs(ref_outputs_logits[:, :-1, :], input_ids[:,1:], labels)
             
-            loss = loss / sample_num
+            # Plackett-Luce over the candidates of each query with the implicit rewards beta * (logp - ref_logp)
+            loss = listwise_loss(args.beta * (logprobs - ref_logprobs), candidate_mask, label_smoothing=args.label_smoothing)
             if torch.isnan(loss):
                 print("Checking for a NaN value in the loss value!!!")
                 del logprobs
@@ -519,11 +515,12 @@ def main():
             # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
             model_to_save = model.module if hasattr(model,
                                                     'module') else model
-            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
             os.makedirs(f'{args.output_dir}/epoch-{epoch}', exist_ok=True)
             WEIGHTS_NAME = "pytorch_model.bin"
             output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}', WEIGHTS_NAME)
             torch.save(lean_state_dict, output_model_file)
+            save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
         
 if __name__ == "__main__":
     main()
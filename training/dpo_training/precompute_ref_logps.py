@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+# Score the preference data with the reference model once and save the log-probs of every candidate,
+# so that the DPO trainers can read them with `--ref_logps_path` instead of keeping the reference model.
+# It takes the same arguments as dpo_training_main.py, the output file is given by `--ref_logps_path`.
+
+import os
+import sys
+
+import torch
+import torch.distributed
+from tqdm import tqdm
+from torch.utils.data import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+
+from transformers import AutoTokenizer
+
+import deepspeed
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from utils.data import build_dataset, DataCollatorPadToMaxLenForRewardModel
+from utils.utils import print_rank_0, to_device, set_random_seed
+from utils.ds_utils import get_train_ds_config
+
+from utils.model import build_model
+from utils.model.vision_feature import get_mllama_cross_attention_states, broadcast_images
+from dpo_training_main import parse_args, gather_log_probs
+from dpo_training_utils import prefix_shared_forward, save_ref_logps
+
+
+@torch.no_grad()
+def compute_ref_logps(ref_model, batch, args):
+    image_index = batch["image_index"]
+    input_ids = batch["input_ids"]
+    attention_mask = batch["attention_mask"]
+    labels = batch["labels"]
+    images = batch["image"]
+
+    image_sizes = None
+    image_num_tiles = None
+    if args.model_architecture == "llava_next":
+        image_sizes = batch["image_sizes"].reshape(-1, 2)
+        image_num_tiles = batch["image_num_tiles"]
+    elif args.model_architecture == "llama-3.2-vision":
+        images = images.reshape(-1, 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
+
+    logits_start = 1
+    if args.model_architecture == 'default':
+        images = broadcast_images(images, image_index)[0]
+        logits = ref_model(
+            images,
+            input_ids,
+            attention_mask=attention_mask,
+            input_labels=labels,
+            image_num=batch["image_num"])[1]
+    elif args.model_architecture in ["llava", "llava_next"]:
+        prefix_outputs = None
+        if args.share_prompt_prefix:
+            prefix_outputs = prefix_shared_forward(
+                ref_model, input_ids, attention_mask, labels, images, image_index, image_sizes, image_num_tiles)
+        if prefix_outputs is not None:
+            logits, logits_start = prefix_outputs
+        else:
+            labels_tmp = input_ids.clone()
+            attention_mask_tmp = attention_mask.clone()
+            attention_mask_tmp[attention_mask_tmp==0] = 1
+            image_inputs = dict(pixel_values=images, image_index=image_index)
+            if image_sizes is not None:
+                image_inputs.update(image_sizes=image_sizes, image_num_tiles=image_num_tiles)
+            logits = ref_model(
+                input_ids=input_ids,
+                attention_mask=attention_mask_tmp,
+                labels=labels_tmp,
+                output_hidden_states=True,
+                **image_inputs).logits_drop_image
+    elif args.model_architecture in ["llama-3.2-vision"]:
+        cross_attention_states = get_mllama_cross_attention_states(
+            ref_model, images, batch["aspect_ratio_ids"], batch["aspect_ratio_mask"], image_index)
+        logits = ref_model(
+            input_ids=input_ids,
+            cross_attention_states=cross_attention_states,
+            attention_mask=attention_mask,
+            labels=labels,
+            output_hidden_states=True).logits
+
+    ref_logps = gather_log_probs(logits[:, :-1, :], input_ids[:, logits_start:], labels[:, logits_start-1:])
+    query_ids = [query_id[0] for query_id in batch["query_id"]]
+    candidate_index = batch["candidate_index"].tolist()
+    return query_ids, candidate_index, ref_logps.float().tolist()
+
+
+def main():
+    args = parse_args()
+    assert args.ref_logps_path is not None, "please specify the output file with --ref_logps_path"
+
+    if args.local_rank == -1:
+        device = torch.device("cuda")
+    else:
+        torch.cuda.set_device(args.local_rank)
+        device = torch.device("cuda", args.local_rank)
+        deepspeed.init_distributed()
+
+    args.global_rank = torch.distributed.get_rank()
+
+    set_random_seed(args.seed)
+
+    torch.distributed.barrier()
+    if args.model_architecture == 'default':
+        tokenizer_origin = AutoTokenizer.from_pretrained(args.lm_model_name_or_path,
+                                                fast_tokenizer=True)
+        tokenizer_origin.padding_side = 'left'
+    else:
+        tokenizer_origin = None
+
+    ds_ref_config_load = get_train_ds_config(
+        offload=args.offload,
+        args=args,
+        stage=2
+    )
+
+    ref_model, image_processor, tokenizer = build_model(
+        text_tokenizer=tokenizer_origin,
+        args=args,
+        ds_config=ds_ref_config_load,
+        enable_lora=False
+    )
+
+    print_rank_0("load ref model............")
+    if args.model_architecture == 'default':
+        ref_model.load_state_dict(torch.load(os.path.join(args.from_checkpoint, 'pytorch_model.bin'), map_location='cpu'), strict=False)
+
+    ds_ref_config = get_train_ds_config(
+        offload=args.offload,
+        args=args,
+        stage=3
+    )
+    ds_ref_config['train_micro_batch_size_per_gpu'] = args.per_device_train_batch_size
+    ds_ref_config['train_batch_size'] = args.per_device_train_batch_size * torch.distributed.get_world_size()
+
+    ref_model, *_ = deepspeed.initialize(
+        model=ref_model,
+        config=ds_ref_config
+    )
+    ref_model.eval()
+
+    # prepare the data, the same way as the trainer (the order does not matter)
+    if len(args.dataset_samples) < len(args.dataset_names):
+        assert len(args.dataset_samples) == 1, "when args.dataset_samples is not the same length as args.dataset_names, it should be only one number"
+        args.dataset_samples =  [args.dataset_samples[0]] * len(args.dataset_names)
+    if len(args.dataset_concatenate_samples) < len(args.dataset_names):
+        assert len(args.dataset_concatenate_samples) == 1, "when args.dataset_concatenate_samples is not the same length as args.dataset_names, it should be only one number"
+        args.dataset_concatenate_samples =  [args.dataset_concatenate_samples[0]] * len(args.dataset_names)
+
+    args.dataset_concatenate_samples = [int(i) for i in args.dataset_concatenate_samples]
+
+    dataset = build_dataset(
+        args.data_path,
+        args.data_debug_path,
+        args.dataset_names,
+        args.dataset_samples,
+        args.dataset_concatenate_samples,
+        args.max_num_image_per_sample,
+        vis_root=args.image_folder,
+        vis_processor=image_processor,
+        tokenizer=tokenizer,
+        template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor,
+        max_ranked_candidate_num=args.ranked_candidate_num
+    )
+
+    dataloader = DataLoader(
+        dataset,
+        batch_size=args.per_device_train_batch_size,
+        sampler=DistributedSampler(dataset, shuffle=False, drop_last=False),
+        collate_fn=DataCollatorPadToMaxLenForRewardModel(args.max_seq_len, tokenizer.pad_token_id, image_processor.crop_size),
+    )
+
+    print_rank_0("***** Computing the reference log-probs *****", args.global_rank)
+    query_ids, candidate_index, ref_logps = [], [], []
+    for batch in tqdm(dataloader):
+        batch = to_device(batch, device)
+        outputs = compute_ref_logps(ref_model, batch, args)
+        query_ids.extend(outputs[0])
+        candidate_index.extend(outputs[1])
+        ref_logps.extend(outputs[2])
+
+    all_outputs = [None for _ in range(torch.distributed.get_world_size())]
+    torch.distributed.all_gather_object(all_outputs, (query_ids, candidate_index, ref_logps))
+    if args.global_rank == 0:
+        save_ref_logps(args.ref_logps_path,
+                       [q for outputs in all_outputs for q in outputs[0]],
+                       [c for outputs in all_outputs for c in outputs[1]],
+                       [l for outputs in all_outputs for l in outputs[2]])
+        print_rank_0(f"save the reference log-probs of {len(dataset)} queries to {args.ref_logps_path}", args.global_rank)
+    torch.distributed.barrier()
+
+
+if __name__ == "__main__":
+    main()
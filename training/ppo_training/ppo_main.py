@@ -22,20 +22,27 @@ from transformers import (
 
 import deepspeed
 from rlhf_engine import DeepSpeedRLHFEngine
+from rollout_engine import RolloutEngine
 from ppo_training_utils import (sampling, compute_logprobs_from_actor_and_ref, 
     compute_kl_reward_scores, get_advantages_and_returns, 
     critic_loss_fn, gather_log_probs,
     actor_loss_fn, sampling_llava,
-    sampling_llama)
+    sampling_llama, repeat_for_group,
+    get_group_advantages, group_sampling_llava,
+    compute_values, align_generation_logprobs,
+    MaxNewTokensScheduler, speculative_sampling_llava)
 
 from transformers import AdamW
 sys.path.append(
     os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
 from utils.data import build_dataset, DataCollatorPadToMaxLenForPPOTraining, split_dataset, shuffle_dataset, DST
-from utils.utils import print_rank_0, to_device, save_hf_format, set_random_seed, get_all_reduce_mean, get_optimizer_grouped_parameters, save_zero_three_model
+from utils.utils import print_rank_0, to_device, save_hf_format, set_random_seed, get_all_reduce_mean, get_optimizer_grouped_parameters, save_zero_three_model, \
+    split_value_head
 from utils.ds_utils import get_train_ds_config
-from utils.module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, fuse_lora, unfuse_lora
-from utils.model import create_dsvl_model_and_transforms
+from utils.module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, fuse_lora, unfuse_lora, merge_lora_state_dict, lora_fused, save_lora_adapter
+from utils.model import create_dsvl_model_and_transforms, build_model
+from utils.model.vision_feature import VisionFeatureCache, get_vision_features, pad_ragged_images
+from utils.model.reward_score_cache import RewardScoreCache, reward_model_fingerprint, lookup_reward_scores
 
 def parse_args():
     parser = argparse.ArgumentParser(
@@ -233,6 +240,10 @@ def parse_args():
     parser.add_argument('--only_optimize_lora',
                         action='store_true',
                         help='Only optimize the LoRA parameters.')
+    parser.add_argument('--lora_actor_as_ref',
+                        action='store_true',
+                        help='Compute the reference log-probs with the actor whose LoRA adapters are bypassed, '
+                        'instead of building a separate reference model. Needs --lang_lora_dim > 0 and --only_optimize_lora.')
 
     ## from ppo training
     parser.add_argument('--from_checkpoint',
@@ -350,6 +361,118 @@ def parse_args():
     parser.add_argument('--template',
                 type=str,
                 choices=["default", "llama_2", "llama_3", "llama_3", "vicuna", "llava", "llava_next", "llama-3.2-vision"],)
+    parser.add_argument('--advantage_estimator',
+                        type=str,
+                        default="gae",
+                        choices=["gae", "group_norm", "leave_one_out"],
+                        help='How to compute the advantages. gae: train a critic model and use GAE. '
+                        'group_norm / leave_one_out: critic-free, sample group_size responses for each prompt and use '
+                        'the group-normalized rewards or the leave-one-out mean of the group as the baseline.')
+    parser.add_argument('--group_size',
+                        type=int,
+                        default=1,
+                        help='Number of responses sampled for each prompt.')
+    parser.add_argument('--shared_critic',
+                        action='store_true',
+                        help='Put the value head on the final hidden states of the actor instead of training a separate '
+                        'critic model, one actor forward then gives both the log-probs and the values.')
+    parser.add_argument('--value_head_gradient',
+                        type=str,
+                        default="detach",
+                        choices=["detach", "shared"],
+                        help='With --shared_critic, detach: the value loss only trains the value head; '
+                        'shared: the value loss is also back-propagated into the actor.')
+    parser.add_argument('--value_loss_coef',
+                        type=float,
+                        default=1.0,
+                        help='With --shared_critic, the weight of the value loss added to the actor loss.')
+    parser.add_argument('--reuse_generation_logprobs',
+                        action='store_true',
+                        help='Use the log-probs collected while sampling as the old log-probs of the actor instead of '
+                        'recomputing them with an actor forward.')
+    parser.add_argument('--generation_logprobs_check_interval',
+                        type=int,
+                        default=100,
+                        help='With --reuse_generation_logprobs, recompute the log-probs every this many steps and compare '
+                        'them with the reused ones (0: never).')
+    parser.add_argument('--generation_logprobs_tolerance',
+                        type=float,
+                        default=0.05,
+                        help='The largest mean absolute difference between the reused and the recomputed log-probs, '
+                        'the reuse is turned off beyond it.')
+    parser.add_argument('--continuous_batching',
+                        action='store_true',
+                        help='Sample the responses with the continuous-batching rollout engine: finished responses leave '
+                        'the decoding batch at once and waiting prompts take their slots, the kv cache is kept in fixed-size pages.')
+    parser.add_argument('--rollout_max_batch_size',
+                        type=int,
+                        default=16,
+                        help='With --continuous_batching, the largest number of responses decoded together.')
+    parser.add_argument('--rollout_page_size',
+                        type=int,
+                        default=16,
+                        help='With --continuous_batching, the number of tokens of a kv cache page.')
+    parser.add_argument('--rollout_num_pages',
+                        type=int,
+                        default=0,
+                        help='With --continuous_batching, the number of kv cache pages (0: enough pages for '
+                        '--rollout_max_batch_size responses of the full length). Responses are preempted and recomputed '
+                        'when the pages run out.')
+    parser.add_argument('--template_stop_sequences',
+                        action='store_true',
+                        help='Also stop the responses at the end-of-turn markers of --template (e.g., <|eot_id|>, </s><s>, '
+                        '### Question:), not only at the eos token of the tokenizer.')
+    parser.add_argument('--adaptive_max_new_tokens',
+                        action='store_true',
+                        help='Cap the new tokens of the rollouts at a running percentile of the response lengths '
+                        '(plus a margin), never above --max_generation_length_of_sampling.')
+    parser.add_argument('--max_new_tokens_percentile',
+                        type=float,
+                        default=95.0,
+                        help='With --adaptive_max_new_tokens, the percentile of the recent response lengths.')
+    parser.add_argument('--max_new_tokens_margin',
+                        type=float,
+                        default=0.2,
+                        help='With --adaptive_max_new_tokens, the cap is the percentile times (1 + margin).')
+    parser.add_argument('--max_new_tokens_window',
+                        type=int,
+                        default=1024,
+                        help='With --adaptive_max_new_tokens, the number of recent responses (of all ranks) in the percentile.')
+    parser.add_argument('--draft_model_path',
+                        type=str,
+                        default=None,
+                        help='A smaller llava / llava_next checkpoint with the tokenizer and image processor of the actor. '
+                        'If given, the rollouts are decoded speculatively: the frozen draft model proposes tokens and the '
+                        'actor verifies them in one forward, the responses still follow the distribution of the actor.')
+    parser.add_argument('--num_draft_tokens',
+                        type=int,
+                        default=4,
+                        help='With --draft_model_path, the number of tokens the draft model proposes per verification.')
+    parser.add_argument('--share_vision_features',
+                        action='store_true',
+                        help='Run the vision tower once per step for the images of the batch and share the features '
+                        'between the actor, reference, critic and reward models whose frozen vision towers hold the same weights.')
+    parser.add_argument('--reward_score_cache_path',
+                        type=str,
+                        default=None,
+                        help='A sqlite file of reward scores shared across jobs (e.g., with rm_score.py), keyed by the '
+                        'reward model weights, the image content and the token ids. The reward model forward is skipped '
+                        'when all responses of the step are cached on all ranks.')
+    parser.add_argument('--reward_score_cache_max_size_mb',
+                        type=float,
+                        default=1024,
+                        help='The least recently used scores are evicted when the cache file grows beyond this size.')
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
 
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
@@ -358,6 +481,35 @@ def parse_args():
         # if we do not provide special learning rate, mainly for embedding, the same lr is applied
         args.learning_rate_pretraining_components = args.actor_learning_rate
     assert args.num_warmup_steps >= 0, "--num_warmup_steps must be >= 0"
+    if args.lora_actor_as_ref:
+        assert args.lang_lora_dim > 0 and args.only_optimize_lora, \
+            "--lora_actor_as_ref needs a LoRA actor whose base weights are frozen (--lang_lora_dim > 0 --only_optimize_lora)"
+    if args.advantage_estimator != "gae":
+        assert args.group_size > 1, "the critic-free advantage estimators need --group_size > 1"
+        assert not args.align_overflow and args.skip_actor_model == 0, \
+            "--align_overflow and --skip_actor_model need the critic model (--advantage_estimator gae)"
+    if args.shared_critic:
+        assert args.advantage_estimator == "gae", "--shared_critic is used with --advantage_estimator gae"
+        assert args.model_architecture in ["llava", "llava_next"], "--shared_critic supports llava and llava_next"
+        assert not args.align_overflow and args.skip_actor_model == 0, \
+            "--align_overflow and --skip_actor_model need a separate critic model"
+    if args.continuous_batching:
+        assert args.model_architecture in ["llava", "llava_next"], "--continuous_batching supports llava and llava_next"
+        assert args.rollout_max_batch_size >= args.group_size, "--rollout_max_batch_size should not be less than --group_size"
+        # each rank runs its own number of prefill / decode forwards, which ZeRO-3 can not keep in step
+        assert args.actor_zero_stage != 3, "--continuous_batching does not support --actor_zero_stage 3"
+    if args.draft_model_path is not None:
+        assert args.model_architecture in ["llava", "llava_next"], "--draft_model_path supports llava and llava_next"
+        assert not args.continuous_batching, "--draft_model_path can not be used with --continuous_batching"
+        assert args.num_draft_tokens > 0, "--num_draft_tokens should be positive"
+    if args.template_stop_sequences or args.adaptive_max_new_tokens:
+        assert args.model_architecture != "default", \
+            "--template_stop_sequences and --adaptive_max_new_tokens support llava, llava_next and llama-3.2-vision"
+    if args.share_vision_features:
+        assert args.model_architecture in ["llava", "llava_next"], "--share_vision_features supports llava and llava_next"
+    if args.reuse_generation_logprobs:
+        assert args.model_architecture in ["llava", "llava_next"], "--reuse_generation_logprobs supports llava and llava_next"
+        assert not args.shared_critic, "--shared_critic needs the actor forward for the values"
     if 'qwen' in args.vision_model_name_or_path.lower():
         assert args.vis_proj == 'baseline', "qwen's model only support baseline vis_proj as it has the perceiver module inside"
     return args
@@ -406,6 +558,12 @@ def main():
         reward_tokenizer=reward_tokenizer,
         number_dataset=args.max_training_samples_num,
         args=args)
+
+    reward_score_cache = None
+    if args.reward_score_cache_path is not None:
+        # the fingerprint gathers the weights of the reward model on all ranks
+        reward_score_cache = RewardScoreCache(args.reward_score_cache_path, max_size_mb=args.reward_score_cache_max_size_mb)
+        reward_fingerprint = reward_model_fingerprint(rlhf_engine.reward)
         
     # Prepare the data
     if len(args.dataset_samples) < len(args.dataset_names):
@@ -427,7 +585,10 @@ def main():
         vis_processor=rlhf_engine.actor_image_processor,
         vis_root=args.image_folder,
         tokenizer=rlhf_engine.actor_tokenizer_new,
-        template=args.template
+        template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor
     )
 
     # split the dataset into train and evaluation
@@ -458,7 +619,8 @@ def main():
 
     if args.gradient_checkpointing:
         rlhf_engine.actor.gradient_checkpointing_enable()
-        rlhf_engine.critic.gradient_checkpointing_enable()
+        if rlhf_engine.critic is not None:
+            rlhf_engine.critic.gradient_checkpointing_enable()
 
     end_of_token = ""
     if args.template == "llama_3":
@@ -470,6 +632,9 @@ def main():
     elif args.template == "llama-3.2-vision":
         end_of_token = DST.LLAMA_3_2_HUMAN_QUESTION_PRETOKEN_END
 
+    stop_sequences = DST.get_stop_sequences(args.template) if args.template_stop_sequences else None
+    print_rank_0(f"stop sequences of the rollouts: {stop_sequences}", args.global_rank)
+
     def evaluation(eval_dataloader):
         print_rank_0("***** Running training *****", args.global_rank)
         reward_score_acc = 0
@@ -482,7 +647,10 @@ def main():
             if args.model_architecture == "llava_next":
                 image_sizes = batch["image_sizes"]
                 image_sizes = image_sizes.reshape(len(input_ids), 2)
-                images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
+                # the rollouts need one tensor per row: pad the ragged tiles to the most tiles of the batch
+                images = pad_ragged_images(images, batch["image_num_tiles"])
+                aspect_ratio_ids = None
+                aspect_ratio_mask = None
                 
                 original_images = images[:, 0, :, :]
 
@@ -497,7 +665,7 @@ def main():
                 aspect_ratio_ids = None
                 aspect_ratio_mask = None
 
-            with torch.no_grad():
+            with torch.no_grad(), lora_fused(rlhf_engine.actor):
                 # generation
                 if args.model_architecture == 'llava':
                     sampling_ans = sampling_llava(rlhf_engine.actor, 
@@ -505,7 +673,8 @@ def main():
                                 attention_mask=attention_mask, 
                                 pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
                                 max_new_tokens=args.max_generation_length_of_sampling,
-                                processor=rlhf_engine.actor_tokenizer_new)
+                                processor=rlhf_engine.actor_tokenizer_new,
+                                stop_sequences=stop_sequences)
                 elif args.model_architecture == 'llava-next':
                     sampling_ans = sampling_llava(rlhf_engine.actor, 
                                 images, input_ids,
@@ -513,7 +682,8 @@ def main():
                                 attention_mask=attention_mask, 
                                 pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
                                 max_new_tokens=args.max_generation_length_of_sampling,
-                                processor=rlhf_engine.actor_tokenizer_new)
+                                processor=rlhf_engine.actor_tokenizer_new,
+                                stop_sequences=stop_sequences)
                 elif args.model_architecture == 'llama-3.2-vision':
                     sampling_ans = sampling_llama(rlhf_engine.actor, 
                                 images, input_ids,
@@ -522,7 +692,8 @@ def main():
                                 attention_mask=attention_mask, 
                                 pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
                                 max_new_tokens=args.max_generation_length_of_sampling,
-                                processor=rlhf_engine.actor_tokenizer_new)
+                                processor=rlhf_engine.actor_tokenizer_new,
+                                stop_sequences=stop_sequences)
                 else:
                     sampling_ans = sampling(rlhf_engine.actor, 
                                     images, input_ids, 
@@ -548,15 +719,23 @@ def main():
             rlhf_engine.critic_tokenizer_new.decode(input_ids[0])
 
             with torch.no_grad():
-                reward_scores = rlhf_engine.reward.forward_value(images,
-                                    reward_input_id,
-                                    image_sizes=image_sizes,
-                                    aspect_ratio_ids=aspect_ratio_ids,
-                                    aspect_ratio_mask=aspect_ratio_mask,
-                                    attention_mask=reward_attention_mask,
-                                    input_labels=reward_input_id,
-                                    image_num=batch["image_num"]
-                                )["chosen_end_scores"]
+                reward_score_keys, reward_scores = None, None
+                if reward_score_cache is not None:
+                    reward_score_keys, reward_scores = lookup_reward_scores(
+                        reward_score_cache, reward_fingerprint, reward_input_id, reward_attention_mask,
+                        images, image_sizes, aspect_ratio_ids, aspect_ratio_mask)
+                if reward_scores is None:
+                    reward_scores = rlhf_engine.reward.forward_value(images,
+                                        reward_input_id,
+                                        image_sizes=image_sizes,
+                                        aspect_ratio_ids=aspect_ratio_ids,
+                                        aspect_ratio_mask=aspect_ratio_mask,
+                                        attention_mask=reward_attention_mask,
+                                        input_labels=reward_input_id,
+                                        image_num=batch["image_num"]
+                                    )["chosen_end_scores"]
+                    if reward_score_keys is not None:
+                        reward_score_cache.put_many(reward_score_keys, reward_scores.float().tolist())
 
             reward_score_acc += reward_scores.mean()
         reward_score_acc = get_all_reduce_mean(reward_score_acc).item()
@@ -566,7 +745,33 @@ def main():
     
     # Train!
     print_rank_0("***** Running training *****", args.global_rank)
+    rollout_engine = None
+    if args.continuous_batching:
+        rollout_engine = RolloutEngine(rlhf_engine.actor,
+                                       rlhf_engine.actor_tokenizer_new,
+                                       pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
+                                       max_batch_size=args.rollout_max_batch_size,
+                                       page_size=args.rollout_page_size,
+                                       num_pages=args.rollout_num_pages,
+                                       max_new_tokens=args.max_generation_length_of_sampling,
+                                       stop_sequences=stop_sequences)
+    draft_model = None
+    if args.draft_model_path is not None:
+        # the draft model is frozen, a stale draft only lowers the acceptance rate
+        print_rank_0("load draft model............", args.global_rank)
+        draft_model, *_ = build_model(args=args,
+                                      from_checkpoint=args.draft_model_path,
+                                      enable_lora=False)
+        draft_model = draft_model.to(device, dtype=torch.bfloat16 if args.precision == "bf16" else torch.half)
+        draft_model.requires_grad_(False)
+    max_new_tokens_scheduler = None
+    if args.adaptive_max_new_tokens:
+        max_new_tokens_scheduler = MaxNewTokensScheduler(args.max_generation_length_of_sampling,
+                                                         percentile=args.max_new_tokens_percentile,
+                                                         margin=args.max_new_tokens_margin,
+                                                         window=args.max_new_tokens_window)
     global_step = 0
+    vision_feature_cache = VisionFeatureCache() if args.share_vision_features else None
     for epoch in range(start_epoch, args.num_train_epochs):
         print_rank_0(
             f"Beginning of Epoch {epoch+1}/{args.num_train_epochs}, Total Micro Batches {len(train_dataloader)}",
@@ -579,8 +784,10 @@ def main():
             only_update_critic_model = False
 
         rlhf_engine.actor.train()
-        rlhf_engine.critic.train()
-        rlhf_engine.ref.eval()
+        if rlhf_engine.critic is not None:
+            rlhf_engine.critic.train()
+        if rlhf_engine.ref is not None:
+            rlhf_engine.ref.eval()
         rlhf_engine.reward.eval()
         for step, batch in enumerate(tqdm(train_dataloader)):
             batch = to_device(batch, device)  #torch.size(1, 3, 224, 224]) #torch.Size([1, 1, 3, 224, 224])
@@ -591,7 +798,10 @@ def main():
             if args.model_architecture == "llava_next":
                 image_sizes = batch["image_sizes"]
                 image_sizes = image_sizes.reshape(len(input_ids), 2)
-                images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
+                # the rollouts need one tensor per row: pad the ragged tiles to the most tiles of the batch
+                images = pad_ragged_images(images, batch["image_num_tiles"])
+                aspect_ratio_ids = None
+                aspect_ratio_mask = None
                 
                 original_images = images[:, 0, :, :]
 
@@ -605,31 +815,89 @@ def main():
                 image_sizes = None
                 aspect_ratio_ids = None
                 aspect_ratio_mask = None
+
+            if args.group_size > 1:
+                # sample group_size responses for each prompt
+                input_ids, attention_mask, images, image_sizes, aspect_ratio_ids, aspect_ratio_mask = repeat_for_group(
+                    args.group_size, input_ids, attention_mask, images, image_sizes, aspect_ratio_ids, aspect_ratio_mask)
+                batch["image_num"] = [n for n in batch["image_num"] for _ in range(args.group_size)]
+                if args.model_architecture == "llava_next":
+                    original_images = images[:, 0, :, :]
             
+            # the vision tower runs once for the images of this step and each distinct frozen tower
+            if vision_feature_cache is not None:
+                vision_feature_cache.clear()
+            actor_vision_features = get_vision_features(rlhf_engine.actor, images, image_sizes, vision_feature_cache)
+
             # Step 1: sampling candidate answers
-            if args.model_architecture in ["llava", "llava_next"]:
-                sampling_ans = sampling_llava(rlhf_engine.actor, 
-                                images, input_ids,
-                                image_sizes=image_sizes,
-                                attention_mask=attention_mask, 
-                                pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
-                                max_new_tokens=args.max_generation_length_of_sampling, 
-                                processor=rlhf_engine.actor_tokenizer_new)
-            elif args.model_architecture in ["llama-3.2-vision"]:
-                sampling_ans = sampling_llama(rlhf_engine.actor, 
-                                images, input_ids,
-                                aspect_ratio_ids=aspect_ratio_ids,
-                                aspect_ratio_mask=aspect_ratio_mask,
-                                attention_mask=attention_mask, 
-                                pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
-                                max_new_tokens=args.max_generation_length_of_sampling, 
-                                processor=rlhf_engine.actor_tokenizer_new)
-            else:
-                sampling_ans = sampling(rlhf_engine.actor, 
-                                        images, input_ids, 
-                                        attention_mask=attention_mask, 
-                                        pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
-                                        max_new_tokens=args.max_generation_length_of_sampling)
+            max_new_tokens = args.max_generation_length_of_sampling
+            if max_new_tokens_scheduler is not None:
+                max_new_tokens = max_new_tokens_scheduler.max_new_tokens()
+            # the LoRA weights are fused for generation and unfused before the training forward
+            with lora_fused(rlhf_engine.actor):
+                if rollout_engine is not None:
+                    sampling_ans = rollout_engine.generate(images, input_ids, attention_mask,
+                                    image_sizes=image_sizes,
+                                    group_size=args.group_size,
+                                    return_logprobs=args.reuse_generation_logprobs,
+                                    vision_features=actor_vision_features,
+                                    max_new_tokens=max_new_tokens)
+                elif draft_model is not None:
+                    sampling_ans = speculative_sampling_llava(rlhf_engine.actor, draft_model,
+                                    images, input_ids,
+                                    image_sizes=image_sizes,
+                                    attention_mask=attention_mask,
+                                    pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
+                                    max_new_tokens=max_new_tokens,
+                                    processor=rlhf_engine.actor_tokenizer_new,
+                                    return_logprobs=args.reuse_generation_logprobs,
+                                    vision_features=actor_vision_features,
+                                    stop_sequences=stop_sequences,
+                                    num_draft_tokens=args.num_draft_tokens,
+                                    synced_gpus=args.actor_zero_stage == 3)
+                elif args.group_size > 1 and args.model_architecture in ["llava", "llava_next"]:
+                    # one vision/prompt prefill per prompt, the kv cache is forked group_size ways for decoding
+                    sampling_ans = group_sampling_llava(rlhf_engine.actor,
+                                    images, input_ids,
+                                    args.group_size,
+                                    image_sizes=image_sizes,
+                                    attention_mask=attention_mask,
+                                    pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
+                                    max_new_tokens=max_new_tokens,
+                                    processor=rlhf_engine.actor_tokenizer_new,
+                                    return_logprobs=args.reuse_generation_logprobs,
+                                    vision_features=actor_vision_features,
+                                    stop_sequences=stop_sequences,
+                                    synced_gpus=args.actor_zero_stage == 3)
+                elif args.model_architecture in ["llava", "llava_next"]:
+                    sampling_ans = sampling_llava(rlhf_engine.actor, 
+                                    images, input_ids,
+                                    image_sizes=image_sizes,
+                                    attention_mask=attention_mask, 
+                                    pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
+                                    max_new_tokens=max_new_tokens, 
+                                    processor=rlhf_engine.actor_tokenizer_new,
+                                    return_logprobs=args.reuse_generation_logprobs,
+                                    vision_features=actor_vision_features,
+                                    stop_sequences=stop_sequences)
+                elif args.model_architecture in ["llama-3.2-vision"]:
+                    sampling_ans = sampling_llama(rlhf_engine.actor, 
+                                    images, input_ids,
+                                    aspect_ratio_ids=aspect_ratio_ids,
+                                    aspect_ratio_mask=aspect_ratio_mask,
+                                    attention_mask=attention_mask, 
+                                    pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
+                                    max_new_tokens=max_new_tokens, 
+                                    processor=rlhf_engine.actor_tokenizer_new,
+                                    stop_sequences=stop_sequences)
+                else:
+                    sampling_ans = sampling(rlhf_engine.actor, 
+                                            images, input_ids, 
+                                            attention_mask=attention_mask, 
+                                            pad_token_id=rlhf_engine.actor_tokenizer_new.pad_token_id,
+                                            max_new_tokens=max_new_tokens)
+            if max_new_tokens_scheduler is not None:
+                max_new_tokens_scheduler.update(torch.tensor([len(ans[0]) for ans in sampling_ans], device=device))
             # print(sampling_ans)
             # len(sampling_ans[0][1])
             # Step 2: computing reward scores
@@ -652,31 +920,42 @@ def main():
             rlhf_engine.critic_tokenizer_new.decode(input_ids[0])
 
             with torch.no_grad():
-                if args.reward_model_architecture == "llava":
-                    reward_scores = rlhf_engine.reward.forward_value(original_images,
-                                        reward_input_id,
-                                        attention_mask=reward_attention_mask,
-                                        input_labels=reward_input_id,   # not need to mask the prompt
-                                        image_num=batch["image_num"]
-                                    )["chosen_end_scores"]
+                reward_score_keys, reward_scores = None, None
+                if reward_score_cache is not None:
+                    reward_score_keys, reward_scores = lookup_reward_scores(
+                        reward_score_cache, reward_fingerprint, reward_input_id, reward_attention_mask,
+                        images, image_sizes, aspect_ratio_ids, aspect_ratio_mask)
+                if reward_scores is None:
+                    if args.reward_model_architecture == "llava":
+                        reward_scores = rlhf_engine.reward.forward_value(original_images,
+                                            reward_input_id,
+                                            attention_mask=reward_attention_mask,
+                                            input_labels=reward_input_id,   # not need to mask the prompt
+                                            image_num=batch["image_num"],
+                                            vision_features=get_vision_features(rlhf_engine.reward, original_images,
+                                                                                cache=vision_feature_cache)
+                                        )["chosen_end_scores"]
                 
-                elif args.reward_model_architecture == "llava_next":
-                    reward_scores = rlhf_engine.reward.forward_value(images,
-                                        reward_input_id,
-                                        attention_mask=reward_attention_mask,
-                                        input_labels=reward_input_id,   # not need to mask the prompt
-                                        image_num=batch["image_num"]
-                                    )["chosen_end_scores"]
+                    elif args.reward_model_architecture == "llava_next":
+                        reward_scores = rlhf_engine.reward.forward_value(images,
+                                            reward_input_id,
+                                            attention_mask=reward_attention_mask,
+                                            input_labels=reward_input_id,   # not need to mask the prompt
+                                            image_num=batch["image_num"]
+                                        )["chosen_end_scores"]
+
+                    elif args.reward_model_architecture in ["llama-3.2-vision"]:
+                        reward_scores = rlhf_engine.reward.forward_value(images,
+                                            reward_input_id,
+                                            aspect_ratio_ids=aspect_ratio_ids,
+                                            aspect_ratio_mask=aspect_ratio_mask,
+                                            attention_mask=reward_attention_mask,
+                                            input_labels=reward_input_id,   # not need to mask the prompt
+                                            image_num=batch["image_num"]
+                                        )["chosen_end_scores"]
 
-                elif args.reward_model_architecture in ["llama-3.2-vision"]:
-                    reward_scores = rlhf_engine.reward.forward_value(images,
-                                        reward_input_id,
-                                        aspect_ratio_ids=aspect_ratio_ids,
-                                        aspect_ratio_mask=aspect_ratio_mask,
-                                        attention_mask=reward_attention_mask,
-                                        input_labels=reward_input_id,   # not need to mask the prompt
-                                        image_num=batch["image_num"]
-                                    )["chosen_end_scores"]
+                    if reward_score_keys is not None:
+                        reward_score_cache.put_many(reward_score_keys, reward_scores.float().tolist())
 
             # employ reward queue for standardising reward scores.
             # (x - mean) / std
@@ -690,12 +969,11 @@ def main():
             else:
                 critic_ids = [torch.cat((input_ids[index], sampling_ans[index][0][0]), dim=-1)
                     for index in range(len(input_ids))]
-            # pading thie critic_ids
-            reversed_sequences = [torch.flip(ids, dims=[0]) for ids in critic_ids]
-            reversed_critic_input_ids = pad_sequence(reversed_sequences, 
+            # pading thie critic_ids: the prompts are left-padded to the same length, the responses are right-padded,
+            # so that the response of every row starts at `start`
+            critic_input_ids = pad_sequence(critic_ids, 
                                         padding_value=rlhf_engine.actor_tokenizer_new.pad_token_id, 
                                         batch_first=True)
-            critic_input_ids = torch.flip(reversed_critic_input_ids, dims=[1])
 
             label_ids = []
             for index in range(reward_input_id.size()[0]):
@@ -710,8 +988,17 @@ def main():
 
             action_attention_mask = critic_attention_mask[:, 1:]
 
-            # compute logprobs and ref_logprobs
-            logprobs, ref_logprobs = compute_logprobs_from_actor_and_ref(actor_model=rlhf_engine.actor,
+            # the log-probs collected while sampling replace the actor forward, except on the check steps
+            generation_logprobs = None
+            check_generation_logprobs = False
+            if args.reuse_generation_logprobs:
+                generation_logprobs, response_mask = align_generation_logprobs(
+                    sampling_ans, input_ids.size(1), critic_input_ids.size(1))
+                check_generation_logprobs = args.generation_logprobs_check_interval > 0 and \
+                    global_step % args.generation_logprobs_check_interval == 0
+
+            # compute logprobs and ref_logprobs (and the values of the shared value head)
+            logprobs_outputs = compute_logprobs_from_actor_and_ref(actor_model=rlhf_engine.actor,
                                     ref_model=rlhf_engine.ref,
                                     images=images,
                                     input_ids=critic_input_ids,
@@ -719,20 +1006,44 @@ def main():
                                     attention_mask=critic_attention_mask,
                                     image_num=batch["image_num"],
                                     image_sizes = image_sizes,
-                                    model_architecture=args.model_architecture)
+                                    model_architecture=args.model_architecture,
+                                    return_values=args.shared_critic,
+                                    actor_logprobs=None if check_generation_logprobs else generation_logprobs,
+                                    vision_feature_cache=vision_feature_cache)
+            if args.shared_critic:
+                logprobs, ref_logprobs, old_values = logprobs_outputs
+            else:
+                logprobs, ref_logprobs = logprobs_outputs
+
+            if check_generation_logprobs:
+                # the recomputed log-probs are used on this step
+                logprobs_diff = ((generation_logprobs - logprobs).abs() * response_mask).sum() / response_mask.sum().clamp(min=1)
+                logprobs_diff = get_all_reduce_mean(logprobs_diff).item()
+                print_rank_0(f"mean absolute difference of the generation and the recomputed log-probs: {logprobs_diff}",
+                             args.global_rank)
+                if logprobs_diff > args.generation_logprobs_tolerance:
+                    print_rank_0(f"WARNING: the difference is larger than {args.generation_logprobs_tolerance}, "
+                                 "recompute the log-probs from now on", args.global_rank)
+                    args.reuse_generation_logprobs = False
+            elif generation_logprobs is not None:
+                # no KL outside the responses (e.g., the position after the last token)
+                logprobs = torch.where(response_mask, logprobs, ref_logprobs)
             
             # Step 4: compute advantages and returns
             # compute the values
-            with torch.no_grad():
-                old_values = rlhf_engine.critic.forward_value(images,
-                                                critic_input_ids,
-                                                image_sizes=image_sizes,
-                                                aspect_ratio_ids=aspect_ratio_ids,
-                                                aspect_ratio_mask=aspect_ratio_mask,
-                                                attention_mask=critic_attention_mask,
-                                                input_labels=critic_input_ids,
-                                                image_num=batch["image_num"]
-                                            )["values"]
+            if rlhf_engine.critic is not None:
+                with torch.no_grad():
+                    old_values = rlhf_engine.critic.forward_value(images,
+                                                    critic_input_ids,
+                                                    image_sizes=image_sizes,
+                                                    aspect_ratio_ids=aspect_ratio_ids,
+                                                    aspect_ratio_mask=aspect_ratio_mask,
+                                                    attention_mask=critic_attention_mask,
+                                                    input_labels=critic_input_ids,
+                                                    image_num=batch["image_num"],
+                                                    vision_features=get_vision_features(rlhf_engine.critic, images, image_sizes,
+                                                                                        vision_feature_cache)
+                                                )["values"]
             
             # run ppo training. 
             # Note that we first implement the case of a minibatch equal to the training batch.
@@ -757,14 +1068,16 @@ def main():
                                                 image_sizes = image_sizes,
                                                 attention_mask=critic_attention_mask,
                                                 labels=critic_label_ids,
-                                                output_hidden_states=True).logits_drop_image
+                                                output_hidden_states=True,
+                                                vision_features=actor_vision_features).logits_drop_image
                             else:
                                 actor_logits = rlhf_engine.actor(
                                                 input_ids=critic_input_ids,
                                                 pixel_values = images,
                                                 attention_mask=critic_attention_mask,
                                                 labels=critic_label_ids,
-                                                output_hidden_states=True).logits_drop_image
+                                                output_hidden_states=True,
+                                                vision_features=actor_vision_features).logits_drop_image
                         elif args.model_architecture in ["llama-3.2-vision"]:
                             actor_logits = rlhf_engine.actor(
                                                 input_ids=critic_input_ids,
@@ -791,45 +1104,57 @@ def main():
 
                 for i in range(kl_reward_scores.shape[0]):
                     kl_reward_scores[i, ends[i]:] = 0
-                    old_values[i, ends[i]:] = 0
-
-                advantages, returns = get_advantages_and_returns(values=old_values, 
-                                                    rewards=kl_reward_scores, 
-                                                    start=start)
+                    if args.advantage_estimator == "gae":
+                        old_values[i, ends[i]:] = 0
+
+                if args.advantage_estimator != "gae":
+                    # critic-free: the sequence return (reward + KL penalties) is compared within the group
+                    # of responses of the same prompt, and the advantage is shared by all tokens of the response
+                    sequence_advantages = get_group_advantages(kl_reward_scores[:, start:].sum(-1),
+                                                               args.group_size,
+                                                               estimator=args.advantage_estimator)
+                    advantages = sequence_advantages[:, None].to(kl_reward_scores.dtype) * action_attention_mask[:, start:]
+                else:
+                    advantages, returns = get_advantages_and_returns(values=old_values, 
+                                                        rewards=kl_reward_scores, 
+                                                        start=start)
                 
-                # Step 5: update the actor and critic models
-                # update critic model
-                values = rlhf_engine.critic.forward_value(images,
-                                                    critic_input_ids,
-                                                    image_sizes=image_sizes,
-                                                    aspect_ratio_ids=aspect_ratio_ids,
-                                                    aspect_ratio_mask=aspect_ratio_mask,
-                                                    attention_mask=critic_attention_mask,
-                                                    input_labels=critic_input_ids,
-                                                    image_num=batch["image_num"]
-                                                )["values"]
-
-                critic_loss = critic_loss_fn(values=values[:, start:], 
-                                            old_values=old_values[:,start:],
-                                            returns=returns, 
-                                            mask=action_attention_mask[:, start:])
-
-                rlhf_engine.critic.backward(critic_loss)
-                # judge only_update_critic_model
-                if only_update_critic_model:
-                    critic_loss_log += critic_loss
-                    kl_distance_log += kl_distance
-
-                    critic_loss_log = get_all_reduce_mean(critic_loss_log).item()
-                    kl_distance_log = get_all_reduce_mean(kl_distance_log).item()
-
-                    rlhf_engine.critic.step()
-
-                    # update stuatus
-                    if global_step>args.skip_actor_model:
-                        only_update_critic_model = False
-
-                    continue
+                    # Step 5: update the actor and critic models
+                    # update critic model (the shared value head is updated with the actor)
+                    if rlhf_engine.critic is not None:
+                        values = rlhf_engine.critic.forward_value(images,
+                                                            critic_input_ids,
+                                                            image_sizes=image_sizes,
+                                                            aspect_ratio_ids=aspect_ratio_ids,
+                                                            aspect_ratio_mask=aspect_ratio_mask,
+                                                            attention_mask=critic_attention_mask,
+                                                            input_labels=critic_input_ids,
+                                                            image_num=batch["image_num"],
+                                                            vision_features=get_vision_features(rlhf_engine.critic, images, image_sizes,
+                                                                                                vision_feature_cache)
+                                                        )["values"]
+
+                        critic_loss = critic_loss_fn(values=values[:, start:], 
+                                                    old_values=old_values[:,start:],
+                                                    returns=returns, 
+                                                    mask=action_attention_mask[:, start:])
+
+                        rlhf_engine.critic.backward(critic_loss)
+                        # judge only_update_critic_model
+                        if only_update_critic_model:
+                            critic_loss_log += critic_loss
+                            kl_distance_log += kl_distance
+
+                            critic_loss_log = get_all_reduce_mean(critic_loss_log).item()
+                            kl_distance_log = get_all_reduce_mean(kl_distance_log).item()
+
+                            rlhf_engine.critic.step()
+
+                            # update stuatus
+                            if global_step>args.skip_actor_model:
+                                only_update_critic_model = False
+
+                            continue
 
                 # update actor model
                 if args.model_architecture == "default":
@@ -841,20 +1166,23 @@ def main():
                                             )[1]
                 elif args.model_architecture in ["llava", "llava_next"]:
                     if image_sizes is not None:
-                        actor_logits = rlhf_engine.actor(
+                        actor_outputs = rlhf_engine.actor(
                                     input_ids=critic_input_ids,
                                     pixel_values = images,
                                     image_sizes = image_sizes,
                                     attention_mask=critic_attention_mask,
                                     labels=critic_label_ids,
-                                    output_hidden_states=True).logits_drop_image
+                                    output_hidden_states=True,
+                                    vision_features=actor_vision_features)
                     else:
-                        actor_logits = rlhf_engine.actor(
+                        actor_outputs = rlhf_engine.actor(
                                         input_ids=critic_input_ids,
                                         pixel_values = images,
                                         attention_mask=critic_attention_mask,
                                         labels=critic_label_ids,
-                                        output_hidden_states=True).logits_drop_image
+                                        output_hidden_states=True,
+                                        vision_features=actor_vision_features)
+                    actor_logits = actor_outputs.logits_drop_image
                 elif args.model_architecture in ["llama-3.2-vision"]:
                     actor_logits = rlhf_engine.actor(
                                     input_ids=critic_input_ids,
@@ -871,7 +1199,16 @@ def main():
                                         old_logprobs=logprobs[:, start:], 
                                         advantages=advantages,
                                         mask=action_attention_mask[:, start:])
-                rlhf_engine.actor.backward(actor_loss)
+                if args.shared_critic:
+                    # the values come from the same actor forward as the log-probs
+                    values = compute_values(rlhf_engine.actor, actor_outputs, args.value_head_gradient)
+                    critic_loss = critic_loss_fn(values=values[:, start:],
+                                                old_values=old_values[:, start:],
+                                                returns=returns,
+                                                mask=action_attention_mask[:, start:])
+                    rlhf_engine.actor.backward(actor_loss + args.value_loss_coef * critic_loss)
+                else:
+                    rlhf_engine.actor.backward(actor_loss)
 
                 if not args.align_overflow:
                     rlhf_engine.actor.step()
@@ -899,14 +1236,16 @@ def main():
                             rank)
                     rlhf_engine.actor.step()
 
-                rlhf_engine.critic.step()
+                if rlhf_engine.critic is not None:
+                    rlhf_engine.critic.step()
+                if args.advantage_estimator == "gae":
+                    critic_loss_log += critic_loss
+                    critic_loss_log = get_all_reduce_mean(critic_loss_log).item()
             
                 actor_loss_log += actor_loss
-                critic_loss_log += critic_loss
                 kl_distance_log += kl_distance
 
                 actor_loss_log = get_all_reduce_mean(actor_loss_log).item()
-                critic_loss_log = get_all_reduce_mean(critic_loss_log).item()
                 kl_distance_log = get_all_reduce_mean(kl_distance_log).item()
 
             print_rank_0(
@@ -914,6 +1253,11 @@ def main():
                 f'Critic Loss:{critic_loss_log/args.ppo_epochs}, Reward Score: {reward_scores.mean()}, '+ \
                 f'KL Distance: {kl_distance_log/args.ppo_epochs}', 
                 args.global_rank)
+            if reward_score_cache is not None:
+                cache_stats = reward_score_cache.stats()
+                print_rank_0(f"reward score cache: hit rate {cache_stats['hit_rate']:.3f} ({cache_stats['hits']} hits, "
+                             f"{cache_stats['misses']} misses), {cache_stats['entries']} entries "
+                             f"({cache_stats['size_mb']:.1f} MB), {cache_stats['evictions']} evictions", args.global_rank)
 
             global_step += 1
             if global_step % args.save_step == 0:
@@ -927,16 +1271,20 @@ def main():
                                         args.global_rank,
                                         args.output_dir,
                                         zero_stage=args.zero_stage, 
-                                        sub_folder=f'epoch-{epoch}-step-{global_step}')
+                                        sub_folder=f'epoch-{epoch}-step-{global_step}',
+                                        exclude_value_head=args.shared_critic)
                 if args.actor_zero_stage in [1,2]:
                     # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
                     model_to_save = model.module if hasattr(model,
                                                             'module') else model
-                    lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+                    lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
                     os.makedirs(f'{args.output_dir}/epoch-{epoch}-step-{global_step}', exist_ok=True)
                     WEIGHTS_NAME = "pytorch_model.bin"
                     output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}-step-{global_step}', WEIGHTS_NAME)
+                    if args.shared_critic:
+                        lean_state_dict = split_value_head(lean_state_dict, os.path.dirname(output_model_file))
                     torch.save(lean_state_dict, output_model_file)
+                    save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
             
             if global_step % args.eval_step == 0:
                 evaluation(eval_dataloader)
@@ -956,16 +1304,20 @@ def main():
                                 args.global_rank,
                                 args.output_dir,
                                 zero_stage=args.zero_stage, 
-                                sub_folder=f'epoch-{epoch}')
+                                sub_folder=f'epoch-{epoch}',
+                                exclude_value_head=args.shared_critic)
         if args.actor_zero_stage in [1,2]:
             # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
             model_to_save = model.module if hasattr(model,
                                                     'module') else model
-            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
             os.makedirs(f'{args.output_dir}/epoch-{epoch}', exist_ok=True)
             WEIGHTS_NAME = "pytorch_model.bin"
             output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}', WEIGHTS_NAME)
+            if args.shared_critic:
+                lean_state_dict = split_value_head(lean_state_dict, os.path.dirname(output_model_file))
             torch.save(lean_state_dict, output_model_file)
+            save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
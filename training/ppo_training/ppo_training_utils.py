@@ -1,6 +1,66 @@
+import math
+from collections import deque
+
+import numpy as np
 import torch
 import torch.nn.functional as F
 
+import os
+import sys
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from utils.utils import expand_past_key_values, crop_past_key_values, all_ranks_done
+from utils.module.lora import lora_disabled
+from utils.model.vision_feature import unwrap_model, get_vision_features
+
+
+class StopSequenceChecker:
+    # whether the sampled tokens end with one of the stop sequences of the template, however they are tokenized
+
+    def __init__(self, stop_sequences, tokenizer):
+        self.stop_sequences = stop_sequences or []
+        self.tokenizer = tokenizer
+        # enough tokens to hold the longest stop sequence
+        self.window = 2 * max([len(tokenizer.encode(stop, add_special_tokens=False)) for stop in self.stop_sequences] + [0]) + 2
+
+    def __call__(self, tokens):
+        if len(self.stop_sequences) == 0:
+            return False
+        tail = self.tokenizer.decode(tokens[-self.window:], skip_special_tokens=False)
+        return any(stop in tail for stop in self.stop_sequences)
+
+def truncate_at_stop_sequences(text, stop_sequences):
+    # the answer before the first stop sequence (the stop tokens are kept in the response ids, as the eos token)
+    positions = [text.find(stop) for stop in (stop_sequences or []) if stop in text]
+    return text[:min(positions)] if len(positions) > 0 else text
+
+class MaxNewTokensScheduler:
+    """
+    Cap the new tokens of the rollouts at a high percentile of the recent response lengths plus a margin, never above
+    `max_new_tokens`. The lengths are gathered from all ranks, so that every rank uses the same cap. The responses cut
+    by the cap count at the cap, the margin lets the cap grow back when many responses reach it.
+    """
+
+    def __init__(self, max_new_tokens, percentile=95.0, margin=0.2, window=1024, warmup=64):
+        self.max_tokens = max_new_tokens
+        self.percentile = percentile
+        self.margin = margin
+        self.warmup = min(warmup, window)
+        self.lengths = deque(maxlen=window)
+
+    def update(self, lengths):
+        # lengths: the [batch] response lengths of this rank
+        if torch.distributed.is_initialized():
+            all_lengths = [torch.zeros_like(lengths) for _ in range(torch.distributed.get_world_size())]
+            torch.distributed.all_gather(all_lengths, lengths)
+            lengths = torch.cat(all_lengths)
+        self.lengths.extend(lengths.tolist())
+
+    def max_new_tokens(self):
+        if len(self.lengths) < self.warmup:
+            return self.max_tokens
+        cap = math.ceil(np.percentile(self.lengths, self.percentile) * (1 + self.margin))
+        return int(min(self.max_tokens, max(1, cap)))
 
 def sampling(actor_model,
             img, lang, 
@@ -58,7 +118,13 @@ def sampling_llava(actor_model,
             max_new_tokens=384,
             num_return_sequences=1,
             temperature=0.75,
-            processor=None):
+            processor=None,
+            return_logprobs=False,
+            vision_features=None,
+            stop_sequences=None):
+    # return_logprobs: also return the log-probs (of the raw logits) of the sampled tokens, collected while decoding
+    # vision_features: the precomputed vision tower features of `img`, see compute_vision_features
+    # stop_sequences: stop the response at these strings (e.g., DST.get_stop_sequences(template)) besides the eos token
     
     generation_kwargs={
         "top_k": topk,
@@ -68,6 +134,8 @@ def sampling_llava(actor_model,
         "num_return_sequences": num_return_sequences,
         "temperature": temperature
     }
+    if stop_sequences:
+        generation_kwargs.update(stop_strings=stop_sequences, tokenizer=processor)
     max_new_tokens = generation_kwargs["max_new_tokens"]
     generation_kwargs.pop("max_new_tokens")
 
@@ -84,21 +152,381 @@ def sampling_llava(actor_model,
         
         sub_attention_mask = attention_mask[index]
         sub_lang = lang[index][sum(sub_attention_mask==pad_token_id):].unsqueeze(0)
+        feature_inputs = {}
+        if vision_features is not None and img.size()[0] == batch_size:
+            feature_inputs.update(vision_features=vision_features[index:index + 1])
         
+        if return_logprobs:
+            image_inputs = dict(pixel_values=sub_img, **feature_inputs)
+            if image_sizes is not None:
+                image_inputs.update(image_sizes=image_sizes[index].unsqueeze(0))
+            outputs = actor_model.generate(input_ids=sub_lang, max_new_tokens=max_new_tokens,
+                                           return_dict_in_generate=True, output_logits=True,
+                                           **image_inputs, **generation_kwargs)
+            res = outputs.sequences[0][sub_lang.shape[1]:]
+            logits = torch.stack(outputs.logits, dim=1)[0, :len(res)]
+            res_text = truncate_at_stop_sequences(processor.decode(res, skip_special_tokens=True), stop_sequences)
+            all_res.append([res, res_text, gather_log_probs(logits.float(), res)])
+            continue
+
         if sub_img == [None]:
             res = actor_model.generate(input_ids=sub_lang, max_new_tokens=max_new_tokens, **generation_kwargs)[0][lang.shape[1]:]
         else:
             if image_sizes is not None:
                 sub_image_sizes = image_sizes[index].unsqueeze(0)
                 res = actor_model.generate(pixel_values=sub_img, input_ids=sub_lang, 
-                                           image_sizes=sub_image_sizes, max_new_tokens=max_new_tokens, **generation_kwargs)[0][sub_lang.shape[1]:]
+                                           image_sizes=sub_image_sizes, max_new_tokens=max_new_tokens,
+                                           **feature_inputs, **generation_kwargs)[0][sub_lang.shape[1]:]
             else:
-                res = actor_model.generate(pixel_values=sub_img, input_ids=sub_lang, max_new_tokens=max_new_tokens, **generation_kwargs)[0][sub_lang.shape[1]:]
-        res_text = processor.decode(res, skip_special_tokens=True)       
+                res = actor_model.generate(pixel_values=sub_img, input_ids=sub_lang, max_new_tokens=max_new_tokens,
+                                           **feature_inputs, **generation_kwargs)[0][sub_lang.shape[1]:]
+        res_text = truncate_at_stop_sequences(processor.decode(res, skip_special_tokens=True), stop_sequences)
+        all_res.append([res, res_text])
+    actor_model.train()
+    return all_res
+
+def batch_sampling_llava(actor_model,
+            img, lang,
+            image_sizes = None,
+            attention_mask=None,
+            pad_token_id=0,
+            topk=50,
+            topp=0.95,
+            do_sample=True,
+            max_new_tokens=384,
+            num_return_sequences=1,
+            temperature=0.75,
+            processor=None,
+            stop_sequences=None):
+    """
+    Sample one response for every (left-padded) prompt of the batch with a single generate call, instead of one
+    call per prompt as sampling_llava. `img` is None for a batch without images. Return the same format as
+    sampling_llava, each response is cut after its eos token (the finished rows are padded by generate).
+    """
+    generation_kwargs={
+        "top_k": topk,
+        "top_p": topp,
+        "do_sample": do_sample,
+        "temperature": temperature
+    }
+    if stop_sequences:
+        generation_kwargs.update(stop_strings=stop_sequences, tokenizer=processor)
+    image_inputs = {}
+    if img is not None:
+        image_inputs.update(pixel_values=img)
+        if image_sizes is not None:
+            image_inputs.update(image_sizes=image_sizes)
+
+    actor_model.eval()
+    outputs = actor_model.generate(input_ids=lang, attention_mask=attention_mask, max_new_tokens=max_new_tokens,
+                                   pad_token_id=pad_token_id, **image_inputs, **generation_kwargs)
+    all_res = []
+    for res in outputs[:, lang.shape[1]:]:
+        eos_positions = torch.where(res == processor.eos_token_id)[0]
+        if len(eos_positions) > 0:
+            res = res[:eos_positions[0] + 1]
+        else:
+            # a row stopped at a stop sequence is padded up to the longest row
+            not_pad = torch.where(res != pad_token_id)[0]
+            res = res[:not_pad[-1] + 1] if len(not_pad) > 0 else res[:0]
+        res_text = truncate_at_stop_sequences(processor.decode(res, skip_special_tokens=True), stop_sequences)
         all_res.append([res, res_text])
     actor_model.train()
     return all_res
 
+def warp_logits(logits, topk=50, topp=0.95, temperature=0.75):
+    # temperature, top-k and top-p (nucleus) filtering of the last-position logits of shape (batch, vocab)
+    logits = logits.float() / temperature
+    if topk > 0:
+        kth_logits = torch.topk(logits, min(topk, logits.size(-1)), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_logits, float("-inf"))
+    if topp < 1.0:
+        sorted_logits, sorted_index = torch.sort(logits, descending=True, dim=-1)
+        cumulative_probs = sorted_logits.softmax(-1).cumsum(-1)
+        # keep the smallest set of tokens whose probability reaches topp (at least one token)
+        sorted_remove = cumulative_probs - sorted_logits.softmax(-1) > topp
+        remove = torch.zeros_like(sorted_remove).scatter(-1, sorted_index, sorted_remove)
+        logits = logits.masked_fill(remove, float("-inf"))
+    return logits
+
+def sample_next_token(logits, topk=50, topp=0.95, do_sample=True, temperature=0.75):
+    # top-k / top-p (nucleus) sampling over the last-position logits of shape (batch, vocab)
+    if not do_sample:
+        return logits.argmax(-1)
+    return torch.multinomial(warp_logits(logits, topk, topp, temperature).softmax(-1), num_samples=1).squeeze(-1)
+
+def next_token_probs(logits, topk=50, topp=0.95, do_sample=True, temperature=0.75):
+    # the distribution that sample_next_token draws from, one-hot for greedy decoding
+    if not do_sample:
+        return F.one_hot(logits.argmax(-1), logits.size(-1)).float()
+    return warp_logits(logits, topk, topp, temperature).softmax(-1)
+
+def group_sampling_llava(actor_model,
+            img, lang,
+            group_size,
+            image_sizes = None,
+            attention_mask=None,
+            pad_token_id=0,
+            topk=50,
+            topp=0.95,
+            do_sample=True,
+            max_new_tokens=384,
+            temperature=0.75,
+            processor=None,
+            return_logprobs=False,
+            vision_features=None,
+            stop_sequences=None,
+            synced_gpus=False):
+    """
+    Sample group_size responses for each prompt. The inputs are already repeated group_size times (the rows of a
+    group are consecutive and identical). The vision tower and the prompt prefill run once for the first row of
+    each group, then the kv cache is forked group_size ways and the responses are decoded together.
+    Return the same format as sampling_llava: [[response_ids, response_text], ...] in the row order of the inputs,
+    with the log-probs of the response tokens as the third element if return_logprobs. `vision_features` are the
+    precomputed vision tower features of `img` (see compute_vision_features). A response also ends at the
+    `stop_sequences` (see sampling_llava). With `synced_gpus` (the actor under ZeRO-3) the ranks decode until all of
+    them are done, the finished rows are fed pad tokens.
+    """
+    batch_size = lang.size()[0]
+    eos_token_id = processor.eos_token_id
+    stop_checker = StopSequenceChecker(stop_sequences, processor)
+
+    all_res = []
+
+    actor_model.eval()
+    with torch.no_grad():
+        for index in range(0, batch_size, group_size):
+            sub_attention_mask = attention_mask[index]
+            sub_lang = lang[index][sum(sub_attention_mask==pad_token_id):].unsqueeze(0)
+            prefill_inputs = dict(input_ids=sub_lang,
+                                  pixel_values=img[index].unsqueeze(0),
+                                  attention_mask=torch.ones_like(sub_lang),
+                                  use_cache=True,
+                                  return_dict=True)
+            if image_sizes is not None:
+                prefill_inputs.update(image_sizes=image_sizes[index].unsqueeze(0))
+            if vision_features is not None:
+                prefill_inputs.update(vision_features=vision_features[index:index + 1])
+            # 1. prefill once per prompt
+            outputs = actor_model(**prefill_inputs)
+
+            # 2. fork the kv cache group_size ways
+            fork_index = torch.zeros(group_size, dtype=torch.long, device=sub_lang.device)
+            past_key_values = expand_past_key_values(outputs.past_key_values, fork_index)
+            group_attention_mask = outputs.attention_mask[fork_index]
+            next_logits = outputs.logits[:, -1, :][fork_index]
+
+            # 3. decode the group together
+            responses = []
+            response_logprobs = []
+            finished = torch.zeros(group_size, dtype=torch.bool, device=sub_lang.device)
+            # the length of the responses that end at a stop sequence
+            stop_lens = [None] * group_size
+            group_tokens = [[] for _ in range(group_size)]
+            for step in range(max_new_tokens):
+                next_tokens = sample_next_token(next_logits, topk=topk, topp=topp,
+                                                do_sample=do_sample, temperature=temperature)
+                next_tokens = next_tokens.masked_fill(finished, pad_token_id)
+                responses.append(next_tokens)
+                if return_logprobs:
+                    response_logprobs.append(gather_log_probs(next_logits.float(), next_tokens))
+                finished = finished | (next_tokens == eos_token_id)
+                if len(stop_checker.stop_sequences) > 0:
+                    for group_index, (token, is_finished) in enumerate(zip(next_tokens.tolist(), finished.tolist())):
+                        group_tokens[group_index].append(token)
+                        if not is_finished and stop_checker(group_tokens[group_index]):
+                            stop_lens[group_index] = step + 1
+                            finished[group_index] = True
+                done = bool(finished.all())
+                if synced_gpus:
+                    done = all_ranks_done(done, sub_lang.device)
+                if done:
+                    break
+                group_attention_mask = torch.cat([group_attention_mask, torch.ones_like(group_attention_mask[:, :1])], dim=-1)
+                outputs = actor_model(input_ids=next_tokens[:, None],
+                                      attention_mask=group_attention_mask,
+                                      position_ids=group_attention_mask.long().sum(-1, keepdim=True) - 1,
+                                      past_key_values=past_key_values,
+                                      use_cache=True,
+                                      return_dict=True)
+                past_key_values = outputs.past_key_values
+                next_logits = outputs.logits[:, -1, :]
+
+            responses = torch.stack(responses, dim=1)
+            if return_logprobs:
+                response_logprobs = torch.stack(response_logprobs, dim=1)
+            for group_index, res in enumerate(responses):
+                # cut each response after its eos token (or stop sequence), as generate() does for a single sequence
+                eos_positions = torch.where(res == eos_token_id)[0]
+                if stop_lens[group_index] is not None:
+                    res = res[:stop_lens[group_index]]
+                elif len(eos_positions) > 0:
+                    res = res[:eos_positions[0] + 1]
+                res_text = truncate_at_stop_sequences(processor.decode(res, skip_special_tokens=True), stop_sequences)
+                if return_logprobs:
+                    all_res.append([res, res_text, response_logprobs[group_index, :len(res)]])
+                else:
+                    all_res.append([res, res_text])
+    actor_model.train()
+    return all_res
+
+def forward_with_cache(model, input_ids, past_key_values):
+    # run the new tokens [1, n] of a single (unpadded) sequence against its kv cache
+    past_len = past_key_values[0][0].size(-2)
+    attention_mask = torch.ones(1, past_len + input_ids.size(-1), dtype=torch.long, device=input_ids.device)
+    position_ids = torch.arange(past_len, past_len + input_ids.size(-1), device=input_ids.device)[None, :]
+    outputs = model(input_ids=input_ids,
+                    attention_mask=attention_mask,
+                    position_ids=position_ids,
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                    return_dict=True)
+    return outputs.logits[0], outputs.past_key_values
+
+def speculative_sampling_llava(actor_model,
+            draft_model,
+            img, lang,
+            image_sizes = None,
+            attention_mask=None,
+            pad_token_id=0,
+            topk=50,
+            topp=0.95,
+            do_sample=True,
+            max_new_tokens=384,
+            num_return_sequences=1,
+            temperature=0.75,
+            processor=None,
+            return_logprobs=False,
+            vision_features=None,
+            stop_sequences=None,
+            num_draft_tokens=4,
+            synced_gpus=False):
+    """
+    Speculative decoding: the draft model (a smaller llava / llava-next with the same tokenizer and image processor)
+    samples `num_draft_tokens` tokens, the actor scores them in one forward and keeps the longest accepted prefix,
+    plus one token of its own. A draft token x is accepted with probability min(1, p(x) / q(x)) and the first rejected
+    one is resampled from max(0, p - q), where p / q are the actor / draft distributions after the temperature, top-k
+    and top-p processing, so that the responses follow the distribution of the actor (the argmax of the actor
+    for greedy decoding). Return the same format as sampling_llava, `vision_features` only go to the actor.
+    With `synced_gpus` (the actor under ZeRO-3) every rank runs one actor forward per round until all of them are
+    done, the ranks that are done (or have nothing to verify) run a dummy one.
+    """
+    sampling_kwargs = dict(topk=topk, topp=topp, do_sample=do_sample, temperature=temperature)
+    batch_size = lang.size()[0]
+    eos_token_id = processor.eos_token_id
+    stop_checker = StopSequenceChecker(stop_sequences, processor)
+
+    all_res = []
+
+    actor_model.eval()
+    draft_model.eval()
+    with torch.no_grad():
+        for index in range(batch_size):
+            sub_attention_mask = attention_mask[index]
+            sub_lang = lang[index][sum(sub_attention_mask==pad_token_id):].unsqueeze(0)
+            prefill_inputs = dict(input_ids=sub_lang,
+                                  attention_mask=torch.ones_like(sub_lang),
+                                  use_cache=True,
+                                  return_dict=True)
+            if img.size()[0] == batch_size:
+                prefill_inputs.update(pixel_values=img[index].unsqueeze(0))
+            else:
+                prefill_inputs.update(pixel_values=img.unsqueeze(0))
+            if image_sizes is not None:
+                prefill_inputs.update(image_sizes=image_sizes[index].unsqueeze(0))
+            # 1. prefill both models, the first actor / draft distributions come from the prompt
+            draft_outputs = draft_model(**prefill_inputs)
+            if vision_features is not None and img.size()[0] == batch_size:
+                prefill_inputs.update(vision_features=vision_features[index:index + 1])
+            actor_outputs = actor_model(**prefill_inputs)
+            actor_past, actor_prompt_len = actor_outputs.past_key_values, actor_outputs.past_key_values[0][0].size(-2)
+            draft_past, draft_prompt_len = draft_outputs.past_key_values, draft_outputs.past_key_values[0][0].size(-2)
+            actor_prompt_logits = actor_outputs.logits[0, -1:]
+            draft_prompt_logits = draft_outputs.logits[0, -1:]
+
+            # the number of response tokens in the kv cache of each model, the others are fed in the next round
+            actor_cached, draft_cached = 0, 0
+            tokens = []
+            logprobs = []
+            finished = False
+            while True:
+                done = finished
+                if synced_gpus:
+                    done = all_ranks_done(done, sub_lang.device)
+                if done:
+                    break
+                if finished:
+                    forward_with_cache(actor_model, torch.tensor([[pad_token_id]], device=sub_lang.device), actor_past)
+                    continue
+                # 2. the draft proposes k tokens (one less than the remaining budget, the actor always adds one)
+                num_tokens = len(tokens)
+                k = min(num_draft_tokens, max_new_tokens - num_tokens - 1)
+                draft_tokens, draft_probs = [], []
+                draft_inputs = tokens[draft_cached:]
+                draft_logits = draft_prompt_logits
+                for _ in range(k):
+                    if len(draft_inputs) > 0:
+                        draft_logits, draft_past = forward_with_cache(
+                            draft_model, torch.tensor([draft_inputs], device=sub_lang.device), draft_past)
+                        draft_logits = draft_logits[-1:]
+                        draft_cached += len(draft_inputs)
+                    probs = next_token_probs(draft_logits, **sampling_kwargs)
+                    draft_tokens.append(torch.multinomial(probs, num_samples=1).item())
+                    draft_probs.append(probs)
+                    draft_inputs = draft_tokens[-1:]
+
+                # 3. the actor scores the pending tokens and the proposals in one forward
+                actor_inputs = tokens[actor_cached:] + draft_tokens
+                actor_logits = actor_prompt_logits if actor_cached == num_tokens else actor_prompt_logits[:0]
+                if len(actor_inputs) > 0:
+                    logits, actor_past = forward_with_cache(
+                        actor_model, torch.tensor([actor_inputs], device=sub_lang.device), actor_past)
+                    actor_logits = torch.cat([actor_logits, logits], dim=0)
+                    actor_cached += len(actor_inputs)
+                elif synced_gpus:
+                    forward_with_cache(actor_model, torch.tensor([[pad_token_id]], device=sub_lang.device), actor_past)
+                actor_probs = next_token_probs(actor_logits, **sampling_kwargs)
+
+                # 4. accept the longest prefix, then resample the first rejected token or add a bonus token
+                num_accepted = 0
+                for i, token in enumerate(draft_tokens):
+                    if torch.rand(1).item() >= (actor_probs[i, token] / draft_probs[i][0, token]).item():
+                        break
+                    num_accepted += 1
+                if num_accepted < k:
+                    residual = (actor_probs[num_accepted] - draft_probs[num_accepted][0]).clamp(min=0)
+                    if residual.sum() <= 0:
+                        residual = actor_probs[num_accepted]
+                    next_token = torch.multinomial(residual / residual.sum(), num_samples=1).item()
+                else:
+                    next_token = torch.multinomial(actor_probs[k], num_samples=1).item()
+                new_tokens = draft_tokens[:num_accepted] + [next_token]
+                if return_logprobs:
+                    new_logprobs = gather_log_probs(actor_logits[:len(new_tokens)].float(),
+                                                    torch.tensor(new_tokens, device=sub_lang.device)).tolist()
+                for i, token in enumerate(new_tokens):
+                    tokens.append(token)
+                    if return_logprobs:
+                        logprobs.append(new_logprobs[i])
+                    if token == eos_token_id or len(tokens) >= max_new_tokens or stop_checker(tokens):
+                        finished = True
+                        break
+
+                # 5. drop the cached keys / values of the rejected proposals
+                actor_cached = min(actor_cached, num_tokens + num_accepted)
+                draft_cached = min(draft_cached, num_tokens + num_accepted)
+                actor_past = crop_past_key_values(actor_past, actor_prompt_len + actor_cached)
+                draft_past = crop_past_key_values(draft_past, draft_prompt_len + draft_cached)
+
+            res = torch.tensor(tokens, dtype=torch.long, device=sub_lang.device)
+            res_text = truncate_at_stop_sequences(processor.decode(res, skip_special_tokens=True), stop_sequences)
+            if return_logprobs:
+                all_res.append([res, res_text, torch.tensor(logprobs, device=sub_lang.device)])
+            else:
+                all_res.append([res, res_text])
+    actor_model.train()
+    return all_res
+
 def sampling_llama(actor_model,
             img, lang,
             aspect_ratio_ids,
@@ -111,7 +539,9 @@ def sampling_llama(actor_model,
             max_new_tokens=384,
             num_return_sequences=1,
             temperature=0.75,
-            processor=None):
+            processor=None,
+            stop_sequences=None):
+    # stop_sequences: stop the response at these strings besides the eos token, see sampling_llava
     
     generation_kwargs={
         "top_k": topk,
@@ -121,6 +551,8 @@ def sampling_llama(actor_model,
         "num_return_sequences": num_return_sequences,
         "temperature": temperature
     }
+    if stop_sequences:
+        generation_kwargs.update(stop_strings=stop_sequences, tokenizer=processor)
     max_new_tokens = generation_kwargs["max_new_tokens"]
     generation_kwargs.pop("max_new_tokens")
 
@@ -149,7 +581,7 @@ def sampling_llama(actor_model,
         else:
             res = actor_model.generate(pixel_values=sub_img, input_ids=sub_lang, max_new_tokens=max_new_tokens, **generation_kwargs)[0][sub_lang.shape[1]:]
 
-        res_text = processor.decode(res, skip_special_tokens=True)       
+        res_text = truncate_at_stop_sequences(processor.decode(res, skip_special_tokens=True), stop_sequences)
         all_res.append([res, res_text])
     actor_model.train()
     return all_res
@@ -159,6 +591,68 @@ def gather_log_probs(logits, labels):
     log_probs_labels = log_probs.gather(dim=-1, index=labels.unsqueeze(-1))
     return log_probs_labels.squeeze(-1)
 
+def align_generation_logprobs(sampling_ans, prompt_len, seq_len):
+    # the log-probs collected while decoding -> the layout of gather_log_probs over the prompt (left-padded to
+    # prompt_len) + response (right-padded) sequences of length seq_len. Also return the mask of the responses
+    first_ans = sampling_ans[0][2]
+    logprobs = torch.zeros(len(sampling_ans), seq_len - 1, dtype=first_ans.dtype, device=first_ans.device)
+    response_mask = torch.zeros_like(logprobs, dtype=torch.bool)
+    for index, ans in enumerate(sampling_ans):
+        response_len = len(ans[2])
+        logprobs[index, prompt_len - 1:prompt_len - 1 + response_len] = ans[2]
+        response_mask[index, prompt_len - 1:prompt_len - 1 + response_len] = True
+    return logprobs, response_mask
+
+def compute_logits(model,
+                images,
+                input_ids,
+                input_labels=None,
+                attention_mask=None,
+                image_num=None,
+                image_sizes=None,
+                model_architecture="default",
+                return_outputs=False,
+                vision_features=None):
+    outputs = None
+    if model_architecture=="default":
+        logits = model(
+                    images,
+                    input_ids,
+                    attention_mask=attention_mask,
+                    input_labels=input_labels,
+                    image_num=image_num)[1]
+    elif model_architecture in ["llava", "llava_next"]:
+        if image_sizes is not None:
+            outputs = model(
+                    input_ids=input_ids,
+                    pixel_values = images,
+                    image_sizes = image_sizes,
+                    attention_mask=attention_mask,
+                    labels=input_labels,
+                    output_hidden_states=True,
+                    vision_features=vision_features)
+        else:
+            outputs = model(
+                    input_ids=input_ids,
+                    pixel_values = images,
+                    attention_mask=attention_mask,
+                    labels=input_labels,
+                    output_hidden_states=True,
+                    vision_features=vision_features)
+        logits = outputs.logits_drop_image
+    if return_outputs:
+        return logits, outputs
+    return logits
+
+def compute_values(actor_model, outputs, value_head_gradient="detach"):
+    # shared actor-critic trunk: the value head of the actor on its final hidden states (image tokens dropped),
+    # aligned with `ViRewardModel.forward_value`. detach: the value loss does not reach the actor trunk
+    hidden_states = outputs.hidden_last_layer_drop_image
+    if value_head_gradient == "detach":
+        hidden_states = hidden_states.detach()
+    v_head = unwrap_model(actor_model).v_head
+    return v_head(hidden_states.to(v_head.weight.dtype)).squeeze(-1)[:, :-1]
+
 def compute_logprobs_from_actor_and_ref(actor_model,
                                     ref_model,
                                     images,
@@ -167,61 +661,45 @@ def compute_logprobs_from_actor_and_ref(actor_model,
                                     attention_mask=None,
                                     image_num=None,
                                     image_sizes = None,
-                                    model_architecture="default"):
-    with torch.no_grad():
-        if model_architecture=="default":
-            logits = actor_model(
-                        images,
-                        input_ids,
-                        attention_mask=attention_mask,
-                        input_labels=input_labels,
-                        image_num=image_num)[1]
-
-            ref_logits = ref_model(
-                        images,
-                        input_ids,
-                        attention_mask=attention_mask,
-                        input_labels=input_labels,
-                        image_num=image_num)[1]
-        elif model_architecture in ["llava", "llava_next"]:
-            if image_sizes is not None:
-                outputs = actor_model(
+                                    model_architecture="default",
+                                    return_values=False,
+                                    actor_logprobs=None,
+                                    vision_feature_cache=None):
+    # ref_model=None: the reference policy is the actor with its LoRA adapters bypassed
+    # return_values: also return the values of the shared value head, from the same actor forward
+    # actor_logprobs: the log-probs collected during generation, the actor forward is skipped
+    # vision_feature_cache: share the vision tower features of `images` between the actor and the ref (llava, llava_next)
+    model_inputs = dict(images=images,
                         input_ids=input_ids,
-                        pixel_values = images,
-                        image_sizes = image_sizes,
-                        attention_mask=attention_mask,
-                        labels=input_labels,
-                        output_hidden_states=True)
-                logits = outputs.logits_drop_image
-
-                ref_outputs = ref_model(
-                        input_ids=input_ids,
-                        pixel_values = images,
-                        image_sizes = image_sizes,
-                        attention_mask=attention_mask,
-                        labels=input_labels,
-                        output_hidden_states=True)
-                ref_logits = ref_outputs.logits_drop_image
-            else:
-                outputs = actor_model(
-                        input_ids=input_ids,
-                        pixel_values = images,
-                        attention_mask=attention_mask,
-                        labels=input_labels,
-                        output_hidden_states=True)
-                logits = outputs.logits_drop_image
-
-                ref_outputs = ref_model(
-                        input_ids=input_ids,
-                        pixel_values = images,
+                        input_labels=input_labels,
                         attention_mask=attention_mask,
-                        labels=input_labels,
-                        output_hidden_states=True)
-                ref_logits = ref_outputs.logits_drop_image
+                        image_num=image_num,
+                        image_sizes=image_sizes,
+                        model_architecture=model_architecture)
+    if model_architecture in ["llava", "llava_next"]:
+        actor_features = get_vision_features(actor_model, images, image_sizes, vision_feature_cache)
+        ref_features = get_vision_features(ref_model if ref_model is not None else actor_model,
+                                           images, image_sizes, vision_feature_cache)
+    else:
+        actor_features = ref_features = None
+    with torch.no_grad():
+        if actor_logprobs is None:
+            logits, outputs = compute_logits(actor_model, return_outputs=True, vision_features=actor_features, **model_inputs)
+            values = compute_values(actor_model, outputs) if return_values else None
+        if ref_model is None:
+            with lora_disabled(actor_model):
+                ref_logits = compute_logits(actor_model, vision_features=ref_features, **model_inputs)
+        else:
+            ref_logits = compute_logits(ref_model, vision_features=ref_features, **model_inputs)
     
-    logprobs = gather_log_probs(logits[:, :-1, :], input_ids[:, 1:])
+    if actor_logprobs is None:
+        logprobs = gather_log_probs(logits[:, :-1, :], input_ids[:, 1:])
+    else:
+        logprobs = actor_logprobs
     ref_logprobs = gather_log_probs(ref_logits[:, :-1, :], input_ids[:,1:])
     
+    if return_values:
+        return logprobs, ref_logprobs, values
     return logprobs, ref_logprobs
 
 def compute_kl_reward_scores(logprobs, ref_logprobs, reward_scores,
@@ -263,6 +741,23 @@ def get_advantages_and_returns(values, rewards, start):
     returns = advantages + values[:, start:]
     return advantages.detach(), returns
 
+def repeat_for_group(group_size, *tensors):
+    # repeat each prompt (and its image inputs) group_size times, the samples of a prompt are consecutive
+    return [t.repeat_interleave(group_size, dim=0) if t is not None else None for t in tensors]
+
+def get_group_advantages(rewards, group_size, estimator="group_norm"):
+    # critic-free baselines computed within the group of responses of each prompt
+    # ref: GRPO (DeepSeekMath), RLOO (Back to Basics: Revisiting REINFORCE Style Optimization for Learning from Human Feedback in LLMs)
+    rewards = rewards.float().view(-1, group_size)
+    if estimator == "group_norm":
+        advantages = (rewards - rewards.mean(-1, keepdim=True)) / (rewards.std(-1, keepdim=True) + 1e-6)
+    elif estimator == "leave_one_out":
+        baseline = (rewards.sum(-1, keepdim=True) - rewards) / (group_size - 1)
+        advantages = rewards - baseline
+    else:
+        raise ValueError(f"unknown advantage estimator: {estimator}")
+    return advantages.view(-1).detach()
+
 def critic_loss_fn(values, old_values, returns, mask):
     cliprange_value = 0.2
 
@@ -2,6 +2,7 @@
 from distutils.command import build
 import math
 import torch
+from torch import nn
 import os
 import deepspeed
 import sys
@@ -38,8 +39,14 @@ class DeepSpeedRLHFEngine():
             actor_model_name_or_path)
         self.actor_tokenizer_new.padding_side = 'left'
         
-        self.ref, self.ref_image_processor, self.ref_tokenizer_new = self._init_ref(
-            actor_model_name_or_path)
+        if self.args.lora_actor_as_ref:
+            # the reference policy is the actor with its LoRA adapters bypassed, no separate copy is built
+            print_rank_0("use the actor without LoRA as the ref model............")
+            self.ref = None
+            self.ref_image_processor, self.ref_tokenizer_new = self.actor_image_processor, self.actor_tokenizer_new
+        else:
+            self.ref, self.ref_image_processor, self.ref_tokenizer_new = self._init_ref(
+                actor_model_name_or_path)
         self.actor_tokenizer_new.padding_side = 'left'
         
         self.reward, self.reward_image_processor, self.reward_tokenizer_new = self._init_reward(
@@ -48,11 +55,22 @@ class DeepSpeedRLHFEngine():
         self.reward_tokenizer_new.add_bos_token = True
         self.reward_tokenizer_new.add_eos_token = True
         
-        self.critic, self.critic_image_processor, self.critic_tokenizer_new = self._init_critic(
-            actor_model_name_or_path)
-        self.critic_tokenizer_new.padding_side="right"
-        self.critic_tokenizer_new.add_bos_token = True
-        self.critic_tokenizer_new.add_eos_token = True
+        if self.args.advantage_estimator == "gae" and not self.args.shared_critic:
+            self.critic, self.critic_image_processor, self.critic_tokenizer_new = self._init_critic(
+                actor_model_name_or_path)
+            self.critic_tokenizer_new.padding_side="right"
+            self.critic_tokenizer_new.add_bos_token = True
+            self.critic_tokenizer_new.add_eos_token = True
+        else:
+            # critic-free (group-relative) advantages or the value head of the actor,
+            # the responses are still encoded with the reward tokenizer
+            if self.args.shared_critic:
+                print_rank_0("the value head shares the actor trunk, skip the critic model............")
+            else:
+                print_rank_0(f"{self.args.advantage_estimator} advantages, skip the critic model............")
+            self.critic = None
+            self.critic_image_processor = self.reward_image_processor
+            self.critic_tokenizer_new = self.reward_tokenizer_new
     
     def push_queue(self, reward_scores):
         self.reward_queue = torch.cat((self.reward_queue, reward_scores))
@@ -89,9 +107,22 @@ class DeepSpeedRLHFEngine():
         if self.args.model_architecture == "default":
             model.load_state_dict(torch.load(os.path.join(actor_path, 'pytorch_model.bin'), map_location='cpu'), strict=False)
 
+        if self.args.shared_critic:
+            # the value head on the final hidden states of the actor, zero-initialized like the critic
+            model.v_head = nn.Linear(model.config.text_config.hidden_size, 1, bias=False)
+            nn.init.zeros_(model.v_head.weight)
+
         # Split weights in two groups, one with weight decay and the other not.
         optimizer_grouped_parameters = get_optimizer_grouped_parameters(
             model, self.args.weight_decay, small_lr=self.args.learning_rate_pretraining_components)
+        if self.args.shared_critic:
+            # the value head is trained with the learning rate of the critic
+            v_head_params = list(model.v_head.parameters())
+            for group in optimizer_grouped_parameters:
+                group["params"] = [p for p in group["params"] if all(p is not v for v in v_head_params)]
+            optimizer_grouped_parameters = [group for group in optimizer_grouped_parameters if len(group["params"]) > 0]
+            optimizer_grouped_parameters.append(
+                {"params": v_head_params, "weight_decay": 0.0, "lr": self.args.critic_learning_rate})
 
         optimizer = AdamW(optimizer_grouped_parameters,
                                 lr=self.args.actor_learning_rate,
@@ -137,7 +168,8 @@ class DeepSpeedRLHFEngine():
         model, image_processor, tokenizer = build_model(
                                             text_tokenizer=self.actor_tokenizer,
                                             args=self.args,
-                                            ds_config=ds_config)
+                                            ds_config=ds_config,
+                                            enable_lora=False)
         
         if self.args.model_architecture == "default":
             model.load_state_dict(torch.load(os.path.join(ref_path, 'pytorch_model.bin'), map_location='cpu'), strict=False)
@@ -232,7 +264,8 @@ class DeepSpeedRLHFEngine():
                                             text_tokenizer=self.reward_tokenizer,
                                             ds_config=ds_config,
                                             is_reward=True,
-                                            args=self.args) 
+                                            args=self.args,
+                                            enable_lora=False) 
                                     
         print_rank_0("load reward model............")
         model.load_state_dict(torch.load(os.path.join(reward_path, 'pytorch_model.bin'), map_location='cpu'), strict=False)
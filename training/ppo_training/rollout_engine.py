@@ -0,0 +1,312 @@
+from collections import deque
+
+import torch
+from transformers import DynamicCache
+
+from ppo_training_utils import sample_next_token, gather_log_probs, StopSequenceChecker, truncate_at_stop_sequences
+
+
+class PagedKVCache:
+    """
+    The keys and values of the in-flight sequences, kept in fixed-size pages of one pool per layer
+    ([num_pages * page_size, num_heads, head_dim]). Each sequence has a page table, pages are reference-counted so
+    that the sequences of a group share the pages of their prompt, and a shared last page is copied before it is
+    written (copy on write). The pools are allocated after the first prefill (shaped after its cache) and released
+    with `release()`.
+    """
+
+    def __init__(self, num_pages=0, page_size=16):
+        self.num_pages = num_pages
+        self.page_size = page_size
+        self.key_pool = None
+        self.value_pool = None
+
+    @property
+    def allocated(self):
+        return self.key_pool is not None
+
+    def allocate(self, past_key_values, num_pages=None):
+        if num_pages is not None:
+            self.num_pages = num_pages
+        self.key_pool, self.value_pool = [], []
+        for layer in range(len(past_key_values)):
+            key, value = past_key_values[layer][0], past_key_values[layer][1]
+            # zeros: the padding of a gathered batch reads (masked) slots that must not be nan
+            self.key_pool.append(key.new_zeros(self.num_pages * self.page_size, key.size(1), key.size(-1)))
+            self.value_pool.append(value.new_zeros(self.num_pages * self.page_size, value.size(1), value.size(-1)))
+        self.free_pages = list(range(self.num_pages - 1, -1, -1))
+        self.page_refs = [0] * self.num_pages
+        self.page_tables = {}
+        self.seq_lens = {}
+
+    def release(self):
+        self.key_pool = None
+        self.value_pool = None
+
+    def num_free_pages(self):
+        return len(self.free_pages)
+
+    def pages_for(self, length):
+        return -(-length // self.page_size)
+
+    def pages_to_append(self, seq_ids):
+        # the new pages needed to append one token to each sequence: a fresh page or a copy of a shared last page
+        num_pages = 0
+        for seq_id in seq_ids:
+            table = self.page_tables[seq_id]
+            if self.seq_lens[seq_id] % self.page_size == 0 or self.page_refs[table[-1]] > 1:
+                num_pages += 1
+        return num_pages
+
+    def _new_page(self):
+        if len(self.free_pages) == 0:
+            raise RuntimeError("the paged kv cache is out of pages, please increase the number of pages")
+        page = self.free_pages.pop()
+        self.page_refs[page] = 1
+        return page
+
+    def _slots(self, seq_id, positions):
+        table = torch.tensor(self.page_tables[seq_id], dtype=torch.long, device=positions.device)
+        return table[positions // self.page_size] * self.page_size + positions % self.page_size
+
+    def add_sequence(self, seq_id, past_key_values, row=0):
+        # copy the cache of row `row` of a prefill (without padding) into new pages
+        length = past_key_values[0][0].size(-2)
+        self.page_tables[seq_id] = [self._new_page() for _ in range(self.pages_for(length))]
+        self.seq_lens[seq_id] = length
+        slots = self._slots(seq_id, torch.arange(length, device=self.key_pool[0].device))
+        for layer in range(len(past_key_values)):
+            self.key_pool[layer][slots] = past_key_values[layer][0][row].transpose(0, 1)
+            self.value_pool[layer][slots] = past_key_values[layer][1][row].transpose(0, 1)
+
+    def fork(self, seq_id, new_seq_id):
+        self.page_tables[new_seq_id] = list(self.page_tables[seq_id])
+        self.seq_lens[new_seq_id] = self.seq_lens[seq_id]
+        for page in self.page_tables[new_seq_id]:
+            self.page_refs[page] += 1
+
+    def free(self, seq_id):
+        for page in self.page_tables.pop(seq_id):
+            self.page_refs[page] -= 1
+            if self.page_refs[page] == 0:
+                self.free_pages.append(page)
+        self.seq_lens.pop(seq_id)
+
+    def append(self, seq_ids, keys, values):
+        # keys / values: one [batch, num_heads, head_dim] tensor per layer, the new token of each sequence
+        slots = []
+        for seq_id in seq_ids:
+            table = self.page_tables[seq_id]
+            length = self.seq_lens[seq_id]
+            if length % self.page_size == 0:
+                table.append(self._new_page())
+            elif self.page_refs[table[-1]] > 1:
+                # copy on write: the last page is shared with the other sequences of the group
+                page = self._new_page()
+                src = slice(table[-1] * self.page_size, (table[-1] + 1) * self.page_size)
+                dst = slice(page * self.page_size, (page + 1) * self.page_size)
+                for pool in self.key_pool + self.value_pool:
+                    pool[dst] = pool[src]
+                self.page_refs[table[-1]] -= 1
+                table[-1] = page
+            slots.append(table[length // self.page_size] * self.page_size + length % self.page_size)
+            self.seq_lens[seq_id] = length + 1
+        slots = torch.tensor(slots, dtype=torch.long, device=self.key_pool[0].device)
+        for layer in range(len(self.key_pool)):
+            self.key_pool[layer][slots] = keys[layer]
+            self.value_pool[layer][slots] = values[layer]
+
+    def gather(self, seq_ids):
+        """
+        The cached keys / values of the sequences as a dense batch in the legacy cache layout
+        ([batch, num_heads, max_len, head_dim] per layer), left-padded, and the [batch, max_len] attention mask.
+        """
+        device = self.key_pool[0].device
+        lengths = torch.tensor([self.seq_lens[seq_id] for seq_id in seq_ids], dtype=torch.long, device=device)
+        max_len = int(lengths.max().item())
+        max_pages = self.pages_for(max_len)
+        tables = torch.tensor([self.page_tables[seq_id] + [0] * (max_pages - len(self.page_tables[seq_id]))
+                               for seq_id in seq_ids], dtype=torch.long, device=device)
+        positions = torch.arange(max_len, device=device)[None, :] - (max_len - lengths)[:, None]
+        attention_mask = (positions >= 0).long()
+        positions = positions.clamp(min=0)
+        slots = tables.gather(1, positions // self.page_size) * self.page_size + positions % self.page_size
+        past_key_values = tuple((key_pool[slots].transpose(1, 2), value_pool[slots].transpose(1, 2))
+                                for key_pool, value_pool in zip(self.key_pool, self.value_pool))
+        return past_key_values, attention_mask
+
+
+class RolloutSequence:
+    # a sampled response in flight: the input row, the sampled tokens (and their log-probs), the logits of the next token
+
+    def __init__(self, row):
+        self.row = row
+        self.tokens = []
+        self.logprobs = []
+        self.next_logits = None
+
+
+class RolloutEngine:
+    """
+    Continuous-batching sampler for the llava / llava-next actor. Up to `max_batch_size` sequences are decoded
+    together, a finished sequence leaves the batch at once and a waiting prompt is prefilled in its slot, so that
+    short responses do not wait for the longest one of the batch. The kv cache lives in a PagedKVCache of `num_pages`
+    pages (0: enough pages for `max_batch_size` sequences of the first prompt length + `max_new_tokens`). When the
+    pages run out, the latest admitted sequence is preempted and recomputed later from its prompt and sampled tokens.
+    A response ends at the eos token or one of `stop_sequences`. `generate` returns the same format as
+    sampling_llava / group_sampling_llava.
+    """
+
+    def __init__(self,
+                 actor_model,
+                 processor,
+                 pad_token_id=0,
+                 max_batch_size=16,
+                 page_size=16,
+                 num_pages=0,
+                 max_new_tokens=384,
+                 topk=50,
+                 topp=0.95,
+                 do_sample=True,
+                 temperature=0.75,
+                 stop_sequences=None):
+        self.actor_model = actor_model
+        self.processor = processor
+        self.pad_token_id = pad_token_id
+        self.eos_token_id = processor.eos_token_id
+        self.max_batch_size = max_batch_size
+        self.num_pages = num_pages
+        self.max_new_tokens = max_new_tokens
+        self.sampling_kwargs = dict(topk=topk, topp=topp, do_sample=do_sample, temperature=temperature)
+        self.stop_sequences = stop_sequences
+        self.stop_checker = StopSequenceChecker(stop_sequences, processor)
+        self.cache = PagedKVCache(num_pages, page_size)
+        self.prefill_len = None
+
+    def _preempt(self, running, waiting):
+        # free the pages of the latest admitted sequence, it is prefilled again with its sampled tokens
+        seq = running.pop()
+        self.cache.free(seq.row)
+        seq.next_logits = None
+        waiting.appendleft([seq])
+
+    def _can_admit(self, group):
+        if not self.cache.allocated:
+            return True
+        # the prompt pages (estimated by the last prefill) and one page per sequence to start decoding
+        return self.cache.num_free_pages() >= self.cache.pages_for(self.prefill_len) + len(group)
+
+    def _prefill(self, group, img, lang, attention_mask, image_sizes, vision_features, max_new_tokens, running, waiting):
+        # the sequences of a group share the prompt (and are all fresh): one prefill, the pages are forked
+        row = group[0].row
+        prompt = lang[row][lang.size(1) - int(attention_mask[row].sum().item()):]
+        if len(group[0].tokens) > 0:
+            prompt = torch.cat([prompt, torch.tensor(group[0].tokens, dtype=prompt.dtype, device=prompt.device)])
+        inputs = dict(input_ids=prompt.unsqueeze(0),
+                      pixel_values=img[row:row + 1],
+                      attention_mask=torch.ones_like(prompt).unsqueeze(0),
+                      use_cache=True,
+                      return_dict=True)
+        if image_sizes is not None:
+            inputs.update(image_sizes=image_sizes[row:row + 1])
+        if vision_features is not None:
+            inputs.update(vision_features=vision_features[row:row + 1])
+        outputs = self.actor_model(**inputs)
+        past_key_values = outputs.past_key_values
+        self.prefill_len = past_key_values[0][0].size(-2)
+
+        if not self.cache.allocated:
+            num_pages = self.num_pages
+            if num_pages == 0:
+                num_pages = self.cache.pages_for(self.prefill_len + max_new_tokens) * self.max_batch_size
+            self.cache.allocate(past_key_values, num_pages)
+        while self.cache.num_free_pages() < self.cache.pages_for(self.prefill_len) and len(running) > 0:
+            self._preempt(running, waiting)
+        self.cache.add_sequence(row, past_key_values)
+        for seq in group[1:]:
+            self.cache.fork(row, seq.row)
+        for seq in group:
+            seq.next_logits = outputs.logits[:, -1, :]
+        return group
+
+    def _decode(self, running):
+        seq_ids = [seq.row for seq in running]
+        past_key_values, past_attention_mask = self.cache.gather(seq_ids)
+        device = past_attention_mask.device
+        input_ids = torch.tensor([seq.tokens[-1] for seq in running], dtype=torch.long, device=device)[:, None]
+        attention_mask = torch.cat([past_attention_mask, torch.ones_like(past_attention_mask[:, :1])], dim=-1)
+        position_ids = past_attention_mask.sum(-1, keepdim=True)
+        outputs = self.actor_model(input_ids=input_ids,
+                                   attention_mask=attention_mask,
+                                   position_ids=position_ids,
+                                   past_key_values=DynamicCache.from_legacy_cache(past_key_values),
+                                   use_cache=True,
+                                   return_dict=True)
+        num_layers = len(outputs.past_key_values)
+        self.cache.append(seq_ids,
+                          [outputs.past_key_values[layer][0][:, :, -1] for layer in range(num_layers)],
+                          [outputs.past_key_values[layer][1][:, :, -1] for layer in range(num_layers)])
+        for index, seq in enumerate(running):
+            seq.next_logits = outputs.logits[index:index + 1, -1, :]
+
+    @torch.no_grad()
+    def generate(self, img, lang, attention_mask, image_sizes=None, group_size=1, return_logprobs=False,
+                 vision_features=None, max_new_tokens=None):
+        """
+        Sample a response for each (left-padded) prompt of `lang`. With group_size > 1, the rows of a group are
+        consecutive and identical, their prompt is prefilled once. Return [[response_ids, response_text], ...]
+        in the row order of the inputs, with the log-probs of the response tokens as the third element if
+        return_logprobs. `vision_features` are the precomputed vision tower features of `img`, `max_new_tokens`
+        overrides the one of the engine for this call (e.g., from MaxNewTokensScheduler).
+        """
+        assert group_size <= self.max_batch_size, "the group size should not exceed the max batch size of the rollout engine"
+        max_new_tokens = max_new_tokens if max_new_tokens is not None else self.max_new_tokens
+        batch_size = lang.size(0)
+        waiting = deque([RolloutSequence(row) for row in range(start, min(start + group_size, batch_size))]
+                        for start in range(0, batch_size, group_size))
+        running = []
+        all_res = [None] * batch_size
+
+        self.actor_model.eval()
+        while len(waiting) > 0 or len(running) > 0:
+            # 1. admit the waiting prompts while there are free slots and pages
+            while len(waiting) > 0 and len(running) + len(waiting[0]) <= self.max_batch_size \
+                    and (len(running) == 0 or self._can_admit(waiting[0])):
+                running.extend(self._prefill(waiting.popleft(), img, lang, attention_mask, image_sizes,
+                                             vision_features, max_new_tokens, running, waiting))
+
+            # 2. sample the next token of every sequence, the finished ones leave the batch
+            next_logits = torch.cat([seq.next_logits for seq in running], dim=0)
+            next_tokens = sample_next_token(next_logits, **self.sampling_kwargs)
+            if return_logprobs:
+                logprobs = gather_log_probs(next_logits.float(), next_tokens).tolist()
+            unfinished = []
+            for index, (seq, token) in enumerate(zip(running, next_tokens.tolist())):
+                seq.tokens.append(token)
+                if return_logprobs:
+                    seq.logprobs.append(logprobs[index])
+                if token == self.eos_token_id or len(seq.tokens) >= max_new_tokens or self.stop_checker(seq.tokens):
+                    self.cache.free(seq.row)
+                    res = torch.tensor(seq.tokens, dtype=torch.long, device=lang.device)
+                    res_text = truncate_at_stop_sequences(self.processor.decode(res, skip_special_tokens=True),
+                                                          self.stop_sequences)
+                    if return_logprobs:
+                        all_res[seq.row] = [res, res_text, torch.tensor(seq.logprobs, device=lang.device)]
+                    else:
+                        all_res[seq.row] = [res, res_text]
+                else:
+                    unfinished.append(seq)
+            running = unfinished
+            if len(running) == 0:
+                continue
+
+            # 3. make room for one more token of each sequence, then decode them together
+            while self.cache.pages_to_append([seq.row for seq in running]) > self.cache.num_free_pages():
+                if len(running) == 1:
+                    raise RuntimeError("the paged kv cache can not hold one sequence, please increase the number of pages")
+                self._preempt(running, waiting)
+            self._decode(running)
+
+        self.cache.release()
+        self.actor_model.train()
+        return all_res
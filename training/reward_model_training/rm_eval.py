@@ -13,7 +13,7 @@ import json
 
 
 import torch
-from torch.utils.data import DataLoader, Subset
+from torch.utils.data import DataLoader, Subset, BatchSampler
 from torch.utils.data.distributed import DistributedSampler
 
 import deepspeed
@@ -25,8 +25,10 @@ sys.path.append(
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)) + "/training")
 
 from training.ppo_training.ppo_training_utils import sampling, sampling_llava
-from training.utils.data import build_dataset, DataCollatorPadToMaxLenForPrediction, DataCollatorPadToMaxLenForRewardModel
-from training.utils.utils import print_rank_0, to_device, set_random_seed, get_all_reduce_mean
+from training.utils.data import build_dataset, DataCollatorPadToMaxLenForPrediction, DataCollatorPadToMaxLenForRewardModel, \
+    get_sample_annotations
+from training.utils.utils import print_rank_0, to_device, set_random_seed, get_all_reduce_mean, PredictionShardWriter, \
+    get_shard_path, read_prediction_shards, remove_prediction_shards, merge_prediction_shards
 from training.utils.ds_utils import get_train_ds_config
 from training.utils.module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, fuse_lora, unfuse_lora
 from training.utils.model import create_dsvl_model_and_transforms, build_model, create_reward_or_critic_model
@@ -205,6 +207,17 @@ def parse_args():
     parser.add_argument('--template',
                         type=str,
                         choices=["default", "llama_2", "llama_3", "llama_3", "vicuna", "llava"],)
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
     parser.add_argument('--reward_model_architecture',
                         type=str,
                         choices=["default", "llama_2", "llama_3", "llama_3", "vicuna", "llava"],)
@@ -237,6 +250,21 @@ def parse_args():
         default=0.75,
         type=float
     )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        choices=["jsonl", "text"],
+        default="jsonl",
+        help="Format of the merged scores in --output_path: one JSON record per line, or the fields of a record "
+        "separated by ' ||| ' (id ||| image ||| prompt ||| score). Each rank writes its own JSONL shard "
+        "(output_path).shard(rank).jsonl, the shards are merged in the order of the ids of --data_path at the end."
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Keep the shards of an interrupted run of the same --output_path and only score the samples "
+        "whose ids are not in them."
+    )
 
     parser = deepspeed.add_config_arguments(parser)
     args = parser.parse_args()
@@ -281,7 +309,8 @@ def main():
     model, image_processor, tokenizer = create_reward_or_critic_model(
                                         text_tokenizer=tokenizer,
                                         ds_config=ds_config,
-                                        args=args)
+                                        args=args,
+                                        enable_lora=False)
     
     model.load_state_dict(torch.load(os.path.join(args.trained_reward_model, 'pytorch_model.bin'), map_location='cpu'), strict=False)
     
@@ -309,7 +338,10 @@ def main():
         vis_root=args.image_folder,
         vis_processor=image_processor,
         tokenizer=tokenizer,
-        template=args.template
+        template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor
     )
 
     generation_kwargs={
@@ -322,28 +354,41 @@ def main():
     }
 
 
-    # split the dataset into train and evaluation
-    train_dataset = dataset
+    # one shard per rank, the shards are merged when all ranks are done
+    if not args.resume and args.global_rank == 0:
+        remove_prediction_shards(args.output_path)
+    torch.distributed.barrier()
 
+    # the reference (image, label) of each sample comes from its annotation
+    annotations = get_sample_annotations(dataset)
+    data_ids = [str(anns[0]['id']) for anns in annotations]
+    train_dataset = dataset
+    if args.resume:
+        finished_ids = set(str(record['id']) for record in read_prediction_shards(args.output_path))
+        # every rank reads the shards before any rank appends to (or truncates) its own, so that they all agree on
+        # the remaining samples and the distributed sampler splits them the same way
+        torch.distributed.barrier()
+        remaining = [index for index, id in enumerate(data_ids) if id not in finished_ids]
+        print_rank_0(f"resume: {len(data_ids) - len(remaining)} samples are done, {len(remaining)} to score", args.global_rank)
+        train_dataset = Subset(dataset, remaining)
+        annotations = [annotations[index] for index in remaining]
+
+    batch_sampler = BatchSampler(DistributedSampler(train_dataset, shuffle=False, drop_last=False),
+                                 args.batch_size, drop_last=False)
     train_dataloader = DataLoader(
         train_dataset,
-        batch_size=args.batch_size,
-        sampler=DistributedSampler(train_dataset, shuffle=False, drop_last=False),
+        batch_sampler=batch_sampler,
         collate_fn=DataCollatorPadToMaxLenForPrediction(args.max_seq_len, tokenizer.pad_token_id, image_processor.crop_size),
     )
 
-    reference = json.load(open(args.data_path, "r", encoding="utf-8"))
-
-    reference_dict = {}
-    for item in reference:
-        reference_dict[str(item['id'])] = item
-
     print_rank_0("***** Running predicting *****", args.global_rank)
 
     model.eval()
 
+    writer = PredictionShardWriter(get_shard_path(args.output_path, args.global_rank))
+
     ref_count = 0
-    for idx, batch in enumerate(tqdm(train_dataloader)):
+    for batch_indices, batch in zip(batch_sampler, tqdm(train_dataloader)):
         batch = to_device(batch, device)  #torch.size(1, 3, 224, 224]) #torch.Size([1, 1, 3, 224, 224])
         images = batch["image"].half().unsqueeze(0) 
         input_ids = batch["input_ids"]
@@ -361,17 +406,24 @@ def main():
                 image_num=batch["image_num"],
             )
     
-        with open(args.output_path, "a") as trg:
-            for i in range(args.batch_size):       
-                id = str(batch['id'][0])
-                ref_image = reference_dict[id]['image'] if reference_dict[id]['image'] is not None else "None"
-                ref_label = reference_dict[id]['label'] if 'label' in reference_dict[id].keys() else "None"
-                line = " ||| ".join([id, ref_image.strip(), 
-                        tokenizer.decode(input_ids[i], skip_special_tokens=True, clean_up_tokenization_spaces=True).replace("\n", "\\n"), 
-                        str(reward_scores[i].item())]) + "\n"
-                print(line)
-                trg.write(line)
-                ref_count = ref_count + 1
+        for i in range(len(batch_indices)):
+            reference = annotations[batch_indices[i]][0]
+            ref_image = reference['image'] if reference['image'] is not None else "None"
+            record = {
+                "id": str(batch['id'][i]),
+                "image": ref_image.strip(),
+                "prompt": tokenizer.decode(input_ids[i], skip_special_tokens=True, clean_up_tokenization_spaces=True),
+                "score": reward_scores[i].item()
+            }
+            print(record)
+            writer.write(batch_indices[i], json.dumps(record, ensure_ascii=False) + "\n")
+            ref_count = ref_count + 1
+    writer.close()
+
+    torch.distributed.barrier()
+    if args.global_rank == 0:
+        num_records = merge_prediction_shards(args.output_path, data_ids, args.output_format)
+        print_rank_0(f"merge {num_records} scores into {args.output_path}", args.global_rank)
      
 
 if __name__ == "__main__":
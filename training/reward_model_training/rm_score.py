@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+# Score the responses of a JSONL file with a trained reward model, e.g., for best-of-n selection, data filtering or
+# offline evaluation. Each input line is {"image": ..., "prompt": ..., "responses": [...]} (or "response": ...),
+# or a sample of the reward model data ({"image": ..., "conversations": [...]}). Each output line is the input
+# record with the "scores" of its responses (and "score" for a single "response"), in the input order.
+
+import argparse
+import json
+import os
+import sys
+
+import torch
+from tqdm import tqdm
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from rm_scoring_utils import load_reward_model, RewardScorer
+from utils.model.reward_score_cache import RewardScoreCache
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Score (image, prompt, response) samples with a trained reward model")
+    parser.add_argument('--input_path',
+                        type=str,
+                        required=True,
+                        help='The JSONL file to score.')
+    parser.add_argument('--output_path',
+                        type=str,
+                        required=True,
+                        help='Where to write the scored JSONL file.')
+    parser.add_argument('--image_folder',
+                        type=str,
+                        default=None,
+                        help='The images of the samples are (image_folder)/(image).')
+    parser.add_argument('--reward_model_architecture',
+                        type=str,
+                        choices=["llava", "llava_next"],
+                        default="llava")
+    parser.add_argument('--reward_base_model',
+                        type=str,
+                        required=True,
+                        help='Path to the reward base model.')
+    parser.add_argument('--trained_reward_model',
+                        type=str,
+                        default=None,
+                        help='Path to the trained reward model (pytorch_model.bin).')
+    parser.add_argument('--template',
+                        type=str,
+                        choices=["default", "llama_2", "llama_3", "vicuna", "llava", "llava_next"],
+                        default="llava",
+                        help='The prompt template used in the reward model training.')
+    parser.add_argument('--device',
+                        type=str,
+                        default=None,
+                        help='cuda or cpu (default: cuda if available).')
+    parser.add_argument('--precision',
+                        type=str,
+                        choices=["fp32", "fp16", "bf16"],
+                        default=None,
+                        help='Default: bf16 on cuda, fp32 on cpu.')
+    parser.add_argument('--batch_size',
+                        type=int,
+                        default=16,
+                        help='The largest number of responses scored in one forward.')
+    parser.add_argument('--max_batch_tokens',
+                        type=int,
+                        default=None,
+                        help='The largest number of (padded) tokens in one forward.')
+    parser.add_argument('--max_seq_len',
+                        type=int,
+                        default=1024,
+                        help='The responses are truncated to this many tokens (with the prompt).')
+    parser.add_argument('--chunk_size',
+                        type=int,
+                        default=1024,
+                        help='The number of input lines read, sorted by length and scored at once.')
+    parser.add_argument('--score_cache_path',
+                        type=str,
+                        default=None,
+                        help='A sqlite file of cached scores shared across jobs, keyed by the reward model weights, '
+                        'the image content and the token ids. The cached responses are not scored again.')
+    parser.add_argument('--score_cache_max_size_mb',
+                        type=float,
+                        default=1024,
+                        help='The least recently used scores are evicted when the cache file grows beyond this size.')
+    parser.set_defaults(lang_decoder_update=False, model_architecture="llava")
+    args = parser.parse_args()
+
+    assert args.batch_size > 0, "--batch_size should be positive"
+    assert args.chunk_size > 0, "--chunk_size should be positive"
+    return args
+
+
+def read_chunks(path, chunk_size):
+    chunk = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip() == "":
+                continue
+            chunk.append(json.loads(line))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def main():
+    args = parse_args()
+    device = torch.device(args.device if args.device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+    precision = args.precision if args.precision is not None else ("bf16" if device.type == "cuda" else "fp32")
+    dtype = {"fp32": torch.float32, "fp16": torch.float16, "bf16": torch.bfloat16}[precision]
+
+    print("load reward model............")
+    model, image_processor, tokenizer = load_reward_model(args, device, dtype)
+    cache = None
+    if args.score_cache_path is not None:
+        cache = RewardScoreCache(args.score_cache_path, max_size_mb=args.score_cache_max_size_mb)
+    scorer = RewardScorer(model, image_processor, tokenizer, args.template,
+                          reward_model_architecture=args.reward_model_architecture,
+                          image_folder=args.image_folder,
+                          batch_size=args.batch_size,
+                          max_batch_tokens=args.max_batch_tokens,
+                          max_seq_len=args.max_seq_len,
+                          cache=cache)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output_path)), exist_ok=True)
+    with open(args.output_path, "w", encoding="utf-8") as f:
+        for samples in tqdm(read_chunks(args.input_path, args.chunk_size)):
+            for sample, scores in zip(samples, scorer.score(samples)):
+                record = dict(sample, scores=scores)
+                if "response" in sample and "responses" not in sample:
+                    record["score"] = scores[0]
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+    stats = scorer.stats()
+    print(f"score {stats['num_responses']} responses of {stats['num_images']} image groups in {stats['num_batches']} batches "
+          f"({stats['responses_per_s']:.2f} responses/s) into {args.output_path}")
+    if cache is not None:
+        print(f"score cache: {stats['cache_hits']} hits, {stats['cache_misses']} misses "
+              f"(hit rate {stats['cache_hit_rate']:.3f}), {stats['cache_evictions']} evictions, "
+              f"{stats['cache_entries']} entries ({stats['cache_size_mb']:.1f} MB)")
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
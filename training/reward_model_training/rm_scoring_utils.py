@@ -0,0 +1,223 @@
+import hashlib
+import os
+import sys
+import time
+
+import torch
+from torch.nn.utils.rnn import pad_sequence
+from PIL import Image
+
+sys.path.append(
+    os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir)))
+from utils.data import DST
+from utils.model import create_reward_or_critic_model
+from utils.model.reward_score_cache import reward_model_fingerprint, hash_image_file, get_reward_score_key
+
+
+def load_reward_model(args, device, dtype=torch.float32):
+    # the reward model of `args.reward_base_model` with the trained weights of `args.trained_reward_model`,
+    # set up for scoring: right padding and bos / eos tokens as in the reward model training
+    model, image_processor, tokenizer = create_reward_or_critic_model(args=args, enable_lora=False)
+    if args.trained_reward_model is not None:
+        model.load_state_dict(torch.load(os.path.join(args.trained_reward_model, 'pytorch_model.bin'), map_location='cpu'), strict=False)
+    model = model.to(device, dtype=dtype)
+    model.eval()
+    tokenizer.padding_side = 'right'
+    tokenizer.add_bos_token = True
+    tokenizer.add_eos_token = True
+    return model, image_processor, tokenizer
+
+
+def get_prompt_and_responses(sample):
+    # a scoring sample is {"prompt": ..., "responses": [...]} (or "response"), or a sample of the reward model data
+    # ({"conversations": [{"value": prompt}, {"value": [responses]}]})
+    if "conversations" in sample:
+        prompt = sample["conversations"][0]["value"]
+        responses = sample["conversations"][1]["value"]
+    else:
+        prompt = sample["prompt"]
+        responses = sample["responses"] if "responses" in sample else sample["response"]
+    if isinstance(responses, str):
+        responses = [responses]
+    return prompt, list(responses)
+
+
+class RewardScorer:
+    """
+    Score (image, prompt, response) samples with a trained reward model (llava or llava_next) that is kept across calls.
+    A sample has one image and any number of responses. The responses of all samples in a call are sorted by length
+    and cut into batches of at most `batch_size` responses (and `max_batch_tokens` padded tokens). The image of a
+    sample is loaded and encoded once per batch for all of its responses in it (`image_index` maps every response to
+    its image). The responses are encoded as in the reward model training (LlavaComparsionDataset).
+    With a `RewardScoreCache`, the cached responses (keyed by the image file content) are not scored again,
+    and the images whose responses are all cached are not loaded.
+    """
+
+    def __init__(self, model, image_processor, tokenizer, template, reward_model_architecture="llava",
+                 image_folder=None, batch_size=16, max_batch_tokens=None, max_seq_len=1024, cache=None):
+        assert reward_model_architecture in ["llava", "llava_next"], \
+            f"the scoring of {reward_model_architecture} reward models is not supported"
+        self.model = model
+        self.image_processor = image_processor
+        self.tokenizer = tokenizer
+        self.template = template
+        self.reward_model_architecture = reward_model_architecture
+        self.image_folder = image_folder
+        self.batch_size = batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_seq_len = max_seq_len
+        self.prompter = DST.Prompter()
+        self.device = next(model.parameters()).device
+        self.dtype = next(model.parameters()).dtype
+        self.cache = cache
+        if cache is not None:
+            # the image files are turned into pixels by the image processor, its settings are part of the key
+            self.fingerprint = hashlib.sha1(
+                (reward_model_fingerprint(model) + image_processor.to_json_string()).encode()).hexdigest()
+
+        self.end_of_token = ""
+        if template == "llama_3":
+            self.end_of_token = DST.LLAMA3_HUMAN_QUESTION_PRETOKEN_END
+        elif template == "llama_2":
+            self.end_of_token = DST.LLAMA2_HUMAN_QUESTION_PRETOKEN_END
+        elif template == "vicuna":
+            self.end_of_token = DST.VICUNA_HUMAN_QUESTION_PRETOKEN_END
+
+        self.num_responses = 0
+        self.num_scored_responses = 0
+        self.num_batches = 0
+        self.num_images = 0
+        self.busy_time = 0.0
+
+    def encode(self, prompt, response):
+        # the same text processing as LlavaComparsionDataset.process_text and VQADataset.tokenize
+        question = prompt.replace("<image>", "")
+        question = question.strip("USER:").strip("ASSISTANT:")
+        question = question.strip("\n")
+        question = question.strip(" ")
+        instruction = self.prompter(question, with_image=True, first_message=True, template=self.template)
+        input_ids = self.tokenizer(instruction + response + self.end_of_token,
+                                   return_tensors=None,
+                                   padding="do_not_pad",
+                                   truncation=True,
+                                   max_length=self.max_seq_len)["input_ids"]
+        if input_ids[-1] != self.tokenizer.eos_token_id:
+            input_ids.append(self.tokenizer.eos_token_id)
+        return input_ids
+
+    def get_image_path(self, image):
+        if isinstance(image, (list, tuple)):
+            assert len(image) == 1, "a scoring sample should have one image"
+            image = image[0]
+        if image is None:
+            raise ValueError("a scoring sample should have an image")
+        if self.image_folder is not None:
+            image = os.path.join(self.image_folder, image)
+        return image
+
+    def load_image(self, image):
+        image_outputs = self.image_processor(Image.open(self.get_image_path(image)).convert("RGB"), return_tensors="pt")
+        image_sizes = image_outputs["image_sizes"] if self.reward_model_architecture == "llava_next" else None
+        return image_outputs["pixel_values"], image_sizes
+
+    def get_batches(self, encoded):
+        # 1. the responses of a sample are kept together, up to `batch_size` per chunk
+        chunks = []
+        for index, (_, input_ids) in enumerate(encoded):
+            for start in range(0, len(input_ids), self.batch_size):
+                rows = list(range(start, min(start + self.batch_size, len(input_ids))))
+                chunks.append((index, rows, max(len(input_ids[row]) for row in rows)))
+        # 2. the longest chunks first, so that running out of memory shows up at the start
+        chunks.sort(key=lambda chunk: chunk[2], reverse=True)
+        batches, batch, num_rows = [], [], 0
+        for chunk in chunks:
+            num_tokens = (num_rows + len(chunk[1])) * (batch[0][2] if len(batch) > 0 else chunk[2])
+            if len(batch) > 0 and (num_rows + len(chunk[1]) > self.batch_size or
+                                   (self.max_batch_tokens is not None and num_tokens > self.max_batch_tokens)):
+                batches.append(batch)
+                batch, num_rows = [], 0
+            batch.append(chunk)
+            num_rows += len(chunk[1])
+        if len(batch) > 0:
+            batches.append(batch)
+        return batches
+
+    @torch.no_grad()
+    def score_batch(self, encoded, batch):
+        input_ids = [torch.LongTensor(encoded[index][1][row]) for index, rows, _ in batch for row in rows]
+        image_index = torch.LongTensor([i for i, (_, rows, _) in enumerate(batch) for _ in rows])
+        attention_mask = pad_sequence([torch.ones_like(ids) for ids in input_ids], padding_value=0, batch_first=True)
+        input_ids = pad_sequence(input_ids, padding_value=self.tokenizer.pad_token_id, batch_first=True)
+
+        images = [self.load_image(encoded[index][0]) for index, _, _ in batch]
+        pixel_values = [image for image, _ in images]
+        image_sizes = None
+        if self.reward_model_architecture == "llava_next":
+            # the anyres patches are padded to the same number, the padded ones are dropped by `image_sizes`
+            num_patches = max(image.size(1) for image in pixel_values)
+            pixel_values = [torch.nn.functional.pad(image, (0, 0, 0, 0, 0, 0, 0, num_patches - image.size(1)), "constant", 0)
+                            for image in pixel_values]
+            image_sizes = torch.cat([sizes for _, sizes in images], dim=0).to(self.device)
+        pixel_values = torch.cat(pixel_values, dim=0).to(self.device, dtype=self.dtype)
+
+        input_ids = input_ids.to(self.device)
+        reward_scores = self.model(pixel_values,
+                                   input_ids,
+                                   image_sizes=image_sizes,
+                                   attention_mask=attention_mask.to(self.device),
+                                   input_labels=input_ids,   # not need to mask the prompt
+                                   image_index=image_index.to(self.device))
+        self.num_images += len(batch)
+        return torch.stack(reward_scores).float().tolist()
+
+    def score(self, samples):
+        # the scores of the responses of every sample, in the order of `samples`
+        start_time = time.time()
+        encoded = []
+        for sample in samples:
+            prompt, responses = get_prompt_and_responses(sample)
+            encoded.append((sample.get("image", None), [self.encode(prompt, response) for response in responses]))
+
+        scores = [[None] * len(input_ids) for _, input_ids in encoded]
+        keys = None
+        if self.cache is not None:
+            keys = []
+            for image, input_ids in encoded:
+                image_hash = hash_image_file(self.get_image_path(image))
+                keys.append([get_reward_score_key(self.fingerprint, image_hash, ids) for ids in input_ids])
+            cached_scores = self.cache.get_many([key for sample_keys in keys for key in sample_keys])
+            for index, (_, input_ids) in enumerate(encoded):
+                scores[index], cached_scores = cached_scores[:len(input_ids)], cached_scores[len(input_ids):]
+
+        # only the responses that are not cached are scored, `pending` maps them back to their samples
+        pending = [(index, [row for row, score in enumerate(scores[index]) if score is None]) for index in range(len(encoded))]
+        pending = [(index, rows) for index, rows in pending if len(rows) > 0]
+        pending_encoded = [(encoded[index][0], [encoded[index][1][row] for row in rows]) for index, rows in pending]
+        for batch in self.get_batches(pending_encoded):
+            batch_scores = iter(self.score_batch(pending_encoded, batch))
+            for pending_index, pending_rows, _ in batch:
+                index, rows = pending[pending_index]
+                for pending_row in pending_rows:
+                    scores[index][rows[pending_row]] = next(batch_scores)
+            self.num_batches += 1
+
+        if self.cache is not None and len(pending) > 0:
+            self.cache.put_many([keys[index][row] for index, rows in pending for row in rows],
+                                [scores[index][row] for index, rows in pending for row in rows])
+
+        self.num_responses += sum(len(input_ids) for _, input_ids in encoded)
+        self.num_scored_responses += sum(len(rows) for _, rows in pending)
+        self.busy_time += time.time() - start_time
+        return scores
+
+    def stats(self):
+        stats = {
+            "num_responses": self.num_responses,
+            "num_scored_responses": self.num_scored_responses,
+            "num_batches": self.num_batches,
+            "num_images": self.num_images,
+            "responses_per_s": self.num_responses / max(self.busy_time, 1e-6),
+        }
+        if self.cache is not None:
+            stats.update({f"cache_{name}": value for name, value in self.cache.stats().items()})
+        return stats
@@ -26,7 +26,8 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.
 from utils.data import build_dataset, DataCollatorPadToMaxLenForRewardModel, split_dataset, shuffle_dataset
 from utils.utils import print_rank_0, to_device, save_hf_format, set_random_seed, get_all_reduce_mean, get_optimizer_grouped_parameters, save_zero_three_model
 from utils.ds_utils import get_train_ds_config
-from utils.module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, fuse_lora, unfuse_lora
+from utils.module.lora import merge_lora_state_dict, save_lora_adapter
+from utils.module.ranking_loss import get_candidate_mask, listwise_loss, pairwise_accuracy
 from utils.model import create_reward_or_critic_model
 
 def parse_args():
@@ -237,6 +238,17 @@ def parse_args():
                     type=str,
                     choices=["default", "llama_2", "llama_3", "llama_3", "vicuna", "llava",
                             "llava_next", "llama-3.2-vision"],)
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
     parser.add_argument(
         '--from_checkpoint',
         type=str,
@@ -328,16 +340,6 @@ def main():
     if os.path.exists(args.trained_reward_model):
         model.load_state_dict(torch.load(os.path.join(args.trained_reward_model, 'pytorch_model.bin'), map_location='cpu'), strict=False)
 
-    if args.lang_lora_dim > 0:
-        model.lang_decoder = convert_linear_layer_to_lora(model.rwtranrsformer.lang_decoder, args.lang_lora_module_name, args.lang_lora_dim)
-        if args.only_optimize_lora:
-            model.lang_decoder = only_optimize_lora_parameters(model.rwtranrsformer.lang_decoder)
-
-    if args.vis_lora_dim > 0:
-        model.vis_encoder = convert_linear_layer_to_lora(model.rwtranrsformer.vis_encoder, args.vis_lora_module_name, args.vis_lora_dim)
-        if args.only_optimize_lora:
-            model.vis_encoder = only_optimize_lora_parameters(model.rwtranrsformer.vis_encoder)
-
     print_rank_0(model, args.global_rank) 
         
     # Prepare the data
@@ -362,7 +364,10 @@ def main():
             vis_processor=image_processor,
             vis_root=args.image_folder,
             tokenizer=tokenizer,
-            template=args.template
+            template=args.template,
+            fast_image_decode=not args.disable_fast_image_decode,
+            image_decode_threads=args.image_decode_threads,
+            fast_image_processor=args.fast_image_processor
         )
         # split the dataset into train and evaluation
         np_rng = np.random.RandomState(seed=args.seed)
@@ -380,7 +385,10 @@ def main():
             vis_processor=image_processor,
             vis_root=args.image_folder,
             tokenizer=tokenizer,
-            template=args.template
+            template=args.template,
+            fast_image_decode=not args.disable_fast_image_decode,
+            image_decode_threads=args.image_decode_threads,
+            fast_image_processor=args.fast_image_processor
         )
         eval_dataset = build_dataset(
             args.eval_data_path,
@@ -393,7 +401,10 @@ def main():
             vis_processor=image_processor,
             vis_root=args.image_folder,
             tokenizer=tokenizer,
-            template=args.template
+            template=args.template,
+            fast_image_decode=not args.disable_fast_image_decode,
+            image_decode_threads=args.image_decode_threads,
+            fast_image_processor=args.fast_image_processor
         )
     
     if args.model_architecture == "llama-3.2-vision":
@@ -453,43 +464,38 @@ def main():
         print_rank_0("***** Evaluation Begin *****")
         model.eval()
         batch_size = args.per_device_eval_batch_size
-        acc_count = 0
-        total = 0
-        candidate_assigned = False
-        candidate_size = 0
+        acc_count = torch.zeros((), dtype=torch.long, device=device)
+        total = torch.zeros((), dtype=torch.long, device=device)
         for step, batch in enumerate(tqdm(eval_dataloader)):
             with torch.no_grad():
                 batch = to_device(batch, device)
-                chosen_idx = [i for i in range(len(batch["input_ids"])) if (batch['input_ids'][i][0] != -1)]
-
-                batch["image"] = [batch["image"][i] for i in chosen_idx]
-                batch["input_ids"] = [batch["input_ids"][i] for i in chosen_idx]
-                batch["attention_mask"] = [batch["attention_mask"][i] for i in chosen_idx]
-                batch["labels"] = [batch["labels"][i] for i in chosen_idx]
-                
-                input_ids = torch.stack(batch["input_ids"])
-                attention_mask = torch.stack(batch["attention_mask"])
-                
-                labels = torch.stack(batch["labels"])
-                images = torch.stack(batch["image"])
+                candidate_mask = get_candidate_mask(batch["candidate_offsets"])
+                # images are kept once per query, `image_index` maps each candidate to its image
+                image_index = batch["image_index"]
+                input_ids = batch["input_ids"]
+                attention_mask = batch["attention_mask"]
+                labels = batch["labels"]
+                images = batch["image"]
 
                 if args.model_architecture == "llava_next":
                     image_sizes = batch["image_sizes"]
-                    image_sizes = image_sizes.reshape(len(input_ids), 2)
-                    images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
+                    image_sizes = image_sizes.reshape(-1, 2)
+                    image_num_tiles = batch["image_num_tiles"]
                     aspect_ratio_ids = None
                     aspect_ratio_mask = None
 
                 elif args.model_architecture == "llama-3.2-vision":
                     aspect_ratio_ids = batch["aspect_ratio_ids"]
                     aspect_ratio_mask = batch["aspect_ratio_mask"]
-                    images = images.reshape(len(input_ids), 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
+                    images = images.reshape(-1, 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
                    
                     image_sizes = None
+                    image_num_tiles = None
 
                 else:
                     
                     image_sizes = None
+                    image_num_tiles = None
                     aspect_ratio_ids = None
                     aspect_ratio_mask = None
 
@@ -507,19 +513,16 @@ def main():
                     attention_mask=attention_mask_tmp,
                     input_labels=labels_tmp,
                     image_num=batch["image_num"],
+                    image_index=image_index,
+                    image_num_tiles=image_num_tiles,
                 )
 
-                if candidate_assigned == False:
-                    candidate_size = int(len(reward_scores) / batch_size)
-                    candidate_assigned = True
-                for i in range(int(len(reward_scores) / candidate_size)):
-                    for j in range(0, candidate_size-1):
-                        for k in range(j+1, candidate_size):
-                            if reward_scores[i*candidate_size + j] > reward_scores[i*candidate_size + k]:
-                                acc_count = acc_count + 1
-                            total = total + 1
+                correct, num_pairs = pairwise_accuracy(torch.stack(reward_scores), candidate_mask)
+                acc_count += correct
+                total += num_pairs
         model.train()
-        acc_rate = acc_count / total
+        # a batch (or a rank) may have no candidate pairs, e.g., a single valid candidate per query
+        acc_rate = acc_count.float() / total.clamp(min=1)
         try:
             acc_rate = get_all_reduce_mean(acc_rate).item()
         except:
@@ -546,33 +549,31 @@ def main():
         for step, batch in enumerate(tqdm(train_dataloader)):
             # batch--> y1 of sample 1; y2 of sample 1;...; yn of sample 1; y1 of sample 2; ...
             batch = to_device(batch, device)  #torch.size(1, 3, 224, 224]) #torch.Size([1, 1, 3, 224, 224])
-            chosen_idx = [i for i in range(len(batch["input_ids"])) if (batch['input_ids'][i][0] != -1)]
-
-            batch["image"] = [batch["image"][i] for i in chosen_idx]
-            batch["input_ids"] = [batch["input_ids"][i] for i in chosen_idx]
-            batch["attention_mask"] = [batch["attention_mask"][i] for i in chosen_idx]
-            batch["labels"] = [batch["labels"][i] for i in chosen_idx]
-
-            input_ids = torch.stack(batch["input_ids"])
-            attention_mask = torch.stack(batch["attention_mask"])
-            labels = torch.stack(batch["labels"])
-            images = torch.stack(batch["image"])
+            candidate_mask = get_candidate_mask(batch["candidate_offsets"])
+            # images are kept once per query, `image_index` maps each candidate to its image
+            image_index = batch["image_index"]
+            input_ids = batch["input_ids"]
+            attention_mask = batch["attention_mask"]
+            labels = batch["labels"]
+            images = batch["image"]
 
             if args.model_architecture == "llava_next":
                 image_sizes = batch["image_sizes"]
-                image_sizes = image_sizes.reshape(len(input_ids), 2)
-                images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
+                image_sizes = image_sizes.reshape(-1, 2)
+                image_num_tiles = batch["image_num_tiles"]
                 aspect_ratio_ids = None
                 aspect_ratio_mask = None
 
             elif args.model_architecture == "llama-3.2-vision":
                 aspect_ratio_ids = batch["aspect_ratio_ids"]
                 aspect_ratio_mask = batch["aspect_ratio_mask"]
-                images = images.reshape(len(input_ids), 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
+                images = images.reshape(-1, 1, images.size(-4), images.size(-3), images.size(-2), images.size(-1))
                 image_sizes = None
+                image_num_tiles = None
 
             else:
                 image_sizes = None
+                image_num_tiles = None
                 aspect_ratio_ids = None
                 aspect_ratio_mask = None
             
@@ -589,36 +590,15 @@ def main():
                 attention_mask=attention_mask_tmp,
                 input_labels=labels_tmp,
                 image_num=batch["image_num"],
+                image_index=image_index,
+                image_num_tiles=image_num_tiles,
             )
 
             # reward modeling
             # using Plackett-Luce to compute loss
-            all_loss = []
-            all_comparison_judgement = [] # compute correct predictions
-
-            sample_num = len(reward_scores)//args.ranked_candidate_num
-            count_list = [args.ranked_candidate_num] * sample_num
-
-            for batch_index, can_num in enumerate(count_list):
-                for i in range(can_num):
-                    numerator_reward_scores = reward_scores[sum(count_list[:batch_index]) + i]
-                    
-                    denominator_reward_scores_sum = []
-                    for j in range(i, can_num):
-                        denominator_reward_score = reward_scores[sum(count_list[:batch_index]) + j]
-                        denominator_reward_scores_sum.append(torch.exp(denominator_reward_score))
-
-                    # get comparison
-                    for k in range(i+1, can_num):
-                        if reward_scores[sum(count_list[:batch_index]) + i] > reward_scores[sum(count_list[:batch_index]) + k]:
-                            all_comparison_judgement.append(True)
-                        else:
-                            all_comparison_judgement.append(False)
-                    
-                    all_loss.append(-torch.log(torch.exp(numerator_reward_scores) /
-                                                    torch.stack(denominator_reward_scores_sum, dim=0).sum(0)))
-
-            loss = torch.stack(all_loss, dim=0).sum(0) / len(count_list)
+            reward_scores = torch.stack(reward_scores)
+            loss = listwise_loss(reward_scores, candidate_mask)
+            correct, num_pairs = pairwise_accuracy(reward_scores, candidate_mask)
 
             model.backward(loss)
             model.step()
@@ -628,7 +608,7 @@ def main():
 
             print_rank_0(
                 f'Epoch {epoch+1}, Step: {(step+1)}, Loss: {acc_loss/(step+1)}, '+ \
-                f'Accuracy: {sum(all_comparison_judgement)/len(all_comparison_judgement)}',
+                f'Accuracy: {(correct.float() / num_pairs.clamp(min=1)).item()}',
                 args.global_rank)
             
             global_step += 1
@@ -650,16 +630,16 @@ def main():
                     # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
                     model_to_save = model.module if hasattr(model,
                                                             'module') else model
-                    lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+                    lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
                     os.makedirs(f'{args.output_dir}/epoch-{epoch}-{global_step}', exist_ok=True)
                     WEIGHTS_NAME = "pytorch_model.bin"
                     output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}-{global_step}', WEIGHTS_NAME)
                     torch.save(lean_state_dict, output_model_file)
+                    save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
 
         model.tput_timer.update_epoch_count()
         evaluation(model, eval_dataloader)
 
-        model = fuse_lora(model)
         if args.global_rank == 0:
             save_hf_format(model, tokenizer, args, f'epoch-{epoch}')
         if args.zero_stage == 3:
@@ -673,11 +653,12 @@ def main():
             # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
             model_to_save = model.module if hasattr(model,
                                                     'module') else model
-            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
             os.makedirs(f'{args.output_dir}/epoch-{epoch}', exist_ok=True)
             WEIGHTS_NAME = "pytorch_model.bin"
             output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}', WEIGHTS_NAME)
             torch.save(lean_state_dict, output_model_file)
+            save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
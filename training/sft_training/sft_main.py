@@ -33,6 +33,7 @@ from utils.utils import (
     save_zero_three_model
 )
 from utils.ds_utils import get_train_ds_config
+from utils.module.lora import merge_lora_state_dict, save_lora_adapter
 from utils.model import build_model
 
 def parse_args():
@@ -236,6 +237,17 @@ def parse_args():
                         type=str,
                         choices=['default', 'llama_2', 'llama_3', 'llama_3', 'vicuna', 
                         'llava', 'llava_next', 'llama-3.2-vision'],)
+    parser.add_argument('--disable_fast_image_decode',
+                        action='store_true',
+                        help='Disable JPEG draft-mode decoding and the image decode thread pool.')
+    parser.add_argument('--image_decode_threads',
+                        type=int,
+                        default=4,
+                        help='Number of threads used to decode the images of a batch.')
+    parser.add_argument('--fast_image_processor',
+                        action='store_true',
+                        help='Preprocess images with torch ops (resize/center-crop/normalize and anyres tiling) '
+                        'instead of the HF image processor. Not used for llama-3.2-vision.')
     parser.add_argument(
         '--eval_step',
         type=int,
@@ -326,7 +338,10 @@ def main():
         vis_processor=image_processor,
         vis_root=args.image_folder,
         tokenizer=tokenizer,
-        template=args.template
+        template=args.template,
+        fast_image_decode=not args.disable_fast_image_decode,
+        image_decode_threads=args.image_decode_threads,
+        fast_image_processor=args.fast_image_processor
     )
     # split the dataset into train and evaluation
     total_data = len(dataset)
@@ -425,12 +440,12 @@ def main():
                 elif args.model_architecture=="llava_next":
                     image_sizes = batch["image_sizes"]
                     image_sizes = image_sizes.reshape(len(input_ids), 2)
-                    images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
 
                     loss = model(
                         input_ids=input_ids,
                         pixel_values=images,
                         image_sizes=image_sizes,
+                        image_num_tiles=batch["image_num_tiles"],
                         attention_mask=attention_mask,
                         labels=labels,
                         return_dict=False
@@ -492,11 +507,11 @@ def main():
             elif args.model_architecture=="llava_next":
                 image_sizes = batch["image_sizes"]
                 image_sizes = image_sizes.reshape(len(input_ids), 2)
-                images = images.reshape(len(input_ids), 5, images.size(-3), images.size(-2), images.size(-1))
                 loss = model(
                     input_ids=input_ids,
                     pixel_values=images,
                     image_sizes=image_sizes,
+                    image_num_tiles=batch["image_num_tiles"],
                     attention_mask=attention_mask,
                     labels=labels,
                     return_dict=False
@@ -544,11 +559,12 @@ def main():
             # https://deepspeed.readthedocs.io/en/latest/model-checkpointing.html
             model_to_save = model.module if hasattr(model,
                                                     'module') else model
-            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(model_to_save.state_dict())
+            lean_state_dict = deepspeed.checkpoint.utils.clone_tensors_for_torch_save(merge_lora_state_dict(model_to_save, model_to_save.state_dict()))
             os.makedirs(f"{args.output_dir}/epoch-{epoch}", exist_ok=True)
             WEIGHTS_NAME = 'pytorch_model.bin'
             output_model_file = os.path.join(f'{args.output_dir}/epoch-{epoch}', WEIGHTS_NAME)
             torch.save(lean_state_dict, output_model_file)
+            save_lora_adapter(model_to_save, model_to_save.state_dict(), os.path.dirname(output_model_file))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
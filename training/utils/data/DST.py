@@ -56,6 +56,21 @@ LLAMA_3_2_HUMAN_QUESTION_PRETOKEN_END = "<|eot_id|>"
 LLAMA_3_2_ASSISTANT_TOKEN = "<|eot_id|><|start_header_id|>assistant<|end_header_id|>\n\n"
 
 
+# the (multi-token) terminators of an answer for each template: the end-of-turn marker or the start of a new turn.
+# `generate` only stops on the eos token of the tokenizer, the rollouts stop on these as well.
+STOP_SEQUENCES = {
+    "default": [DEFAULT_HUMAN_QUESTION_PRETOKEN, DEFAULT_HUMAN_IMAGE_PRETOKEN, DEFAULT_ASSISTANT_TOKEN, DEFAULT_ASSISTANT_END_ROUND_TOKEN],
+    "llama_2": [LLAMA2_HUMAN_QUESTION_PRETOKEN_END, LLAMA2_HUMAN_QUESTION_PRETOKEN.strip()],
+    "llama_3": [LLAMA3_HUMAN_QUESTION_PRETOKEN_END, "<|start_header_id|>"],
+    "vicuna": [VICUNA_HUMAN_QUESTION_PRETOKEN_END, VICUNA_HUMAN_QUESTION_PRETOKEN.strip()],
+    "llava": [LLAVA_HUMAN_QUESTION_PRETOKEN_END, LLAVA_HUMAN_QUESTION_PRETOKEN.strip()],
+    "llava_next": [LLAVA_HUMAN_QUESTION_PRETOKEN_END, LLAVA_HUMAN_QUESTION_PRETOKEN.strip()],
+    "llama-3.2-vision": [LLAMA_3_2_HUMAN_QUESTION_PRETOKEN_END, "<|start_header_id|>"],
+}
+
+def get_stop_sequences(template):
+    return list(STOP_SEQUENCES.get(template, []))
+
 special_token_list = [DEFAULT_IMAGE_TOKEN] # used for easy image # replacement
 
 DEFAULT_LABEL_PADDING_NUM = -100
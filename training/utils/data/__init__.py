@@ -8,6 +8,9 @@ DataCollatorPadToMaxLenForRewardModel,
 DataCollatorPadToMaxLenForPPOTraining, 
 DataCollatorPadToMaxLenForPrediction,
 DataCollatorPadToMaxLenForMSERewardModel,
+BucketedBatchSampler,
+get_prompt_lengths,
+get_sample_annotations,
 split_dataset, 
 shuffle_dataset)
 
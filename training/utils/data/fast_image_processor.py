@@ -0,0 +1,227 @@
+import math
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+def select_best_resolution(original_size, possible_resolutions):
+    # same rule as transformers.image_processing_utils.select_best_resolution, sizes are (height, width)
+    original_height, original_width = original_size
+    best_fit = None
+    max_effective_resolution = 0
+    min_wasted_resolution = float("inf")
+
+    for height, width in possible_resolutions:
+        scale = min(width / original_width, height / original_height)
+        downscaled_width, downscaled_height = int(original_width * scale), int(original_height * scale)
+        effective_resolution = min(downscaled_width * downscaled_height, original_width * original_height)
+        wasted_resolution = (width * height) - effective_resolution
+
+        if effective_resolution > max_effective_resolution or (
+            effective_resolution == max_effective_resolution and wasted_resolution < min_wasted_resolution
+        ):
+            max_effective_resolution = effective_resolution
+            min_wasted_resolution = wasted_resolution
+            best_fit = (height, width)
+
+    return best_fit
+
+
+class TorchImageProcessor:
+    """
+    A drop-in replacement of the HF CLIPImageProcessor / LlavaNextImageProcessor for the data path.
+    resize / center-crop / rescale / normalize (and the llava-next anyres tiling) are done with torch ops,
+    and the rescale + normalize step is shared by all tiles of all images passed in one call.
+    It reads its configuration from the HF processor, so the outputs follow the same convention:
+    {'pixel_values': [...], 'image_sizes': [...] (anyres only)}.
+    """
+
+    def __init__(self, hf_processor):
+        self.hf_processor = hf_processor
+        self.size = hf_processor.size
+        self.crop_size = getattr(hf_processor, "crop_size", None)
+        self.do_resize = getattr(hf_processor, "do_resize", True)
+        self.do_center_crop = getattr(hf_processor, "do_center_crop", True)
+        self.do_rescale = getattr(hf_processor, "do_rescale", True)
+        self.do_normalize = getattr(hf_processor, "do_normalize", True)
+        self.rescale_factor = getattr(hf_processor, "rescale_factor", 1 / 255)
+        self.image_grid_pinpoints = getattr(hf_processor, "image_grid_pinpoints", None)
+        self.image_mean = torch.tensor(hf_processor.image_mean, dtype=torch.float32).view(-1, 1, 1)
+        self.image_std = torch.tensor(hf_processor.image_std, dtype=torch.float32).view(-1, 1, 1)
+
+    @staticmethod
+    def is_supported(hf_processor):
+        # mllama uses aspect-ratio tiling with its own outputs, keep the HF processor for it
+        return (hf_processor is not None
+                and hf_processor.__class__.__name__ in ["CLIPImageProcessor", "LlavaNextImageProcessor"])
+
+    def __getattr__(self, name):
+        # expose the remaining attributes (e.g. resample, do_convert_rgb) of the wrapped processor
+        hf_processor = self.__dict__.get("hf_processor", None)
+        if hf_processor is None:
+            raise AttributeError(name)
+        return getattr(hf_processor, name)
+
+    def to_tensor(self, image):
+        # PIL (RGB) -> uint8 tensor of shape (3, H, W)
+        return torch.from_numpy(np.array(image.convert("RGB"), dtype=np.uint8)).permute(2, 0, 1).contiguous()
+
+    def resize(self, image, height, width):
+        if image.shape[-2:] == (height, width):
+            return image
+        image = F.interpolate(image[None].float(), size=(height, width), mode="bicubic",
+                              align_corners=False, antialias=True)[0]
+        # HF resizes uint8 images through PIL, so round back to uint8 before rescaling
+        return image.round_().clamp_(0, 255).to(torch.uint8)
+
+    def resize_shortest_edge(self, image):
+        if "shortest_edge" in self.size:
+            height, width = image.shape[-2:]
+            short, long = (width, height) if width <= height else (height, width)
+            new_short = self.size["shortest_edge"]
+            new_long = int(new_short * long / short)
+            new_height, new_width = (new_long, new_short) if width <= height else (new_short, new_long)
+        else:
+            new_height, new_width = self.size["height"], self.size["width"]
+        return self.resize(image, new_height, new_width)
+
+    def center_crop(self, image):
+        crop_height, crop_width = self.crop_size["height"], self.crop_size["width"]
+        height, width = image.shape[-2:]
+        if height < crop_height or width < crop_width:
+            pad_height, pad_width = max(crop_height - height, 0), max(crop_width - width, 0)
+            image = F.pad(image, (pad_width // 2, pad_width - pad_width // 2,
+                                  pad_height // 2, pad_height - pad_height // 2))
+            height, width = image.shape[-2:]
+        top = (height - crop_height) // 2
+        left = (width - crop_width) // 2
+        return image[:, top:top + crop_height, left:left + crop_width]
+
+    def get_anyres_patches(self, image):
+        height, width = image.shape[-2:]
+        target_height, target_width = select_best_resolution((height, width), self.image_grid_pinpoints)
+
+        # resize while keeping the aspect ratio, then pad to the target resolution
+        scale_w = target_width / width
+        scale_h = target_height / height
+        if scale_w < scale_h:
+            new_width = target_width
+            new_height = min(math.ceil(height * scale_w), target_height)
+        else:
+            new_height = target_height
+            new_width = min(math.ceil(width * scale_h), target_width)
+        resized = self.resize(image, new_height, new_width)
+        paste_x = (target_width - new_width) // 2
+        paste_y = (target_height - new_height) // 2
+        padded = F.pad(resized, (paste_x, target_width - new_width - paste_x,
+                                 paste_y, target_height - new_height - paste_y))
+
+        patch_size = self.crop_size["height"]
+        patches = padded.unfold(1, patch_size, patch_size).unfold(2, patch_size, patch_size)
+        patches = patches.permute(1, 2, 0, 3, 4).reshape(-1, padded.size(0), patch_size, patch_size)
+
+        if "shortest_edge" in self.size:
+            base_height = base_width = self.size["shortest_edge"]
+        else:
+            base_height, base_width = self.size["height"], self.size["width"]
+        base_image = self.resize(image, base_height, base_width)
+        return torch.cat([base_image[None], patches], dim=0)
+
+    def prepare(self, image):
+        if self.do_resize:
+            image = self.resize_shortest_edge(image)
+        if self.do_center_crop:
+            image = self.center_crop(image)
+        return image
+
+    def __call__(self, images, return_tensors=None, **kwargs):
+        # images: PIL images or the uint8 (3, H, W) tensors of to_tensor
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        images = [image if torch.is_tensor(image) else self.to_tensor(image) for image in images]
+
+        image_sizes = None
+        if self.image_grid_pinpoints is not None:
+            image_sizes = [list(image.shape[-2:]) for image in images]
+            tiles = [torch.stack([self.prepare(patch) for patch in self.get_anyres_patches(image)], dim=0)
+                     for image in images]
+        else:
+            tiles = [self.prepare(image)[None] for image in images]
+
+        # rescale and normalize all tiles at once
+        num_tiles = [len(t) for t in tiles]
+        pixel_values = torch.cat(tiles, dim=0).float()
+        if self.do_rescale:
+            pixel_values = pixel_values * self.rescale_factor
+        if self.do_normalize:
+            pixel_values = (pixel_values - self.image_mean) / self.image_std
+
+        if image_sizes is not None:
+            pixel_values = list(torch.split(pixel_values, num_tiles, dim=0))
+            outputs = {"pixel_values": pixel_values, "image_sizes": image_sizes}
+        else:
+            outputs = {"pixel_values": list(pixel_values)}
+        if return_tensors == "pt":
+            outputs["pixel_values"] = torch.stack(outputs["pixel_values"], dim=0) \
+                if image_sizes is None or len(set(num_tiles)) == 1 else outputs["pixel_values"]
+            if image_sizes is not None:
+                outputs["image_sizes"] = torch.tensor(image_sizes, dtype=torch.long)
+        return outputs
+
+
+class PendingImage:
+    # a decoded image whose preprocessing is left to the collator, so that the images of a batch are processed together
+
+    def __init__(self, processor, image):
+        self.processor = processor
+        self.image = processor.to_tensor(image)
+
+    @property
+    def image_sizes(self):
+        return list(self.image.shape[-2:])
+
+
+def _find_pending_images(value, found):
+    if isinstance(value, PendingImage):
+        found[id(value)] = value
+    elif isinstance(value, dict):
+        for item in value.values():
+            _find_pending_images(item, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _find_pending_images(item, found)
+
+
+def _replace_pending_images(value, pixel_values):
+    if isinstance(value, PendingImage):
+        return pixel_values[id(value)]
+    if isinstance(value, dict):
+        for key in value:
+            value[key] = _replace_pending_images(value[key], pixel_values)
+    elif isinstance(value, list):
+        value[:] = [_replace_pending_images(item, pixel_values) for item in value]
+    elif isinstance(value, tuple):
+        value = tuple(_replace_pending_images(item, pixel_values) for item in value)
+    return value
+
+
+def process_pending_images(data):
+    """
+    Replace the PendingImage objects of the samples of a batch by their pixel values (as VQADataset.process_image
+    returns them), with one processor call for all images of the batch. An image shared by several samples (e.g.,
+    by the candidates of a query) is processed once and stays shared.
+    """
+    found = {}
+    _find_pending_images(data, found)
+    if len(found) == 0:
+        return data
+    groups = {}
+    for pending in found.values():
+        groups.setdefault(id(pending.processor), []).append(pending)
+    pixel_values = {}
+    for group in groups.values():
+        outputs = group[0].processor([pending.image for pending in group])
+        for pending, pixel_value in zip(group, outputs["pixel_values"]):
+            pixel_values[id(pending)] = pixel_value
+    return _replace_pending_images(data, pixel_values)
@@ -4,8 +4,9 @@ import os
 import copy
 import training.utils.data.DST as DST
 from .vqa_dataset import VQADataset
-from training.utils.utils import get_rank
+from training.utils.utils import get_rank, print_rank_0
 from .utils import save_debug_text
+from .fast_image_processor import process_pending_images
 
 
 import torch
@@ -61,11 +62,12 @@ class LlavaDataset(VQADataset):
         
         res_list_all = []
         image_number = 1
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             if 'image' in ann.keys():
                 if ann['image'] is not None:
                     if ("," in ann['image']) and (self.template == 'llama-3.2-vision'):  # support for sft with multi-images on the LLaMA-3.2-vision model
-                        all_image_paths = ann['image'].split(",")
+                        all_image_paths = self.get_image_names(ann)
                         all_images = []
                         all_aspect_ratio_ids = []
                         all_aspect_ratio_mask = []
@@ -196,6 +198,14 @@ class LlavaComparsionDataset(VQADataset):
         per_sample_image = 1
         super().__init__(data_path, data_debug_path, per_sample_image, tokenizer, vis_processor,
                          vis_root, ann_paths, **kwargs)
+        # a query needs a chosen and a rejected candidate at least, otherwise its pairs would run into the
+        # candidates of the next query of the batch
+        num_annotations = len(self.annotation)
+        self.annotation = [anns for anns in self.annotation
+                           if all(len(ann["conversations"][1]["value"]) >= 2 for ann in anns)]
+        if len(self.annotation) < num_annotations:
+            print_rank_0(f"drop {num_annotations - len(self.annotation)} queries with less than 2 candidates")
+            self.cat_number()
 
     def _add_instance_ids(self, key="id"):
         for idx, ann in enumerate(self.annotation):
@@ -204,6 +214,7 @@ class LlavaComparsionDataset(VQADataset):
     def __getitem__(self, index):
         outputs = []
         res_list = []
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             if self.template == 'llava_next':
                 image, image_sizes = self.process_image(ann,
@@ -230,37 +241,22 @@ class LlavaComparsionDataset(VQADataset):
             ranked_candidates = text['answer']
             query_id = [ann["id"]]
 
-            if len(ranked_candidates) > len(ranked_candidates):
-                pass
-            else:
-                candi_num = len(ranked_candidates)
-                for rc in ranked_candidates:
-                    res_list = []
-                    text_tmp = {'instruction': text['instruction'], 'answer': rc}
-                    res = self.tokenize(text_tmp)
-                    res.update(image=image)
-                    if self.template == 'llava_next':
-                        res.update(image_sizes=image_sizes)
-                    elif self.template == 'llama-3.2-vision':
-                        res.update(aspect_ratio_ids=aspect_items['aspect_ratio_ids'])
-                        res.update(aspect_ratio_mask=aspect_items['aspect_ratio_mask'])
-                    res.update(text_tmp)
-                    res.update(query_id=query_id)
-                    res_list.append(res)
-                    output = self.merge_all_images(res_list, text)
-                    outputs.append(output)
-
-                for i in range(self.max_cand_num - candi_num):
-                    tmp = {
-                        "input_ids": [0 for item in outputs[0]['input_ids']],
-                        "attention_mask": [0 for item in outputs[0]['attention_mask']],
-                        "labels": [0 for item in outputs[0]['labels']],
-                        "score": [],
-                        "image": [None for item in outputs[0]['image']],
-                        "image_num": 0
-                    }
-                    tmp["input_ids"][0] = -1
-                    outputs.append(tmp)
+            for rc in ranked_candidates:
+                res_list = []
+                text_tmp = {'instruction': text['instruction'], 'answer': rc}
+                res = self.tokenize(text_tmp)
+                res.update(image=image)
+                if self.template == 'llava_next':
+                    res.update(image_sizes=image_sizes)
+                elif self.template == 'llama-3.2-vision':
+                    res.update(aspect_ratio_ids=aspect_items['aspect_ratio_ids'])
+                    res.update(aspect_ratio_mask=aspect_items['aspect_ratio_mask'])
+                res.update(text_tmp)
+                res.update(query_id=query_id)
+                res_list.append(res)
+                output = self.merge_all_images(res_list, text)
+                outputs.append(output)
+        # the candidate groups are ragged, the collator records the offsets of each group
         return outputs
 
     def process_text(self, ann, data_debug_path=None, data_debug_counter=0, first_message=False):
@@ -307,6 +303,7 @@ class LlavaRMPaddingDataset(VQADataset):
     def __getitem__(self, index):
         outputs = []
         res_list = []
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             if ann['image'] != None:
                 image = self.process_image(ann,
@@ -327,7 +324,6 @@ class LlavaRMPaddingDataset(VQADataset):
             if len(ranked_candidates) > self.max_cand_num:
                 pass
             else:
-                candi_num = len(ranked_candidates)
                 for rc in ranked_candidates:
                     res_list = []
                     text_tmp = {'instruction': text['instruction'], 'answer': rc}
@@ -337,19 +333,7 @@ class LlavaRMPaddingDataset(VQADataset):
                     res_list.append(res)
                     output = self.merge_all_images(res_list, text)
                     outputs.append(output)
-                for i in range(self.max_cand_num - candi_num):
-                    # import pdb; pdb.set_trace()
-
-                    tmp = {
-                        "input_ids": [0 for item in outputs[0]['input_ids']],
-                        "attention_mask": [0 for item in outputs[0]['attention_mask']],
-                        "labels": [0 for item in outputs[0]['labels']],
-                        "score": [],
-                        "image": [None for item in outputs[0]['image']],
-                        "image_num": 0
-                    }
-                    tmp["input_ids"][0] = -1
-                    outputs.append(tmp)
+        # the candidate groups are ragged, the collator records the offsets of each group
         return outputs
 
     def process_text(self, ann, data_debug_path=None, data_debug_counter=0, first_message=False):
@@ -396,6 +380,7 @@ class LlavaRewardMseDataset(VQADataset):
     def __getitem__(self, index):
         outputs = []
         res_list = []
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             if ann['image'] != None:
                 image = self.process_image(ann,
@@ -491,6 +476,7 @@ class LlavaPPODataset(VQADataset):
 
     def __getitem__(self, index):
         res_list = []
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             if ann['image'] != None:
                 if self.template == 'llava_next':
@@ -591,6 +577,7 @@ class LlavaPredictDataset(VQADataset):
     
     def __getitem__(self, index):
         res_list = []
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             if self.template == 'llava_next':
                 image, image_sizes = self.process_image(ann,
@@ -681,6 +668,7 @@ class LlavaPredictDataset(VQADataset):
         return dict(instruction=instruction, answer=answer)
 
     def collater(self, samples):
+        samples = process_pending_images(samples)
         image_list, question_list, answer_list, input_id_list, attention_mask_list, labels_list, id_list = [], [], [], [], [], [],[]
 
         for sample in samples:
@@ -1,10 +1,15 @@
 import torch
-from torch.utils.data import Subset
+from torch.utils.data import Subset, ConcatDataset
 from torch.nn.utils.rnn import pad_sequence
 import numpy as np
 import shutil
+import os
+import math
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
 from torch.utils.data.dataloader import default_collate
 import training.utils.data.DST as DST
+from .fast_image_processor import process_pending_images
 
 NUM_DEBUG_SAMPLE = 10
 
@@ -36,6 +41,50 @@ def save_debug_text(text_to_save, data_debug_path, data_debug_counter, rank):
         with open(f"{data_debug_path}/gpu_rank{rank}_debug{data_debug_counter}_text.txt", 'w') as f:
             f.write(f"{text_to_save}")
 
+def get_min_decode_edge(vis_processor):
+    # the smallest shortest-edge (in pixels) the image processor may need from a decoded image.
+    # we only use it as the lower bound of JPEG draft decoding, so being conservative is fine.
+    if vis_processor is None:
+        return None
+    size = getattr(vis_processor, "size", None)
+    if size is None:
+        return None
+    if "shortest_edge" in size:
+        min_edge = size["shortest_edge"]
+    else:
+        min_edge = max(size.get("height", 0), size.get("width", 0))
+    # llava_next: anyres tiles can be as large as the biggest grid pinpoint
+    grid_pinpoints = getattr(vis_processor, "image_grid_pinpoints", None)
+    if grid_pinpoints:
+        min_edge = max([min_edge] + [max(pinpoint) for pinpoint in grid_pinpoints])
+    # llama-3.2-vision: the canvas can span all tiles in one direction
+    max_image_tiles = getattr(vis_processor, "max_image_tiles", None)
+    if max_image_tiles:
+        min_edge = min_edge * max_image_tiles
+    return min_edge if min_edge > 0 else None
+
+def decode_image(image_path, min_edge=None):
+    image = Image.open(image_path)
+    if min_edge is not None and image.format == "JPEG":
+        # let libjpeg decode at 1/2, 1/4 or 1/8 scale as long as the shortest edge stays >= min_edge,
+        # draft() is a no-op when the image is not large enough.
+        width, height = image.size
+        scale = min_edge / min(width, height)
+        if scale < 0.5:
+            image.draft("RGB", (math.ceil(width * scale), math.ceil(height * scale)))
+    return image.convert("RGB")
+
+_DECODE_POOL = None
+_DECODE_POOL_PID = None
+
+def get_decode_pool(num_threads=4):
+    # one bounded pool per process (dataloader workers are forked, so never reuse the parent pool)
+    global _DECODE_POOL, _DECODE_POOL_PID
+    if _DECODE_POOL is None or _DECODE_POOL_PID != os.getpid():
+        _DECODE_POOL = ThreadPoolExecutor(max_workers=max(1, num_threads))
+        _DECODE_POOL_PID = os.getpid()
+    return _DECODE_POOL
+
 class DataCollatorPadToMaxLenForMSERewardModel:
 
     def __init__(self, max_token_len, pad_token_id, image_size):
@@ -44,6 +93,7 @@ class DataCollatorPadToMaxLenForMSERewardModel:
         self.image_size = image_size
 
     def __call__(self, data):
+        data = process_pending_images(data)
         batch = {}
         # data = data[0]
         data = [data[i][j] for i in range(len(data)) for j in range(len(data[0]))]
@@ -82,6 +132,13 @@ class DataCollatorPadToMaxLenForMSERewardModel:
         batch['score'] = score_list
         return batch
 
+def collate_ragged_tiles(image_data):
+    # the anyres tiles of llava-next images ([1, num_tiles, C, H, W] each) are not padded to the same number:
+    # return the tiles of all images ([total tiles, C, H, W]) and the number of tiles of each image.
+    # The placeholder of a text-only sample keeps 5 zero tiles, the model drops the ones beyond its image_sizes
+    tiles = [image.reshape(-1, *image.shape[-3:]) for image in image_data]
+    return torch.cat(tiles, dim=0), torch.LongTensor([len(image_tiles) for image_tiles in tiles])
+
 class DataCollatorPadToMaxLen:
 
     def __init__(self, max_token_len, pad_token_id, image_size):
@@ -90,6 +147,7 @@ class DataCollatorPadToMaxLen:
         self.image_size = image_size # {'height': 336, 'width': 336}
 
     def __call__(self, data):
+        data = process_pending_images(data)
         batch = {}
         input_ids = pad_sequence([default_collate(f['input_ids']) for f in data], 
                                   padding_value=self.pad_token_id, 
@@ -139,18 +197,10 @@ class DataCollatorPadToMaxLen:
                     image_num.append(single_data['image_num'])
                     # check multiple images?
                 elif 'image_sizes' in single_data.keys():
+                    # the tiles are kept ragged, see collate_ragged_tiles
                     if len(single_data['image_sizes']) != 0:
                         image_sizes.append(default_collate(single_data['image_sizes']))
-                        if default_collate(single_data['image']).size(1) == 5:
-                            image_data.append(default_collate(single_data['image']))
-                        else:
-                            tmp_image = default_collate(single_data['image'])
-                            current_dim_size = tmp_image.size(1)
-                            padding_size = 5 - current_dim_size
-                            tmp_image = torch.nn.functional.pad(tmp_image, (0, 0, 0, 0, 0, 0, 0, padding_size), "constant", 0)
-                            image_data.append(tmp_image)
-                    else:
-                        image_data.append(default_collate(single_data['image']))
+                    image_data.append(default_collate(single_data['image']))
                 else:
                     image_data.append(default_collate(single_data['image'][0]).unsqueeze(0))
                     image_num.append(single_data['image_num'])
@@ -191,7 +241,10 @@ class DataCollatorPadToMaxLen:
             
             batch['image_sizes'] = image_sizes
 
-        image = torch.cat(image_data, dim=0)
+        if 'image_sizes' in data[0].keys():
+            image, batch['image_num_tiles'] = collate_ragged_tiles(image_data)
+        else:
+            image = torch.cat(image_data, dim=0)
 
         batch['input_ids'] = input_ids
         batch['labels'] = labels
@@ -208,8 +261,17 @@ class DataCollatorPadToMaxLenForRewardModel:
         self.image_size = image_size
 
     def __call__(self, data):
+        data = process_pending_images(data)
         batch = {}
-        data = [data[i][j] for i in range(len(data)) for j in range(len(data[0]))]
+        # all candidates of a query share the same image, so we only keep one image per query
+        # and use `image_index` to map each candidate (row) to its image.
+        # The number of candidates may differ between queries, the candidates of query i are the rows
+        # candidate_offsets[i]:candidate_offsets[i+1].
+        group_data = [data[i][0] for i in range(len(data))]
+        image_index = [i for i in range(len(data)) for j in range(len(data[i]))]
+        candidate_index = [j for i in range(len(data)) for j in range(len(data[i]))]
+        candidate_offsets = np.cumsum([0] + [len(data[i]) for i in range(len(data))]).tolist()
+        data = [data[i][j] for i in range(len(data)) for j in range(len(data[i]))]
 
         input_ids = pad_sequence([default_collate(f['input_ids']) for f in data], 
                                   padding_value=self.pad_token_id, 
@@ -229,6 +291,10 @@ class DataCollatorPadToMaxLenForRewardModel:
         aspect_ratio_ids = []
         aspect_ratio_mask = []
         for single_data in data:
+            image_num.append(0 if single_data['image'][0] is None else single_data['image_num'])
+            query_ids.append(single_data.get('query_id', None))
+
+        for single_data in group_data:
             if single_data['image'][0] is None:
                 if 'image_sizes' in single_data.keys():
                     image_data.append(torch.zeros(1, 5, 3, self.image_size['height'],self.image_size['width']))
@@ -239,21 +305,12 @@ class DataCollatorPadToMaxLenForRewardModel:
                     aspect_ratio_mask.append(torch.LongTensor([[0,0,0,0]]))
                 else:
                     image_data.append(torch.zeros(1, 3, self.image_size['height'],self.image_size['width']))
-                image_num.append(0)
             else:
                 if 'image_sizes' in single_data.keys():
+                    # the tiles are kept ragged, see collate_ragged_tiles
                     if len(single_data['image_sizes']) != 0:
                         image_sizes.append(default_collate(single_data['image_sizes']))
-                        if default_collate(single_data['image']).size(1) == 5:
-                            image_data.append(default_collate(single_data['image']))
-                        else:
-                            tmp_image = default_collate(single_data['image'])
-                            current_dim_size = tmp_image.size(1)
-                            padding_size = 5 - current_dim_size
-                            tmp_image = torch.nn.functional.pad(tmp_image, (0, 0, 0, 0, 0, 0, 0, padding_size), "constant", 0)
-                            image_data.append(tmp_image)
-                    else:
-                        image_data.append(default_collate(single_data['image']))
+                    image_data.append(default_collate(single_data['image']))
                 elif 'aspect_ratio_ids' in data[0].keys():
                     aspect_ratio_ids.append(torch.LongTensor(default_collate(single_data['aspect_ratio_ids'])))
                     aspect_ratio_mask.append(torch.LongTensor(default_collate(single_data['aspect_ratio_mask'])))
@@ -261,12 +318,6 @@ class DataCollatorPadToMaxLenForRewardModel:
                     image_data.append(default_collate(single_data['image']))
                 else:
                     image_data.append(default_collate(single_data['image']))
-                
-                image_num.append(single_data['image_num'])
-            try:
-                query_ids.append(single_data['query_id'])
-            except:
-                pass
 
         if 'image_sizes' in data[0].keys():
             image_sizes = torch.concat(image_sizes, dim=0)
@@ -281,6 +332,8 @@ class DataCollatorPadToMaxLenForRewardModel:
             batch['aspect_ratio_mask'] = aspect_ratio_mask
 
             image = torch.concat(image_data, dim=0)
+        elif 'image_sizes' in data[0].keys():
+            image, batch['image_num_tiles'] = collate_ragged_tiles(image_data)
         else:
             image = torch.concat(image_data, dim=0)
     
@@ -288,6 +341,9 @@ class DataCollatorPadToMaxLenForRewardModel:
         batch['labels'] = labels
         batch['attention_mask'] = attention_mask
         batch['image'] = image
+        batch['image_index'] = torch.LongTensor(image_index)
+        batch['candidate_index'] = torch.LongTensor(candidate_index)
+        batch['candidate_offsets'] = torch.LongTensor(candidate_offsets)
         batch['image_num'] = image_num
         batch['query_id'] = query_ids
         return batch
@@ -300,6 +356,7 @@ class DataCollatorPadToMaxLenForPPOTraining:
         self.image_size = image_size
 
     def __call__(self, data):
+        data = process_pending_images(data)
         batch = {}
 
         input_ids = pad_sequence([default_collate(torch.flip(torch.LongTensor(f['input_ids']), dims=[-1]).tolist()) for f in data],
@@ -337,18 +394,10 @@ class DataCollatorPadToMaxLenForPPOTraining:
                 image_num.append(0)
             else:
                 if 'image_sizes' in single_data.keys():
+                    # the tiles are kept ragged, see collate_ragged_tiles
                     if len(single_data['image_sizes']) != 0:
                         image_sizes.append(default_collate(single_data['image_sizes']))
-                        if default_collate(single_data['image']).size(1) == 5:
-                            image_data.append(default_collate(single_data['image']))
-                        else:
-                            tmp_image = default_collate(single_data['image'])
-                            current_dim_size = tmp_image.size(1)
-                            padding_size = 5 - current_dim_size
-                            tmp_image = torch.nn.functional.pad(tmp_image, (0, 0, 0, 0, 0, 0, 0, padding_size), "constant", 0)
-                            image_data.append(tmp_image)
-                    else:
-                        image_data.append(default_collate(single_data['image']))
+                    image_data.append(default_collate(single_data['image']))
 
                 elif 'aspect_ratio_ids' in data[0].keys():
                     aspect_ratio_ids.append(torch.LongTensor(default_collate(single_data['aspect_ratio_ids'])))
@@ -359,11 +408,12 @@ class DataCollatorPadToMaxLenForPPOTraining:
                 
                 image_num.append(single_data['image_num'])
 
-        image = torch.concat(image_data, dim=0)
-
         if 'image_sizes' in data[0].keys():
+            image, batch['image_num_tiles'] = collate_ragged_tiles(image_data)
             image_sizes = torch.concat(image_sizes, dim=0)
             batch['image_sizes'] = image_sizes
+        else:
+            image = torch.concat(image_data, dim=0)
 
         if 'aspect_ratio_ids' in data[0].keys():
             aspect_ratio_ids = torch.concat(aspect_ratio_ids, dim=0)
@@ -381,6 +431,8 @@ class DataCollatorPadToMaxLenForPPOTraining:
         return batch
 
 class DataCollatorPadToMaxLenForPrediction:
+    # left-pads the prompts of a batch, the anyres patches of llava-next are zero-padded to the most patches of the
+    # batch (the model drops them by image_sizes). batch['id'] holds the id of each row
 
     def __init__(self, max_token_len, pad_token_id, image_size):
         self.max_token_len = max_token_len
@@ -388,49 +440,59 @@ class DataCollatorPadToMaxLenForPrediction:
         self.image_size = image_size
 
     def __call__(self, data):
+        data = process_pending_images(data)
         batch = {}
- 
-        input_ids = data[0]['input_ids']
-        labels = data[0]['labels']
-        attention_mask = data[0]['attention_mask']
-        sample_id = data[0]['id']
-
-        if len(data[0]['image']) == 0:
-            if 'image_sizes' in data[0].keys():
-                image_data.append(torch.zeros(1, 5, 3, self.image_size['height'],self.image_size['width']))
-                image_sizes = []
-                image_sizes.append(torch.LongTensor([123, 123]))
-            elif 'aspect_ratio_ids' in data[0].keys():
-                image_data.append(torch.zeros(1, 4, 3, self.image_size['height'],self.image_size['width']))
-                aspect_ratio_ids = []
-                aspect_ratio_mask = []
-                aspect_ratio_ids.append(torch.LongTensor([[4]]))
-                aspect_ratio_mask.append(torch.LongTensor([[[0,0,0,0]]]))
+
+        input_ids = pad_sequence([torch.flip(torch.LongTensor(f['input_ids']), dims=[-1]) for f in data],
+                                 padding_value=self.pad_token_id,
+                                 batch_first=True)
+        input_ids = torch.flip(input_ids, dims=[-1])
+
+        labels = pad_sequence([torch.flip(torch.LongTensor(f['labels']), dims=[-1]) for f in data],
+                              padding_value=DST.DEFAULT_LABEL_PADDING_NUM,
+                              batch_first=True)
+        labels = torch.flip(labels, dims=[-1])
+
+        attention_mask = pad_sequence([torch.flip(torch.LongTensor(f['attention_mask']), dims=[-1]) for f in data],
+                                      padding_value=0,
+                                      batch_first=True)
+        attention_mask = torch.flip(attention_mask, dims=[-1])
+
+        image_num = []
+        image_data = []
+        image_sizes = []
+        aspect_ratio_ids = []
+        aspect_ratio_mask = []
+        for single_data in data:
+            if len(single_data['image']) == 0:
+                if 'image_sizes' in data[0].keys():
+                    image_data.append(torch.zeros(5, 3, self.image_size['height'],self.image_size['width']))
+                    image_sizes.append(torch.LongTensor([[123, 123]]))
+                elif 'aspect_ratio_ids' in data[0].keys():
+                    image_data.append(torch.zeros(1, 4, 3, self.image_size['height'],self.image_size['width']))
+                    aspect_ratio_ids.append(torch.LongTensor([[4]]))
+                    aspect_ratio_mask.append(torch.LongTensor([[[0,0,0,0]]]))
+                else:
+                    image_data.append(torch.zeros(1, 3, self.image_size['height'],self.image_size['width']))
+                image_num.append(0)
             else:
-                image_data.append(torch.zeros(1, 3, self.image_size['height'],self.image_size['width']))
-            image_num = [0]
-        else:
-            image_num = []
-            image_data = []
-            image_sizes = []
-            aspect_ratio_ids = []
-            aspect_ratio_mask = []
-            
-            for single_data in data:
                 if 'image_sizes' in single_data.keys():
                     if len(single_data['image_sizes']) != 0:
                         image_sizes.append(torch.LongTensor(default_collate(single_data['image_sizes'])))
-                
+
                 if 'aspect_ratio_ids' in single_data.keys():
                     aspect_ratio_ids.append(torch.LongTensor(default_collate(single_data['aspect_ratio_ids'])))
                     aspect_ratio_mask.append(torch.LongTensor(default_collate(single_data['aspect_ratio_mask'])))
 
                 image_data.append(default_collate(single_data['image'][0]))
-                    
                 image_num.append(single_data['image_num'])
 
+        if 'image_sizes' in data[0].keys() and len(data) > 1:
+            num_patches = max(image.size(0) for image in image_data)
+            image_data = [torch.nn.functional.pad(image, (0, 0, 0, 0, 0, 0, 0, num_patches - image.size(0)), "constant", 0)
+                          for image in image_data]
         image = torch.concat(image_data, dim=0)
-        
+
         if 'image_sizes' in data[0].keys():
             image_sizes = torch.concat(image_sizes, dim=0)
             batch['image_sizes'] = image_sizes
@@ -442,10 +504,80 @@ class DataCollatorPadToMaxLenForPrediction:
             batch['aspect_ratio_ids'] = aspect_ratio_ids
             batch['aspect_ratio_mask'] = aspect_ratio_mask
 
-        batch['input_ids'] = torch.LongTensor(input_ids).unsqueeze(0)
-        batch['labels'] = torch.LongTensor(labels).unsqueeze(0)
-        batch['attention_mask'] = torch.LongTensor(attention_mask).unsqueeze(0)
+        batch['input_ids'] = input_ids
+        batch['labels'] = labels
+        batch['attention_mask'] = attention_mask
         batch['image'] = image
         batch['image_num'] = image_num
-        batch['id'] = sample_id
-        return batch
\ No newline at end of file
+        batch['id'] = [f['id'][0] for f in data]
+        return batch
+
+
+def get_sample_annotations(dataset):
+    # the annotations (the list of concatenated samples) of each sample, without decoding any image. Concatenated
+    # and subsampled datasets are walked down to their VQADataset
+    if isinstance(dataset, ConcatDataset):
+        return [anns for sub_dataset in dataset.datasets for anns in get_sample_annotations(sub_dataset)]
+    if isinstance(dataset, Subset):
+        annotations = get_sample_annotations(dataset.dataset)
+        return [annotations[i] for i in dataset.indices]
+    return dataset.annotation
+
+
+def get_prompt_lengths(dataset):
+    """
+    The prompt length (in tokens) and the number of images of each sample of a prediction dataset, computed from the
+    annotations so that no image is decoded. Concatenated and subsampled datasets are walked down to their VQADataset.
+    """
+    if isinstance(dataset, ConcatDataset):
+        lengths, image_nums = [], []
+        for sub_dataset in dataset.datasets:
+            sub_lengths, sub_image_nums = get_prompt_lengths(sub_dataset)
+            lengths.extend(sub_lengths)
+            image_nums.extend(sub_image_nums)
+        return lengths, image_nums
+    if isinstance(dataset, Subset):
+        lengths, image_nums = get_prompt_lengths(dataset.dataset)
+        return [lengths[i] for i in dataset.indices], [image_nums[i] for i in dataset.indices]
+
+    lengths, image_nums = [], []
+    for anns in dataset.annotation:
+        length, image_num = 0, 0
+        for ann in anns:
+            text = dataset.process_text(ann, first_message=True, with_image=True)
+            length += len(dataset.tokenize(text)["input_ids"])
+            if (DST.DEFAULT_IMAGE_TOKEN in text["instruction"]) or ("<|image|>" in text["instruction"]):
+                image_num += 1
+        lengths.append(length)
+        image_nums.append(image_num)
+    return lengths, image_nums
+
+
+class BucketedBatchSampler:
+    """
+    Batch sampler for prediction: the samples are grouped by their number of images and sorted by prompt length
+    (longest first), then cut into batches of up to `batch_size` samples, so that the prompts of a batch need little
+    padding and the batch has the same image shapes. The batches are dealt to the ranks in turn, every sample is in
+    exactly one batch of one rank. `lengths` and `image_nums` come from get_prompt_lengths.
+    """
+
+    def __init__(self, lengths, image_nums, batch_size, num_replicas=None, rank=None):
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size() if torch.distributed.is_initialized() else 1
+        if rank is None:
+            rank = torch.distributed.get_rank() if torch.distributed.is_initialized() else 0
+
+        order = sorted(range(len(lengths)), key=lambda i: (image_nums[i], -lengths[i], i))
+        batches = []
+        for index in order:
+            if len(batches) > 0 and len(batches[-1]) < batch_size and image_nums[batches[-1][0]] == image_nums[index]:
+                batches[-1].append(index)
+            else:
+                batches.append([index])
+        self.batches = batches[rank::num_replicas]
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
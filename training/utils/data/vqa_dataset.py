@@ -7,6 +7,7 @@
  For full license text, see the LICENSE file in the repo root or https://opensource.org/licenses/BSD-3-Clause
 """
 
+import bisect
 import copy
 import json
 import os
@@ -17,13 +18,38 @@ from typing import Iterable
 import numpy as np
 import torch
 from PIL import Image
-from torch.utils.data import ConcatDataset, Dataset
+from torch.utils.data import ConcatDataset as TorchConcatDataset, Dataset, Subset
 from transformers import AutoTokenizer
 import training.utils.data.DST as DST 
-from training.utils.utils import get_rank
-from .utils import save_debug_image, save_debug_text
+from training.utils.utils import get_rank, print_rank_0
+from .fast_image_processor import TorchImageProcessor, PendingImage, process_pending_images
+from .utils import save_debug_image, save_debug_text, get_min_decode_edge, decode_image, get_decode_pool
 import re
 
+def prefetch_samples(dataset, indices):
+    # start decoding the images of the samples `indices` of a dataset (through Subset / ConcatDataset)
+    if isinstance(dataset, Subset):
+        prefetch_samples(dataset.dataset, [dataset.indices[index] for index in indices])
+    elif isinstance(dataset, TorchConcatDataset):
+        groups = {}
+        for index in indices:
+            dataset_idx = bisect.bisect_right(dataset.cumulative_sizes, index)
+            offset = dataset.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0
+            groups.setdefault(dataset_idx, []).append(index - offset)
+        for dataset_idx, sub_indices in groups.items():
+            prefetch_samples(dataset.datasets[dataset_idx], sub_indices)
+    elif isinstance(dataset, VQADataset):
+        dataset.prefetch_samples(indices)
+
+
+class ConcatDataset(TorchConcatDataset):
+
+    def __getitems__(self, indices):
+        # see VQADataset.__getitems__
+        prefetch_samples(self, indices)
+        return [self[index] for index in indices]
+
+
 class VQADataset(Dataset):
     def __init__(
         self,
@@ -38,7 +64,10 @@ class VQADataset(Dataset):
         ignore_instruction=True,
         sample_image=False,
         annotation_key=None,
-        template="default"
+        template="default",
+        fast_image_decode=True,
+        image_decode_threads=4,
+        fast_image_processor=False
     ):
         """
         vis_root (string): Root directory of images (e.g. coco/images/)
@@ -66,6 +95,13 @@ class VQADataset(Dataset):
         self.annotation = DST.random_grouping(self.annotation, self.per_sample_image)
 
         self.vis_processor = vis_processor
+        if fast_image_processor and TorchImageProcessor.is_supported(vis_processor):
+            print_rank_0("use the torch image processor instead of the HF image processor")
+            self.vis_processor = TorchImageProcessor(vis_processor)
+        self.fast_image_decode = fast_image_decode
+        self.image_decode_threads = image_decode_threads
+        self.min_decode_edge = get_min_decode_edge(vis_processor) if fast_image_decode else None
+        self.pending_images = {}
 
         self.option_prob = 0.5
         self.prompter = DST.Prompter()
@@ -96,10 +132,67 @@ class VQADataset(Dataset):
         for idx, ann in enumerate(self.annotation):
             ann[key] = str(idx)
 
+    def get_image_names(self, ann):
+        # the images of an annotation: several comma-separated ones for llama-3.2-vision (see LlavaDataset)
+        if "," in ann["image"] and self.template == "llama-3.2-vision":
+            return ann["image"].split(",")
+        return [ann["image"]]
+
+    def get_image_path(self, image_name):
+        # the key of the prefetched images, process_image loads the same path
+        return os.path.join(self.vis_root, image_name)
+
+    def prefetch_images(self, anns, min_images=2):
+        # decode the images of the annotations concurrently in a bounded thread pool, load_image() then picks up
+        # the decoded result. A single image is decoded in place (a thread would only add a hand-off).
+        if not self.fast_image_decode or self.image_decode_threads <= 1:
+            return
+        image_paths = [self.get_image_path(image_name) for ann in anns if ann.get("image", None) is not None
+                       for image_name in self.get_image_names(ann)]
+        new_paths = set(image_paths) - set(self.pending_images.keys())
+        if len(new_paths) < min_images:
+            return
+        pool = get_decode_pool(self.image_decode_threads)
+        for image_path in image_paths:
+            if image_path not in new_paths:
+                continue
+            if image_path not in self.pending_images:
+                self.pending_images[image_path] = [pool.submit(decode_image, image_path, self.min_decode_edge), 0]
+            # the number of loads the image is kept for, e.g., two samples of a batch with the same image
+            self.pending_images[image_path][1] += 1
+
+    def prefetch_samples(self, indices):
+        # the images of all samples of a batch, the ones of the previous batch are all loaded (or dropped)
+        self.pending_images = {}
+        self.prefetch_images([ann for index in indices for ann in self.annotation[index]], min_images=1)
+
+    def __getitems__(self, indices):
+        # the DataLoader fetches the samples of a batch with __getitems__ (torch >= 2.0, also through Subset in
+        # torch >= 2.1), so that the images of the whole batch are decoded concurrently
+        prefetch_samples(self, indices)
+        return [self[index] for index in indices]
+
+    def load_image(self, image_path):
+        pending = self.pending_images.get(image_path, None)
+        if pending is not None:
+            pending[1] -= 1
+            if pending[1] <= 0:
+                del self.pending_images[image_path]
+            return pending[0].result()
+        if self.fast_image_decode:
+            return decode_image(image_path, self.min_decode_edge)
+        return Image.open(image_path).convert("RGB")
+
     def process_image(self, ann, data_debug_path=None, data_debug_counter=0):
-        image_path = os.path.join(self.vis_root, ann["image"])
+        image_path = self.get_image_path(ann["image"])
         save_debug_image(image_path, data_debug_path, data_debug_counter, get_rank(), img_idx=0)
-        image = Image.open(image_path).convert("RGB")
+        image = self.load_image(image_path)
+        if isinstance(self.vis_processor, TorchImageProcessor):
+            # the collator processes the images of the whole batch at once, see process_pending_images
+            image = PendingImage(self.vis_processor, image)
+            if self.template == 'llava_next':
+                return image, image.image_sizes
+            return image
         image_outputs = self.vis_processor(image)
         try:
             image = image_outputs['pixel_values'][0]
@@ -216,6 +309,7 @@ class VQADataset(Dataset):
 
     def __getitem__(self, index):
         res_list = []
+        self.prefetch_images(self.annotation[index])
         for ann in self.annotation[index]:
             image = self.process_image(ann,
                                     data_debug_path=self.data_debug_path,
@@ -237,6 +331,7 @@ class VQADataset(Dataset):
         return output
 
     def collater(self, samples):
+        samples = process_pending_images(samples)
         image_list, question_list, answer_list, input_id_list, attention_mask_list, labels_list = [], [], [], [], [], []
 
         for sample in samples:
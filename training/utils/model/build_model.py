@@ -10,13 +10,28 @@ from transformers import MllamaForConditionalGeneration, AutoProcessor
 from transformers import AutoTokenizer, AutoProcessor
 from .modeling_dsvl import create_dsvl_model_and_transforms
 from ..data import DST
+from ..module.lora import convert_linear_layer_to_lora, only_optimize_lora_parameters, has_lora_layers
+
+
+def apply_lora(model, lang_decoder, vis_encoder, args):
+    # replace the linear layers of the language decoder / vision encoder by LoRA layers in place, the base
+    # weights are frozen while the adapters are trained even if the decoder / encoder is frozen
+    if getattr(args, "lang_lora_dim", 0) > 0:
+        convert_linear_layer_to_lora(lang_decoder, args.lang_lora_module_name, args.lang_lora_dim)
+    if getattr(args, "vis_lora_dim", 0) > 0:
+        convert_linear_layer_to_lora(vis_encoder, args.vis_lora_module_name, args.vis_lora_dim)
+    if getattr(args, "only_optimize_lora", False) and has_lora_layers(model):
+        only_optimize_lora_parameters(model)
+    return model
 
 # You can design (or specify) the architecture of vision LLM.
 def build_model(text_tokenizer=None,
                 ds_config=None,
                 args=None,
                 model_architecture=None,
-                from_checkpoint=None):
+                from_checkpoint=None,
+                enable_lora=True):
+    # enable_lora: apply the LoRA settings of args (`lang_lora_dim`, `vis_lora_dim`), disable it for the frozen models
     
     if model_architecture is None:
         model_architecture = args.model_architecture
@@ -29,6 +44,8 @@ def build_model(text_tokenizer=None,
             text_tokenizer=text_tokenizer,
             args=args,
             ds_config=ds_config)
+        if enable_lora and model_architecture == 'default':
+            apply_lora(model, model.lang_decoder, model.vis_encoder, args)
         return model, image_processor, tokenizer
     
     elif model_architecture=="llava":
@@ -50,6 +67,9 @@ def build_model(text_tokenizer=None,
         else:
             model.language_model.requires_grad_(False)
 
+        if enable_lora:
+            apply_lora(model, model.language_model, model.vision_tower, args)
+
         return model, image_processor, tokenizer
 
     elif model_architecture=="llava_next":
@@ -71,6 +91,9 @@ def build_model(text_tokenizer=None,
         else:
             model.language_model.requires_grad_(False)
 
+        if enable_lora:
+            apply_lora(model, model.language_model, model.vision_tower, args)
+
         return model, image_processor, tokenizer
 
     elif model_architecture=="llama-3.2-vision":
@@ -92,6 +115,9 @@ def build_model(text_tokenizer=None,
             model.language_model.requires_grad_(True)
         else:
             model.language_model.requires_grad_(False)
+
+        if enable_lora:
+            apply_lora(model, model.language_model, model.vision_model, args)
         
         tokenizer.pad_token_id = 128002
         tokenizer.bos_token_id = 128000
@@ -18,7 +18,8 @@ from transformers.deepspeed import HfDeepSpeedConfig
 import numpy as np
 from .vis_proj import VisProjection_vit, VisProjection_perceiver
 from ..utils import load_state_dict_into_model
-from .build_model import build_model
+from .build_model import build_model, apply_lora
+from .vision_feature import get_mllama_cross_attention_states, broadcast_images
 
 def get_name(huggingface_path):
     if 'opt' in huggingface_path.lower():
@@ -103,22 +104,27 @@ def create_reward_or_critic_model(
             ds_config=None,
             is_reward=True,
             training_reward_stage=False,
-            args=None):
+            args=None,
+            enable_lora=True):
     
     if args.reward_model_architecture=="default" and is_reward:
         vis_llm, reward_image_processor, reward_tokenizer = create_dsvl_model_and_transforms(text_tokenizer=text_tokenizer,
                                                                                             ds_config=ds_config,
                                                                                             args=args)
+        if enable_lora:
+            apply_lora(vis_llm, vis_llm.lang_decoder, vis_llm.vis_encoder, args)
     elif is_reward:
         vis_llm, reward_image_processor, reward_tokenizer = build_model(text_tokenizer=text_tokenizer,
                                                                             ds_config=ds_config,
                                                                             model_architecture=args.reward_model_architecture,
                                                                             from_checkpoint=args.reward_base_model,
-                                                                            args=args)
+                                                                            args=args,
+                                                                            enable_lora=enable_lora)
     else:
         vis_llm, reward_image_processor, reward_tokenizer = build_model(text_tokenizer=text_tokenizer,
                                                                     ds_config=ds_config,
-                                                                    args=args)
+                                                                    args=args,
+                                                                    enable_lora=enable_lora)
 
     # load paramters from `from_checkpoint`
     if training_reward_stage and args.model_architecture=='default':
@@ -205,7 +211,21 @@ class ViRewardModel(nn.Module):
                 use_cache=False,
                 output_attentions=False, 
                 output_hidden_states=True,
-                return_dict=True):
+                return_dict=True,
+                image_index=None,
+                image_num_tiles=None):
+
+        # image_index: the image (in `img`) of each sequence, used when candidates share one image
+        # image_num_tiles: the tile counts of ragged llava-next images (see collate_ragged_tiles)
+        cross_attention_states = None
+        if image_index is not None:
+            if self.vis_architecture == "llama-3.2-vision":
+                cross_attention_states = get_mllama_cross_attention_states(
+                    self.rwtranrsformer, img, aspect_ratio_ids, aspect_ratio_mask, image_index)
+                img = None
+            elif self.vis_architecture not in ["llava", "llava_next"]:
+                img = broadcast_images(img, image_index)[0]
+                image_index = None
 
         if self.vis_architecture == "default":
             transformer_outputs = self.rwtranrsformer(
@@ -228,7 +248,9 @@ class ViRewardModel(nn.Module):
                         attention_mask=attention_mask,
                         labels=input_labels,
                         output_hidden_states=output_hidden_states,
-                        return_dict=return_dict)
+                        return_dict=return_dict,
+                        image_index=image_index,
+                        image_num_tiles=image_num_tiles)
             else:
                 transformer_outputs = self.rwtranrsformer(
                         input_ids=lang,
@@ -236,7 +258,8 @@ class ViRewardModel(nn.Module):
                         attention_mask=attention_mask,
                         labels=input_labels,
                         output_hidden_states=output_hidden_states,
-                        return_dict=return_dict)
+                        return_dict=return_dict,
+                        image_index=image_index)
             
             hidden_states = transformer_outputs.hidden_last_layer_drop_image
         elif self.vis_architecture in ["llama-3.2-vision"]:
@@ -245,6 +268,7 @@ class ViRewardModel(nn.Module):
                         pixel_values=img,
                         aspect_ratio_ids=aspect_ratio_ids,
                         aspect_ratio_mask=aspect_ratio_mask,
+                        cross_attention_states=cross_attention_states,
                         attention_mask=attention_mask,
                         labels=None,
                         output_hidden_states=output_hidden_states,
@@ -281,7 +305,9 @@ class ViRewardModel(nn.Module):
                     use_cache=False,
                     output_attentions=False, 
                     output_hidden_states=True,
-                    return_dict=True):
+                    return_dict=True,
+                    vision_features=None):
+        # vision_features: the precomputed vision tower features of `img` (llava and llava_next), see vision_feature.py
         
         if self.vis_architecture == "default":
             transformer_outputs = self.rwtranrsformer(
@@ -304,7 +330,8 @@ class ViRewardModel(nn.Module):
                         attention_mask=attention_mask,
                         labels=input_labels,
                         output_hidden_states=output_hidden_states,
-                        return_dict=return_dict)
+                        return_dict=return_dict,
+                        vision_features=vision_features)
             else:
                 transformer_outputs = self.rwtranrsformer(
                         input_ids=lang,
@@ -312,7 +339,8 @@ class ViRewardModel(nn.Module):
                         attention_mask=attention_mask,
                         labels=input_labels,
                         output_hidden_states=output_hidden_states,
-                        return_dict=return_dict)    
+                        return_dict=return_dict,
+                        vision_features=vision_features)    
             hidden_states = transformer_outputs.hidden_last_layer_drop_image
         elif self.vis_architecture in ["llama-3.2-vision"]:
             transformer_outputs = self.rwtranrsformer(
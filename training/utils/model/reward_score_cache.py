@@ -0,0 +1,168 @@
+import hashlib
+import os
+import sqlite3
+import time
+
+import torch
+import deepspeed
+
+from ..utils import _z3_params_to_fetch
+from .vision_feature import unwrap_model
+
+
+@torch.no_grad()
+def reward_model_fingerprint(model):
+    """
+    Content hash of the weights of a (frozen) reward model: the base model, the trained weights and the value head.
+    Two models with the same fingerprint give the same scores, whatever checkpoint paths they were loaded from.
+    The hash is computed once (gathering the ZeRO-3 partitions, all ranks should call it) and kept on the module.
+    """
+    model = unwrap_model(model)
+    if not hasattr(model, "_reward_score_fingerprint"):
+        digest = hashlib.sha1()
+        digest.update(f"{type(model).__name__}:{getattr(model, 'vis_architecture', '')}".encode())
+        for name, param in model.named_parameters():
+            with deepspeed.zero.GatheredParameters(_z3_params_to_fetch([param]), enabled=hasattr(param, "ds_id")):
+                digest.update(f"{name}:{tuple(param.shape)}:{param.dtype}".encode())
+                digest.update(param.detach().contiguous().view(torch.uint8).cpu().numpy().tobytes())
+        model._reward_score_fingerprint = digest.hexdigest()
+    return model._reward_score_fingerprint
+
+
+def hash_image_file(path):
+    # content hash of an image file, so that the images of the cached scores are not decoded at all
+    digest = hashlib.sha1(b"file:")
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+@torch.no_grad()
+def hash_image_tensors(num_rows, *image_inputs):
+    """
+    Content hash of the (preprocessed) image inputs of every row, e.g., (pixel_values, image_sizes). An input whose
+    first dimension is not the number of rows is hashed as a whole into the key of every row.
+    """
+    digests = [hashlib.sha1(b"tensor:") for _ in range(num_rows)]
+    for image_input in image_inputs:
+        if image_input is None:
+            continue
+        image_input = image_input.detach().contiguous().cpu()
+        if image_input.size(0) == num_rows:
+            for row in range(num_rows):
+                digests[row].update(f"{tuple(image_input[row].shape)}:{image_input.dtype}".encode())
+                digests[row].update(image_input[row].view(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            shared = f"{tuple(image_input.shape)}:{image_input.dtype}".encode() + \
+                image_input.view(-1).view(torch.uint8).numpy().tobytes()
+            for row in range(num_rows):
+                digests[row].update(shared)
+    return [digest.hexdigest() for digest in digests]
+
+
+def get_reward_score_key(fingerprint, image_hash, token_ids):
+    digest = hashlib.sha1(f"{fingerprint}:{image_hash}:".encode())
+    digest.update(",".join(str(token_id) for token_id in token_ids).encode())
+    return digest.digest()
+
+
+class RewardScoreCache:
+    """
+    A persistent reward score store shared by jobs, keyed by (reward model fingerprint, image content hash, token ids),
+    see `get_reward_score_key`. The scores are kept in a sqlite file. When it grows beyond `max_size_mb`, the least
+    recently used scores are evicted. Several processes can share one file on a local disk.
+    """
+
+    def __init__(self, path, max_size_mb=1024, evict_fraction=0.1):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.evict_fraction = evict_fraction
+        self.conn = sqlite3.connect(path, timeout=600, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS scores "
+                          "(key BLOB PRIMARY KEY, score REAL NOT NULL, access REAL NOT NULL) WITHOUT ROWID")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS scores_access ON scores (access)")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_many(self, keys):
+        # the cached score of each key, None for the missing ones
+        found = {}
+        for start in range(0, len(keys), 500):
+            chunk = list(set(keys[start:start + 500]))
+            placeholders = ",".join("?" * len(chunk))
+            found.update(self.conn.execute(f"SELECT key, score FROM scores WHERE key IN ({placeholders})", chunk).fetchall())
+            hit_keys = [key for key in chunk if key in found]
+            if len(hit_keys) > 0:
+                self.conn.execute(f"UPDATE scores SET access = ? WHERE key IN ({','.join('?' * len(hit_keys))})",
+                                  [time.time()] + hit_keys)
+        scores = [found.get(key) for key in keys]
+        self.hits += sum(score is not None for score in scores)
+        self.misses += sum(score is None for score in scores)
+        return scores
+
+    def put_many(self, keys, scores):
+        now = time.time()
+        self.conn.execute("BEGIN")
+        try:
+            self.conn.executemany("INSERT OR REPLACE INTO scores (key, score, access) VALUES (?, ?, ?)",
+                                  [(key, float(score), now) for key, score in zip(keys, scores)])
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.evict()
+
+    def size_bytes(self):
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.conn.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def __len__(self):
+        return self.conn.execute("SELECT COUNT(*) FROM scores").fetchone()[0]
+
+    def evict(self):
+        # the freed pages are reused by the new scores, so the file does not grow beyond the limit
+        size = self.size_bytes()
+        if size <= self.max_bytes:
+            return
+        num_entries = len(self)
+        num_evicted = max(1, int(num_entries * (1.0 - (1.0 - self.evict_fraction) * self.max_bytes / size)))
+        self.conn.execute("DELETE FROM scores WHERE key IN (SELECT key FROM scores ORDER BY access LIMIT ?)", (num_evicted,))
+        self.evictions += num_evicted
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self),
+            "size_mb": self.size_bytes() / 1024 / 1024,
+        }
+
+    def close(self):
+        self.conn.close()
+
+
+def lookup_reward_scores(cache, fingerprint, input_ids, attention_mask, *image_inputs):
+    """
+    Look up the reward scores of a batch (`image_inputs`: the image tensors of the rows, e.g., pixel_values and
+    image_sizes). Return (keys, scores): scores is a tensor when every row is cached on every rank, otherwise None
+    and the reward model should be run (on all ranks, for ZeRO-3) and its scores saved with `cache.put_many(keys, ...)`.
+    """
+    image_hashes = hash_image_tensors(len(input_ids), *image_inputs)
+    keys = [get_reward_score_key(fingerprint, image_hash, ids[mask != 0].tolist())
+            for image_hash, ids, mask in zip(image_hashes, input_ids, attention_mask)]
+    scores = cache.get_many(keys)
+    all_cached = torch.tensor(int(all(score is not None for score in scores)), device=input_ids.device)
+    if torch.distributed.is_initialized():
+        torch.distributed.all_reduce(all_cached, op=torch.distributed.ReduceOp.MIN)
+    if all_cached.item() == 0:
+        return keys, None
+    return keys, torch.tensor(scores, device=input_ids.device)
@@ -73,6 +73,8 @@ class LlavaCausalLMOutputWithPast(ModelOutput):
             sequence_length, hidden_size)`.
 
             image_hidden_states of the model produced by the vision encoder, and optionally by the perceiver
+        attention_mask (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Attention mask of the sequence after merging the image features (used to continue from `past_key_values`).
     """
 
     loss: Optional[torch.FloatTensor] = None
@@ -83,6 +85,7 @@ class LlavaCausalLMOutputWithPast(ModelOutput):
     logits_drop_image: torch.FloatTensor = None
     attentions: Optional[Tuple[torch.FloatTensor]] = None
     image_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    attention_mask: Optional[torch.LongTensor] = None
 
 class LlavaMultiModalProjector(nn.Module):
     def __init__(self, config: LlavaConfig):
@@ -387,6 +390,8 @@ class LlavaForConditionalGeneration(LlavaPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        image_index: Optional[torch.LongTensor] = None,
+        vision_features: Optional[torch.FloatTensor] = None,
     ) -> Union[Tuple, LlavaCausalLMOutputWithPast]:
         r"""
         Args:
@@ -394,6 +399,12 @@ class LlavaForConditionalGeneration(LlavaPreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            image_index (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                Index of the image (in `pixel_values`) used by each sequence. When several sequences share one image
+                (e.g., the ranked candidates of a query), each image is encoded once and its features are broadcast.
+            vision_features (`torch.FloatTensor` of shape `(num_images, num_image_tokens, vision_hidden_size)`, *optional*):
+                The selected vision tower features of `pixel_values` (see `utils.model.vision_feature`), computed
+                once and shared by the models with the same frozen vision tower. The vision tower is skipped.
 
         Returns:
 
@@ -440,20 +451,25 @@ class LlavaForConditionalGeneration(LlavaPreTrainedModel):
             # 2. Merge text and images
             # from training.utils import pdb;pdb.set_trace()
             if pixel_values is not None and input_ids.shape[1] != 1:
-                image_outputs = self.vision_tower(pixel_values, output_hidden_states=True)
-                # this is not memory efficient at all (output_hidden_states=True) will save all the hidden stated.
-                selected_image_feature = image_outputs.hidden_states[vision_feature_layer]
-
-                if vision_feature_select_strategy == "default":
-                    selected_image_feature = selected_image_feature[:, 1:]
-                elif vision_feature_select_strategy == "full":
-                    selected_image_feature = selected_image_feature
+                if vision_features is not None:
+                    selected_image_feature = vision_features
                 else:
-                    raise ValueError(
-                        f"Unexpected select feature strategy: {self.config.vision_feature_select_strategy}"
-                    )
+                    image_outputs = self.vision_tower(pixel_values, output_hidden_states=True)
+                    # this is not memory efficient at all (output_hidden_states=True) will save all the hidden stated.
+                    selected_image_feature = image_outputs.hidden_states[vision_feature_layer]
+
+                    if vision_feature_select_strategy == "default":
+                        selected_image_feature = selected_image_feature[:, 1:]
+                    elif vision_feature_select_strategy == "full":
+                        selected_image_feature = selected_image_feature
+                    else:
+                        raise ValueError(
+                            f"Unexpected select feature strategy: {self.config.vision_feature_select_strategy}"
+                        )
 
                 image_features = self.multi_modal_projector(selected_image_feature)
+                if image_index is not None:
+                    image_features = image_features[image_index.to(image_features.device)]
                 inputs_embeds = inputs_embeds.to(image_features.dtype)
                 inputs_embeds, attention_mask, labels, position_ids, mask_image_labels= self._merge_input_ids_with_image_features(
                     image_features, inputs_embeds, input_ids, attention_mask, labels
@@ -540,10 +556,12 @@ class LlavaForConditionalGeneration(LlavaPreTrainedModel):
             hidden_last_layer_drop_image=hidden_last_layer_drop_image,
             logits_drop_image=logits_drop_image,
             attentions=outputs.attentions,
+            attention_mask=attention_mask,
         )
 
     def prepare_inputs_for_generation(
-        self, input_ids, past_key_values=None, inputs_embeds=None, pixel_values=None, attention_mask=None, **kwargs
+        self, input_ids, past_key_values=None, inputs_embeds=None, pixel_values=None, attention_mask=None,
+        vision_features=None, **kwargs
     ):
         if past_key_values is not None:
             if isinstance(past_key_values, Cache):
@@ -591,6 +609,7 @@ class LlavaForConditionalGeneration(LlavaPreTrainedModel):
                 "use_cache": kwargs.get("use_cache"),
                 "attention_mask": attention_mask,
                 "pixel_values": pixel_values,
+                "vision_features": vision_features,
             }
         )
         return model_inputs
@@ -176,6 +176,8 @@ class LlavaNextCausalLMOutputWithPast(ModelOutput):
             sequence_length, hidden_size)`.
 
             image_hidden_states of the model produced by the vision encoder, and optionally by the perceiver
+        attention_mask (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
+            Attention mask of the sequence after merging the image features (used to continue from `past_key_values`).
     """
 
     loss: Optional[torch.FloatTensor] = None
@@ -186,6 +188,7 @@ class LlavaNextCausalLMOutputWithPast(ModelOutput):
     logits_drop_image: torch.FloatTensor = None
     attentions: Optional[Tuple[torch.FloatTensor]] = None
     image_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
+    attention_mask: Optional[torch.LongTensor] = None
 
 
 # Copied from transformers.models.llava.modeling_llava.LlavaMultiModalProjector with Llava->LlavaNext
@@ -709,6 +712,9 @@ class LlavaNextForConditionalGeneration(LlavaNextPreTrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        image_index: Optional[torch.LongTensor] = None,
+        vision_features: Optional[Tuple[torch.FloatTensor]] = None,
+        image_num_tiles: Optional[torch.LongTensor] = None,
     ) -> Union[Tuple, LlavaNextCausalLMOutputWithPast]:
         r"""
         Args:
@@ -716,6 +722,17 @@ class LlavaNextForConditionalGeneration(LlavaNextPreTrainedModel):
                 Labels for computing the masked language modeling loss. Indices should either be in `[0, ...,
                 config.vocab_size]` or -100 (see `input_ids` docstring). Tokens with indices set to `-100` are ignored
                 (masked), the loss is only computed for the tokens with labels in `[0, ..., config.vocab_size]`.
+            image_index (`torch.LongTensor` of shape `(batch_size,)`, *optional*):
+                Index of the image (in `pixel_values` and `image_sizes`) used by each sequence. When several sequences
+                share one image, each image is encoded once and its features are broadcast.
+            vision_features (`Tuple[torch.FloatTensor]`, *optional*):
+                The selected vision tower features of the patches of each image in `pixel_values` (see
+                `utils.model.vision_feature`), computed once and shared by the models with the same frozen vision
+                tower. The vision tower is skipped.
+            image_num_tiles (`torch.LongTensor` of shape `(num_images,)`, *optional*):
+                The number of tiles of each image in a ragged `pixel_values` of shape `(num_tiles, num_channels, height,
+                width)`, i.e., the tiles of all images concatenated without padding. The tiles beyond the patches of
+                `image_sizes` (e.g., of the placeholder images of text-only samples) are dropped.
 
         Returns:
 
@@ -783,19 +800,34 @@ class LlavaNextForConditionalGeneration(LlavaNextPreTrainedModel):
                 elif pixel_values.dim() != 4:
                     # otherwise has to be stacked from list of (num_patches, num_channels, height, width)
                     raise ValueError(f"pixel_values of shape {pixel_values.shape}, expect to be of 4 or 5 dimensions")
+                elif image_num_tiles is not None:
+                    # ragged tiles: the vision tower only runs on the patches of each image
+                    _pixel_values_list = [
+                        tiles[:num_patch]
+                        for tiles, num_patch in zip(torch.split(pixel_values, image_num_tiles.tolist()), image_num_patches)
+                    ]
+                    pixel_values = torch.cat(_pixel_values_list, dim=0)
 
-                image_features = self.vision_tower(pixel_values, output_hidden_states=True)
-                selected_image_feature = image_features.hidden_states[vision_feature_layer]
+                if vision_features is not None:
+                    selected_image_feature = torch.cat(list(vision_features), dim=0)
+                else:
+                    image_features = self.vision_tower(pixel_values, output_hidden_states=True)
+                    selected_image_feature = image_features.hidden_states[vision_feature_layer]
 
-                if vision_feature_select_strategy == "default":
-                    selected_image_feature = selected_image_feature[:, 1:]
-                elif vision_feature_select_strategy == "full":
-                    selected_image_feature = selected_image_feature
+                    if vision_feature_select_strategy == "default":
+                        selected_image_feature = selected_image_feature[:, 1:]
+                    elif vision_feature_select_strategy == "full":
+                        selected_image_feature = selected_image_feature
 
                 image_features = self.multi_modal_projector(selected_image_feature)
 
                 image_features = torch.split(image_features, image_num_patches, dim=0)
 
+                if image_index is not None:
+                    # broadcast the features of the shared images to every sequence
+                    image_features = [image_features[index] for index in image_index.tolist()]
+                    image_sizes = image_sizes[image_index.to(image_sizes.device)]
+
                 # NOTE we only support multimodal_patch_merge_type == "spatial_unpad"
 
                 image_features, feature_lens = self.pack_image_features(
@@ -928,6 +960,7 @@ class LlavaNextForConditionalGeneration(LlavaNextPreTrainedModel):
             hidden_last_layer_drop_image=hidden_last_layer_drop_image,
             logits_drop_image=logits_drop_image,
             attentions=outputs.attentions,
+            attention_mask=attention_mask,
         )
 
 
@@ -940,6 +973,7 @@ class LlavaNextForConditionalGeneration(LlavaNextPreTrainedModel):
         pixel_values=None,
         image_sizes=None,
         attention_mask=None,
+        vision_features=None,
         **kwargs,
     ):
         if past_key_values is not None:
@@ -989,6 +1023,7 @@ class LlavaNextForConditionalGeneration(LlavaNextPreTrainedModel):
                 "attention_mask": attention_mask,
                 "pixel_values": pixel_values,
                 "image_sizes": image_sizes,
+                "vision_features": vision_features,
             }
         )
         return model_inputs
@@ -0,0 +1,165 @@
+import hashlib
+
+import torch
+import deepspeed
+
+from .third_party_model.hf_model.modeling_llava_next import image_size_to_num_patches
+from ..utils import _z3_params_to_fetch
+
+
+def unwrap_model(model):
+    # deepspeed engine -> the wrapped module
+    return model.module if hasattr(model, "module") else model
+
+
+def unwrap_vision_llm(model):
+    # deepspeed engine / reward (critic) model -> the vision LLM
+    model = unwrap_model(model)
+    return model.rwtranrsformer if hasattr(model, "rwtranrsformer") else model
+
+
+def get_mllama_cross_attention_states(model, pixel_values, aspect_ratio_ids, aspect_ratio_mask, image_index=None):
+    """
+    Run the vision model and the projector of llama-3.2-vision once for each image and return the
+    cross-attention states of each sequence (`image_index` maps every sequence to its image).
+    The result can be passed to the model as `cross_attention_states` instead of `pixel_values`.
+    """
+    model = unwrap_model(model)
+    vision_outputs = model.vision_model(
+        pixel_values=pixel_values,
+        aspect_ratio_ids=aspect_ratio_ids,
+        aspect_ratio_mask=aspect_ratio_mask,
+        output_hidden_states=False,
+        output_attentions=False,
+        return_dict=True,
+    )
+    cross_attention_states = vision_outputs[0]
+    cross_attention_states = model.multi_modal_projector(cross_attention_states).reshape(
+        -1, cross_attention_states.shape[-2], model.config.text_config.hidden_size)
+    if image_index is not None:
+        num_tokens_per_image = cross_attention_states.size(0) // pixel_values.size(0)
+        cross_attention_states = cross_attention_states.reshape(
+            pixel_values.size(0), num_tokens_per_image, *cross_attention_states.shape[1:])
+        cross_attention_states = cross_attention_states[image_index.to(cross_attention_states.device)]
+        cross_attention_states = cross_attention_states.reshape(-1, *cross_attention_states.shape[2:])
+    return cross_attention_states
+
+
+def broadcast_images(images, image_index, *image_inputs):
+    # fallback for the models that can not consume shared images: expand them on the device
+    image_index = image_index.to(images.device)
+    outputs = [images[image_index]]
+    for image_input in image_inputs:
+        outputs.append(image_input[image_index.to(image_input.device)] if image_input is not None else None)
+    return outputs
+
+
+def select_ragged_images(images, image_num_tiles, index):
+    # the tiles (and tile counts) of the images `index` of a ragged llava-next batch, see DataCollatorPadToMaxLen
+    tiles = torch.split(images, image_num_tiles.tolist())
+    return torch.cat([tiles[i] for i in index.tolist()], dim=0), image_num_tiles[index.to(image_num_tiles.device)]
+
+
+def pad_ragged_images(images, image_num_tiles):
+    # ragged llava-next tiles -> [num_images, max tiles, C, H, W], the zero tiles are dropped by the model (image_sizes)
+    tiles = torch.split(images, image_num_tiles.tolist())
+    num_tiles = max(len(image_tiles) for image_tiles in tiles)
+    return torch.stack([torch.nn.functional.pad(image_tiles, (0, 0, 0, 0, 0, 0, 0, num_tiles - len(image_tiles)), "constant", 0)
+                        for image_tiles in tiles], dim=0)
+
+
+@torch.no_grad()
+def vision_tower_fingerprint(vision_tower):
+    """
+    Content hash of a frozen vision tower, two towers with the same fingerprint give the same features.
+    Return None for a trainable tower (e.g., with LoRA adapters), whose features can not be shared.
+    The hash is computed once (gathering the ZeRO-3 partitions) and kept on the module.
+    """
+    if not hasattr(vision_tower, "_vision_feature_fingerprint"):
+        fingerprint = None
+        if not any(p.requires_grad for p in vision_tower.parameters()):
+            digest = hashlib.sha1()
+            for name, param in vision_tower.named_parameters():
+                with deepspeed.zero.GatheredParameters(_z3_params_to_fetch([param]), enabled=hasattr(param, "ds_id")):
+                    digest.update(f"{name}:{tuple(param.shape)}:{param.dtype}".encode())
+                    digest.update(param.detach().contiguous().view(torch.uint8).cpu().numpy().tobytes())
+            fingerprint = digest.hexdigest()
+        vision_tower._vision_feature_fingerprint = fingerprint
+    return vision_tower._vision_feature_fingerprint
+
+
+@torch.no_grad()
+def compute_vision_features(model, pixel_values, image_sizes=None):
+    """
+    The selected vision tower features of llava (`image_sizes` is None) or llava-next, before the projector.
+    They can be passed to the model as `vision_features` (with `pixel_values`) to skip its vision tower:
+    a [num_images, num_tokens, hidden_size] tensor for llava and a tuple of the per-image patch features for llava-next.
+    """
+    model = unwrap_vision_llm(model)
+    config = model.config
+    if image_sizes is not None:
+        image_num_patches = [
+            image_size_to_num_patches(
+                image_size=imsize,
+                grid_pinpoints=config.image_grid_pinpoints,
+                patch_size=config.vision_config.image_size,
+            )
+            for imsize in image_sizes
+        ]
+        if pixel_values.dim() == 5:
+            pixel_values = torch.cat([pix_val[:num_patch] for pix_val, num_patch in zip(pixel_values, image_num_patches)], dim=0)
+
+    vision_features = model.vision_tower(pixel_values, output_hidden_states=True).hidden_states[config.vision_feature_layer]
+    if config.vision_feature_select_strategy == "default":
+        vision_features = vision_features[:, 1:]
+
+    if image_sizes is not None:
+        return torch.split(vision_features, image_num_patches, dim=0)
+    return vision_features
+
+
+class VisionFeatureCache:
+    """
+    Vision tower features shared by the llava / llava-next models whose frozen vision towers hold the same weights,
+    e.g., the actor, reference, critic and reward models of one PPO step that are built from one vision encoder.
+    Entries are keyed by the pixel tensor and the tower fingerprint, call `clear()` when the images change.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self.entries = {}
+
+    def get(self, model, pixel_values, image_sizes=None):
+        # return None if the vision tower is trainable, the model then runs it in its own forward
+        model = unwrap_vision_llm(model)
+        fingerprint = vision_tower_fingerprint(model.vision_tower)
+        if fingerprint is None:
+            return None
+        key = (fingerprint,
+               model.config.vision_feature_layer,
+               model.config.vision_feature_select_strategy,
+               pixel_values.data_ptr(),
+               tuple(pixel_values.shape),
+               pixel_values.stride(),
+               pixel_values.dtype,
+               pixel_values._version,
+               None if image_sizes is None else tuple(map(tuple, image_sizes.tolist())))
+        if key in self.entries:
+            self.hits += 1
+            return self.entries[key][1]
+        self.misses += 1
+        vision_features = compute_vision_features(model, pixel_values, image_sizes)
+        # keep the pixel tensor alive, so that its memory (part of the key) is not reused by another tensor
+        self.entries[key] = (pixel_values, vision_features)
+        return vision_features
+
+
+def get_vision_features(model, pixel_values, image_sizes=None, cache=None):
+    # the cached vision features of `model`, None without a cache (the model runs its vision tower)
+    if cache is None:
+        return None
+    return cache.get(model, pixel_values, image_sizes)
@@ -3,6 +3,8 @@
 
 # DeepSpeed Team
 import math
+import os
+from contextlib import contextmanager
 import torch
 from torch import nn
 import torch.nn.functional as F
@@ -49,6 +51,10 @@ class LinearLayer_LoRA(nn.Module):
         self.weight.requires_grad = False
         # fuse LoRA to the original weight
         self.fuse_lora = False
+        # bypass LoRA and use the original weight only
+        self.lora_disabled = False
+        # the original values (of the local partition under ZeRO-3) that unfusing with the fp32 delta does not restore
+        self.lora_fuse_residual = None
 
     def eval(self):
         self.lora_dropout.eval()
@@ -60,20 +66,70 @@ class LinearLayer_LoRA(nn.Module):
         nn.init.kaiming_uniform_(self.lora_right_weight, a=math.sqrt(5))
         nn.init.zeros_(self.lora_left_weight)
 
+    def get_lora_delta(self):
+        # the update of the weight in fp32
+        return self.lora_scaling * torch.matmul(
+            self.lora_left_weight.t().float(), self.lora_right_weight.t().float())
+
+    def get_lora_delta_range(self, start, end):
+        # the elements [start, end) of the flattened fp32 update, only the rows they fall in are computed
+        columns = self.lora_right_weight.size(0)
+        first_row, last_row = start // columns, (end + columns - 1) // columns
+        delta = self.lora_scaling * torch.matmul(
+            self.lora_left_weight.t()[first_row:last_row].float(), self.lora_right_weight.t().float())
+        return delta.view(-1)[start - first_row * columns:end - first_row * columns]
+
+    def get_partition_range(self):
+        # the elements of the flattened weight this rank holds: its partition under ZeRO-3, else all of them
+        # (also for the small ZeRO-3 parameters that are kept gathered)
+        if hasattr(self.weight, 'ds_id') and not getattr(self.weight, 'ds_persist', False):
+            partition_size = self.weight.ds_tensor.ds_numel
+            start = partition_size * torch.distributed.get_rank(group=self.weight.ds_process_group)
+            start = min(start, self.weight.ds_numel)
+            return start, min(start + partition_size, self.weight.ds_numel)
+        return 0, self.weight.numel()
+
+    def get_weight_partition(self):
+        # the flattened weight values of get_partition_range (a view), also while the weight is gathered
+        start, end = self.get_partition_range()
+        if hasattr(self.weight, 'ds_id') and not getattr(self.weight, 'ds_persist', False):
+            return self.weight.ds_tensor.data.view(-1)[:end - start]
+        return self.weight.data.view(-1)
+
     def fuse_lora_weight(self):
+        # under ZeRO-3, call it with the weight gathered
         if not self.fuse_lora:
-            self.weight.data += self.lora_scaling * torch.matmul(
-                self.lora_left_weight.t(), self.lora_right_weight.t())
+            fused_weight = (self.weight.data.float() + self.get_lora_delta()).to(self.weight.dtype)
+            # in fp16/bf16, (w + delta) - delta is not always w. Unfusing subtracts the fp32 delta again, keep the
+            # few original values (of this rank's partition) it would not restore, so that repeated fuse/unfuse
+            # does not drift the base weight
+            start, end = self.get_partition_range()
+            delta = self.get_lora_delta_range(start, end)
+            original = self.weight.data.view(-1)[start:end]
+            restored = (fused_weight.view(-1)[start:end].float() - delta).to(self.weight.dtype)
+            drift_index = torch.nonzero(restored != original).squeeze(-1).int()
+            self.lora_fuse_residual = (drift_index, original[drift_index].clone(), delta.sum())
+            self.weight.data.copy_(fused_weight)
         self.fuse_lora = True
 
     def unfuse_lora_weight(self):
+        # under ZeRO-3, call it with the LoRA weights gathered and the weight partitioned: the partition is
+        # restored in place
         if self.fuse_lora:
-            self.weight.data -= self.lora_scaling * torch.matmul(
-                self.lora_left_weight.t(), self.lora_right_weight.t())
+            drift_index, original_values, checksum = self.lora_fuse_residual
+            start, end = self.get_partition_range()
+            delta = self.get_lora_delta_range(start, end)
+            assert torch.equal(delta.sum(), checksum), \
+                "the LoRA weights are updated while they are fused, the base weight can not be restored"
+            partition = self.get_weight_partition()
+            restored = (partition.float() - delta).to(partition.dtype)
+            restored[drift_index.long()] = original_values
+            partition.copy_(restored)
+            self.lora_fuse_residual = None
         self.fuse_lora = False
 
     def forward(self, input):
-        if self.fuse_lora:
+        if self.fuse_lora or self.lora_disabled:
             return F.linear(input, self.weight, self.bias)
         else:
             return F.linear(
@@ -81,6 +137,83 @@ class LinearLayer_LoRA(nn.Module):
                 self.bias) + (self.lora_dropout(input) @ self.lora_right_weight
                               @ self.lora_left_weight) * self.lora_scaling
 
+
+class LinearLayer_MultiLoRA(nn.Module):
+    # several named LoRA adapters on one frozen linear layer, different rows of a batch can use different adapters
+    def __init__(self, weight, bias=None):
+        super(LinearLayer_MultiLoRA, self).__init__()
+        self.weight = weight
+        self.bias = bias
+        self.weight.requires_grad = False
+        try:
+            # for zero stage 3
+            self.rows, self.columns = weight.ds_shape
+        except:
+            self.rows, self.columns = weight.shape
+
+        self.lora_right_weights = nn.ParameterDict()
+        self.lora_left_weights = nn.ParameterDict()
+        self.lora_scalings = {}
+        # the adapter of each row of the batch (index into adapter_names), None for the base weight only
+        self.adapter_index = None
+        # the stacked weights of get_stacked_weights by (dtype, device), rebuilt when the adapters change
+        self.stacked_weights = {}
+
+    @property
+    def adapter_names(self):
+        return list(self.lora_left_weights.keys())
+
+    def add_adapter(self, name, left_weight, right_weight, lora_scaling):
+        # left_weight: [lora_dim, rows], right_weight: [columns, lora_dim], lora_scaling is already divided by lora_dim
+        assert name not in self.lora_scalings, f"the adapter {name} is already loaded"
+        self.lora_left_weights[name] = nn.Parameter(left_weight.to(self.weight.device), requires_grad=False)
+        self.lora_right_weights[name] = nn.Parameter(right_weight.to(self.weight.device), requires_grad=False)
+        self.lora_scalings[name] = float(lora_scaling)
+        self.stacked_weights = {}
+
+    def remove_adapter(self, name):
+        del self.lora_left_weights[name]
+        del self.lora_right_weights[name]
+        del self.lora_scalings[name]
+        self.stacked_weights = {}
+
+    def get_stacked_weights(self, dtype):
+        # [num_adapters + 1, columns, max_dim] and [num_adapters + 1, max_dim, rows], the last one (zeros)
+        # is for the rows without an adapter. Adapters of different dims are zero-padded.
+        # They are built once per dtype (and device) after the adapters change and reused by every forward.
+        key = (dtype, self.weight.device)
+        if key not in self.stacked_weights:
+            self.stacked_weights[key] = self.build_stacked_weights(dtype)
+        return self.stacked_weights[key]
+
+    @torch.no_grad()
+    def build_stacked_weights(self, dtype):
+        names = self.adapter_names
+        max_dim = max(self.lora_left_weights[name].size(0) for name in names)
+        right_weights = self.weight.new_zeros(len(names) + 1, self.columns, max_dim, dtype=dtype)
+        left_weights = self.weight.new_zeros(len(names) + 1, max_dim, self.rows, dtype=dtype)
+        for i, name in enumerate(names):
+            lora_dim = self.lora_left_weights[name].size(0)
+            right_weights[i, :, :lora_dim] = self.lora_right_weights[name]
+            left_weights[i, :lora_dim] = self.lora_left_weights[name] * self.lora_scalings[name]
+        return right_weights, left_weights
+
+    def forward(self, input):
+        output = F.linear(input, self.weight, self.bias)
+        if self.adapter_index is None or len(self.lora_scalings) == 0:
+            return output
+
+        adapter_index = self.adapter_index.to(input.device)
+        if input.size(0) != adapter_index.size(0):
+            # e.g., several image patches per row in the vision tower
+            assert input.size(0) % adapter_index.size(0) == 0, "the adapter of each row can not be inferred"
+            adapter_index = adapter_index.repeat_interleave(input.size(0) // adapter_index.size(0))
+        right_weights, left_weights = self.get_stacked_weights(input.dtype)
+        hidden = input.reshape(input.size(0), -1, input.size(-1))
+        # gathered low-rank matmul: [batch, seq, columns] @ [batch, columns, dim] @ [batch, dim, rows]
+        lora_output = torch.bmm(torch.bmm(hidden, right_weights[adapter_index]), left_weights[adapter_index])
+        return output + lora_output.view_as(output)
+
  
 # convert the linear layer to LoRA
 def convert_linear_layer_to_lora(model,
@@ -122,6 +255,14 @@ def convert_lora_to_linear_layer(model, fuse_lora=True):
             repalce_name.append(name)
     for name in repalce_name:
         module = recursive_getattr(model, name)
+        if not fuse_lora:
+            # each rank restores its own partition of the weight, only the LoRA weights are gathered
+            with deepspeed.zero.GatheredParameters(_z3_params_to_fetch([
+                    module.lora_left_weight, module.lora_right_weight
+            ]),
+                                                   enabled=hasattr(module.weight, 'ds_id')):
+                module.unfuse_lora_weight()
+            continue
         zero_stage_3 = hasattr(module.weight, 'ds_id')
         with deepspeed.zero.GatheredParameters(_z3_params_to_fetch([
                 module.weight, module.bias, module.lora_left_weight,
@@ -129,10 +270,7 @@ def convert_lora_to_linear_layer(model, fuse_lora=True):
         ]),
                                                modifier_rank=0,
                                                enabled=zero_stage_3):
-            if fuse_lora:
-                module.fuse_lora_weight()
-            else:
-                module.unfuse_lora_weight()
+            module.fuse_lora_weight()
     return model
 
 def fuse_lora(model):
@@ -142,6 +280,160 @@ def unfuse_lora(model):
     return convert_lora_to_linear_layer(model, fuse_lora=False)
 
 
+@contextmanager
+def lora_fused(model):
+    # fuse the LoRA weights into the base weights for generation, the LoRA layers then cost the same as the
+    # linear layers, and unfuse them before the training forward
+    lora_modules = [module for module in model.modules() if isinstance(module, LinearLayer_LoRA)]
+    fused = len(lora_modules) > 0 and not all(module.fuse_lora for module in lora_modules)
+    if fused:
+        fuse_lora(model)
+    try:
+        yield model
+    finally:
+        if fused:
+            unfuse_lora(model)
+
+
+def has_lora_layers(model):
+    return any(isinstance(module, LinearLayer_LoRA) for module in model.modules())
+
+
+@contextmanager
+def lora_disabled(model):
+    # run the model with the original (base) weights only, e.g., the reference policy of a LoRA actor
+    lora_modules = [module for module in model.modules() if isinstance(module, LinearLayer_LoRA)]
+    fused = any(module.fuse_lora for module in lora_modules)
+    if fused:
+        unfuse_lora(model)
+    for module in lora_modules:
+        module.lora_disabled = True
+    try:
+        yield model
+    finally:
+        for module in lora_modules:
+            module.lora_disabled = False
+        if fused:
+            fuse_lora(model)
+
+
+def merge_lora_state_dict(model, state_dict):
+    # fold the LoRA weights of a state dict into the weights of their linear layers and drop them, so that
+    # the checkpoint has the keys of the original model and can be loaded without LoRA (e.g., from_pretrained)
+    state_dict = state_dict.copy()
+    for name, module in model.named_modules():
+        if not isinstance(module, LinearLayer_LoRA):
+            continue
+        prefix = f"{name}." if name else ""
+        left_weight = state_dict.pop(prefix + "lora_left_weight", None)
+        right_weight = state_dict.pop(prefix + "lora_right_weight", None)
+        weight = state_dict.get(prefix + "weight", None)
+        if left_weight is None or right_weight is None or weight is None or module.fuse_lora:
+            continue
+        delta = module.lora_scaling * torch.matmul(left_weight.t().float(), right_weight.t().float())
+        state_dict[prefix + "weight"] = (weight.float() + delta.to(weight.device)).to(weight.dtype)
+    return state_dict
+
+
+LORA_ADAPTER_NAME = "adapter_model.bin"
+
+
+def save_lora_adapter(model, state_dict, output_dir):
+    # save the LoRA weights of a state dict (with the scaling of each layer) to `adapter_model.bin`, so that the
+    # fine-tune can be loaded as a named adapter with `load_lora_adapter`. Nothing is saved without LoRA layers.
+    adapter_state_dict = {}
+    for name, module in model.named_modules():
+        if not isinstance(module, LinearLayer_LoRA):
+            continue
+        prefix = f"{name}." if name else ""
+        if prefix + "lora_left_weight" not in state_dict:
+            continue
+        adapter_state_dict[prefix + "lora_left_weight"] = state_dict[prefix + "lora_left_weight"].detach().cpu()
+        adapter_state_dict[prefix + "lora_right_weight"] = state_dict[prefix + "lora_right_weight"].detach().cpu()
+        adapter_state_dict[prefix + "lora_scaling"] = torch.tensor(module.lora_scaling)
+    if len(adapter_state_dict) > 0:
+        os.makedirs(output_dir, exist_ok=True)
+        torch.save(adapter_state_dict, os.path.join(output_dir, LORA_ADAPTER_NAME))
+
+
+# convert the linear layers to multi-adapter LoRA layers, the adapters are added with `load_lora_adapter`
+def convert_linear_layer_to_multi_lora(model, part_module_name):
+    repalce_name = []
+    part_module_name = part_module_name.split(",")
+    for name, module in model.named_modules():
+        if isinstance(module, nn.Linear) and any(part_module_name_sub in name for part_module_name_sub in part_module_name):
+            repalce_name.append(name)
+    for name in repalce_name:
+        module = recursive_getattr(model, name)
+        recursive_setattr(model, name, LinearLayer_MultiLoRA(module.weight, module.bias))
+    return model
+
+
+def load_lora_adapter(model, adapter_name, path):
+    """
+    Load the adapter saved by `save_lora_adapter` (a file, or a checkpoint folder with adapter_model.bin) into
+    the multi-adapter LoRA layers of the model under `adapter_name`. The layers are matched by name, a name may
+    have an extra prefix on either side (e.g., an actor adapter loaded into a reward model, or the reverse).
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, LORA_ADAPTER_NAME)
+    adapter_state_dict = torch.load(path, map_location="cpu")
+    adapter_modules = [key[:-len(".lora_scaling")] for key in adapter_state_dict if key.endswith(".lora_scaling")]
+
+    num_loaded = 0
+    for name, module in model.named_modules():
+        if not isinstance(module, LinearLayer_MultiLoRA):
+            continue
+        matched = [adapter_module for adapter_module in adapter_modules
+                   if adapter_module == name or adapter_module.endswith("." + name) or name.endswith("." + adapter_module)]
+        if len(matched) == 0:
+            continue
+        assert len(matched) == 1, f"the layer {name} matches several layers of the adapter: {matched}"
+        module.add_adapter(adapter_name,
+                           adapter_state_dict[matched[0] + ".lora_left_weight"],
+                           adapter_state_dict[matched[0] + ".lora_right_weight"],
+                           adapter_state_dict[matched[0] + ".lora_scaling"].item())
+        num_loaded += 1
+    assert num_loaded > 0, f"no layer of the model matches the adapter {path}"
+    return num_loaded
+
+
+def unload_lora_adapter(model, adapter_name):
+    for module in model.modules():
+        if isinstance(module, LinearLayer_MultiLoRA) and adapter_name in module.lora_scalings:
+            module.remove_adapter(adapter_name)
+
+
+def set_lora_adapters(model, adapter_names):
+    # the adapter of each row of the next batches (a list, None for the base model), or one adapter for all rows.
+    # Pass None to use the base model only.
+    if adapter_names is not None:
+        loaded_names = set(name for module in model.modules() if isinstance(module, LinearLayer_MultiLoRA)
+                           for name in module.adapter_names)
+        row_names = [adapter_names] if isinstance(adapter_names, str) else adapter_names
+        unknown_names = set(name for name in row_names if name is not None) - loaded_names
+        assert len(unknown_names) == 0, f"the adapters {unknown_names} are not loaded"
+    for module in model.modules():
+        if not isinstance(module, LinearLayer_MultiLoRA):
+            continue
+        if adapter_names is None:
+            module.adapter_index = None
+            continue
+        # the layers without the adapter (e.g., it only covers the language decoder) use the base weight
+        names = module.adapter_names
+        module.adapter_index = torch.LongTensor([
+            names.index(name) if name in names else len(names) for name in row_names])
+
+
+@contextmanager
+def lora_adapters(model, adapter_names):
+    set_lora_adapters(model, adapter_names)
+    try:
+        yield model
+    finally:
+        set_lora_adapters(model, None)
+
+
 def only_optimize_lora_parameters(model):
     # turn off the gradient of all the parameters except the LoRA parameters
     for name, param in model.named_parameters():
@@ -0,0 +1,53 @@
+import torch
+
+
+def get_candidate_mask(candidate_offsets):
+    # the candidates of query i are the rows candidate_offsets[i]:candidate_offsets[i+1] of the batch.
+    # Return the [num_queries, max_num_candidates] validity mask
+    num_candidates = candidate_offsets[1:] - candidate_offsets[:-1]
+    max_num_candidates = int(num_candidates.max().item())
+    return torch.arange(max_num_candidates, device=candidate_offsets.device)[None, :] < num_candidates[:, None]
+
+
+def scatter_candidate_scores(scores, candidate_mask):
+    # scores of the valid candidates (in row order) -> [num_queries, num_candidates], 0 for the invalid ones
+    return scores.new_zeros(candidate_mask.shape).masked_scatter(candidate_mask, scores)
+
+
+def plackett_luce_log_likelihood(scores, candidate_mask):
+    """
+    Log-likelihood of the given ranking (candidate 0 is the best) of each query under the Plackett-Luce model:
+    sum_i (s_i - log sum_{j>=i} exp(s_j)). The valid candidates of a query must come first.
+    """
+    scores = scatter_candidate_scores(scores.float(), candidate_mask)
+    # a finite value instead of -inf, so that the backward of logcumsumexp has no nan
+    masked_scores = scores.masked_fill(~candidate_mask, torch.finfo(scores.dtype).min)
+    log_denominator = masked_scores.flip(-1).logcumsumexp(-1).flip(-1)
+    return ((scores - log_denominator) * candidate_mask).sum(-1)
+
+
+def listwise_loss(scores, candidate_mask, label_smoothing=0.0):
+    """
+    Plackett-Luce ranking loss averaged over the queries. `scores` are the rewards of the valid candidates in row
+    order (e.g., reward scores, or beta * (logp - ref_logp) for multi-candidate DPO), `candidate_mask` is the
+    [num_queries, num_candidates] validity mask. With two candidates it is the Bradley-Terry / DPO loss.
+    """
+    log_likelihood = plackett_luce_log_likelihood(scores, candidate_mask)
+    loss = -log_likelihood * (1 - label_smoothing)
+    if label_smoothing > 0:
+        # log(1 - p) with p = exp(log_likelihood)
+        log_one_minus_p = torch.log((-torch.expm1(log_likelihood)).clamp(min=torch.finfo(log_likelihood.dtype).tiny))
+        loss = loss - log_one_minus_p * label_smoothing
+    return loss.mean()
+
+
+@torch.no_grad()
+def pairwise_accuracy(scores, candidate_mask):
+    # number of the candidate pairs (i < j, i is preferred) ranked correctly by the scores and the number of pairs,
+    # both are kept on the device so that they can be accumulated and all-reduced without a sync
+    scores = scatter_candidate_scores(scores.float(), candidate_mask)
+    num_candidates = candidate_mask.size(-1)
+    pair_mask = torch.ones(num_candidates, num_candidates, dtype=torch.bool, device=scores.device).triu(1)
+    pair_mask = pair_mask & candidate_mask[:, :, None] & candidate_mask[:, None, :]
+    correct = ((scores[:, :, None] > scores[:, None, :]) & pair_mask).sum()
+    return correct, pair_mask.sum()
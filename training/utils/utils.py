@@ -3,6 +3,7 @@
 
 # DeepSpeed Team
 import os
+import glob
 import torch
 import torch.nn as nn
 import random
@@ -11,6 +12,7 @@ from transformers import set_seed, AutoTokenizer
 import json
 import deepspeed
 from deepspeed.runtime.zero.partition_parameters import ZeroParamStatus
+from .module.lora import merge_lora_state_dict, save_lora_adapter
 
 
 def print_rank_0(msg, rank=None):
@@ -61,6 +63,112 @@ class MovingAverage:
         return self.mean
 
 
+class PredictionShardWriter:
+    """
+    Append the prediction lines of this rank to its shard through one file handle, each line is flushed as soon as
+    it is written so that a crash loses at most the line being written. The lines keep the order the batches come
+    in, merge_prediction_shards orders the records by id.
+    """
+
+    def __init__(self, path, mode="a"):
+        if mode == "a":
+            truncate_partial_line(path)
+        self.file = open(path, mode, encoding="utf-8")
+        # a sample repeated by the distributed sampler (to even out the ranks) is written once
+        self.written = set()
+
+    def write(self, index, line):
+        if index in self.written:
+            return
+        self.written.add(index)
+        self.file.write(line)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def truncate_partial_line(path):
+    # drop the last line of a file if it was cut (e.g., by a crash), so that new lines can be appended
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if len(data) > 0 and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def get_shard_path(output_path, rank):
+    # the predictions of each rank go to their own shard, merged into output_path by merge_prediction_shards
+    return f"{output_path}.shard{rank:05d}.jsonl"
+
+
+def get_shard_paths(output_path):
+    return sorted(glob.glob(glob.escape(output_path) + ".shard*.jsonl"))
+
+
+def remove_prediction_shards(output_path):
+    for path in get_shard_paths(output_path):
+        os.remove(path)
+
+
+def read_prediction_shards(output_path):
+    # the records of all shards of output_path, a last line cut by a crash is skipped
+    records = []
+    for path in get_shard_paths(output_path):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break
+                records.append(json.loads(line))
+    return records
+
+
+def merge_prediction_shards(output_path, ids=None, output_format="jsonl"):
+    """
+    Merge the shards of all ranks into output_path with one record per id, in the order of `ids` (e.g., the ids of
+    the data file) and the other ids after them in sorted order, so that the output does not depend on the number
+    of ranks or the timing. output_format "text" writes the fields of a record in one " ||| " separated line.
+    Return the number of records.
+    """
+    records = {}
+    for record in read_prediction_shards(output_path):
+        records.setdefault(str(record["id"]), record)
+    order = {str(id): i for i, id in enumerate(ids or [])}
+    keys = sorted(records.keys(), key=lambda id: (order.get(id, len(order)),) + ((0, int(id), "") if id.isdigit() else (1, 0, id)))
+    with open(output_path, "w", encoding="utf-8") as f:
+        for key in keys:
+            if output_format == "text":
+                f.write(" ||| ".join(str(value).replace("\n", "\\n") for value in records[key].values()) + "\n")
+            else:
+                f.write(json.dumps(records[key], ensure_ascii=False) + "\n")
+    return len(keys)
+
+
+def expand_past_key_values(past_key_values, index):
+    # select (and repeat) the cached keys/values of each sequence, works for both Cache objects and legacy tuples
+    if hasattr(past_key_values, "to_legacy_cache"):
+        legacy_cache = past_key_values.to_legacy_cache()
+        expanded = tuple(tuple(t[index] for t in layer) for layer in legacy_cache)
+        return past_key_values.__class__.from_legacy_cache(expanded)
+    return tuple(tuple(t[index] for t in layer) for layer in past_key_values)
+
+
+def crop_past_key_values(past_key_values, length):
+    # keep the cached keys/values of the first `length` positions, works for both Cache objects and legacy tuples
+    if hasattr(past_key_values, "to_legacy_cache"):
+        legacy_cache = past_key_values.to_legacy_cache()
+        cropped = tuple(tuple(t[:, :, :length] for t in layer) for layer in legacy_cache)
+        return past_key_values.__class__.from_legacy_cache(cropped)
+    return tuple(tuple(t[:, :, :length] for t in layer) for layer in past_key_values)
+
+
 def set_random_seed(seed):
     if seed is not None:
         set_seed(seed)
@@ -76,21 +184,36 @@ def get_all_reduce_mean(tensor):
     return tensor
 
 
+def all_ranks_done(done, device):
+    # whether `done` holds on every rank: under ZeRO-3 the decoding loops stop together (as generate with synced_gpus),
+    # the ranks that are done keep running dummy forwards, so that the parameter gathers stay in step
+    done = torch.tensor(int(done), device=device)
+    if torch.distributed.is_initialized():
+        torch.distributed.all_reduce(done, op=torch.distributed.ReduceOp.MIN)
+    return done.item() == 1
+
+
 def get_optimizer_grouped_parameters(model,
                                      weight_decay,
                                      no_decay_name_list=[
                                          "bias", "LayerNorm.weight"
                                      ],
                                      small_learning_rate_list=
-                                     ["embed"], small_lr=1e-4):
+                                     ["embed"], small_lr=1e-4,
+                                     lora_name_list=[
+                                         "lora_right_weight", "lora_left_weight"
+                                     ]):
     
+    def is_lora(n):
+        return any(nd in n for nd in lora_name_list)
+
     optimizer_grouped_parameters = [
         {
             "params": [
                 p for n, p in model.named_parameters()
                 if (not any(nd in n
                             for nd in no_decay_name_list) and (not any(nd in n
-                            for nd in small_learning_rate_list)) and p.requires_grad)
+                            for nd in small_learning_rate_list)) and not is_lora(n) and p.requires_grad)
             ],
             "weight_decay":
             weight_decay,
@@ -100,7 +223,7 @@ def get_optimizer_grouped_parameters(model,
                 p for n, p in model.named_parameters()
                 if (any(nd in n
                         for nd in no_decay_name_list) and (not any(nd in n
-                            for nd in small_learning_rate_list)) and p.requires_grad)
+                            for nd in small_learning_rate_list)) and not is_lora(n) and p.requires_grad)
             ],
             "weight_decay":
             0.0,
@@ -110,7 +233,7 @@ def get_optimizer_grouped_parameters(model,
                 p for n, p in model.named_parameters()
                 if (not any(nd in n
                             for nd in no_decay_name_list) and (any(nd in n
-                            for nd in small_learning_rate_list)) and p.requires_grad)
+                            for nd in small_learning_rate_list)) and not is_lora(n) and p.requires_grad)
             ],
             "weight_decay":
             weight_decay,
@@ -121,13 +244,24 @@ def get_optimizer_grouped_parameters(model,
                 p for n, p in model.named_parameters()
                 if (any(nd in n
                         for nd in no_decay_name_list) and (any(nd in n
-                            for nd in small_learning_rate_list)) and p.requires_grad)
+                            for nd in small_learning_rate_list)) and not is_lora(n) and p.requires_grad)
             ],
             "weight_decay":
             0.0,
             "lr": small_lr
         },
+        {
+            # the LoRA adapters: no weight decay, their product is the update of the frozen weight
+            "params": [
+                p for n, p in model.named_parameters()
+                if is_lora(n) and p.requires_grad
+            ],
+            "weight_decay":
+            0.0,
+        },
     ]
+    # e.g., only the LoRA adapters are trained, the optimizer of deepspeed does not accept empty groups
+    optimizer_grouped_parameters = [group for group in optimizer_grouped_parameters if len(group["params"]) > 0]
     return optimizer_grouped_parameters
 
 
@@ -177,7 +311,22 @@ def save_hf_format(model, tokenizer, args, sub_folder=""):
     # tokenizer.save_vocabulary(output_dir)
     tokenizer.save_pretrained(output_dir)  # this will save all tokenizer files
 
-def save_zero_three_model(model_ema, global_rank, save_dir, zero_stage=0, sub_folder=""):
+VALUE_HEAD_NAME = "value_head.bin"
+
+
+def split_value_head(state_dict, output_dir):
+    # the value head that --shared_critic puts on the actor (`v_head.*`) is not part of the policy: save it to
+    # `value_head.bin` in output_dir and return the state dict without it, so that the actor loads as before
+    value_head_state_dict = {k: v for k, v in state_dict.items() if k.startswith("v_head.")}
+    if len(value_head_state_dict) == 0:
+        return state_dict
+    os.makedirs(output_dir, exist_ok=True)
+    torch.save(value_head_state_dict, os.path.join(output_dir, VALUE_HEAD_NAME))
+    return {k: v for k, v in state_dict.items() if not k.startswith("v_head.")}
+
+
+def save_zero_three_model(model_ema, global_rank, save_dir, zero_stage=0, sub_folder="", exclude_value_head=False):
+    # exclude_value_head: save the `v_head.*` weights (the shared critic of an actor) apart, see split_value_head
     zero_stage_3 = (zero_stage == 3)
     output_dir = os.path.join(save_dir, sub_folder)
     os.makedirs(output_dir, exist_ok=True)
@@ -188,7 +337,11 @@ def save_zero_three_model(model_ema, global_rank, save_dir, zero_stage=0, sub_fo
                                                 'module') else model_ema
     if not zero_stage_3:
         if global_rank == 0:
-            torch.save(model_to_save.state_dict(), output_model_file)
+            state_dict = model_to_save.state_dict()
+            if exclude_value_head:
+                state_dict = split_value_head(state_dict, output_dir)
+            torch.save(merge_lora_state_dict(model_to_save, state_dict), output_model_file)
+            save_lora_adapter(model_to_save, state_dict, output_dir)
     else:
         output_state_dict = {}
         for k, v in model_to_save.named_parameters():
@@ -200,10 +353,13 @@ def save_zero_three_model(model_ema, global_rank, save_dir, zero_stage=0, sub_fo
                     v_p = v.data.clone().detach().cpu() # this is a hack to get around the fact that we can't get the data from the param
             else:
                 v_p = v.cpu()
-            if global_rank == 0 and "lora" not in k:
+            if global_rank == 0:
                 output_state_dict[k] = v_p
         if global_rank == 0:
-            torch.save(output_state_dict, output_model_file)
+            if exclude_value_head:
+                output_state_dict = split_value_head(output_state_dict, output_dir)
+            torch.save(merge_lora_state_dict(model_to_save, output_state_dict), output_model_file)
+            save_lora_adapter(model_to_save, output_state_dict, output_dir)
         del output_state_dict
 
 # This function is a modified version of code available in the from_pretrained API of HuggingFace Transformers